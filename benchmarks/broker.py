@@ -0,0 +1,190 @@
+"""
+A minimal, in-process MQTT 3.1.1 broker, for tests and benchmarks.
+
+It supports just enough of the protocol for paho to talk to it: CONNECT, SUBSCRIBE (with
++ and # wildcards), PUBLISH at QoS 0, 1 and 2, retained messages, PINGREQ and DISCONNECT.
+Messages are always delivered to subscribers at QoS 0.
+
+The broker runs its own event loop in a background thread:
+
+    broker = FakeBroker().start()
+    client.connect('127.0.0.1', broker.port)
+    ...
+    broker.stop()
+"""
+import asyncio
+import struct
+import threading
+import time
+from collections import namedtuple
+
+CONNECT, CONNACK, PUBLISH, PUBACK, PUBREC, PUBREL, PUBCOMP = 1, 2, 3, 4, 5, 6, 7
+SUBSCRIBE, SUBACK, UNSUBSCRIBE, UNSUBACK, PINGREQ, PINGRESP, DISCONNECT = 8, 9, 10, 11, 12, 13, 14
+
+Published = namedtuple('Published', ['topic', 'payload', 'qos', 'retain', 'received'])
+
+
+def topic_matches(topic_filter, topic):
+    filter_parts = topic_filter.split('/')
+    topic_parts = topic.split('/')
+    for i, part in enumerate(filter_parts):
+        if part == '#':
+            return True
+        if i >= len(topic_parts) or (part != '+' and part != topic_parts[i]):
+            return False
+    return len(filter_parts) == len(topic_parts)
+
+
+def encode_length(length):
+    encoded = bytearray()
+    while True:
+        byte, length = length % 128, length // 128
+        encoded.append(byte | (0x80 if length else 0))
+        if not length:
+            return bytes(encoded)
+
+
+def packet(packet_type, body=b'', flags=0):
+    return bytes([packet_type << 4 | flags]) + encode_length(len(body)) + body
+
+
+def encode_string(value):
+    return struct.pack('!H', len(value)) + value
+
+
+class Connection:
+    def __init__(self, broker, reader, writer):
+        self.broker = broker
+        self.reader = reader
+        self.writer = writer
+        self.subscriptions = []
+
+    async def read_packet(self):
+        header = (await self.reader.readexactly(1))[0]
+        length, multiplier = 0, 1
+        while True:
+            byte = (await self.reader.readexactly(1))[0]
+            length += (byte & 0x7f) * multiplier
+            multiplier *= 128
+            if not byte & 0x80:
+                break
+        return header >> 4, header & 0x0f, await self.reader.readexactly(length)
+
+    def send(self, data):
+        self.writer.write(data)
+
+    def deliver(self, topic, payload, retain=False):
+        self.send(packet(PUBLISH, encode_string(topic.encode()) + payload, flags=int(retain)))
+
+    async def serve(self):
+        try:
+            while True:
+                packet_type, flags, body = await self.read_packet()
+                if packet_type == CONNECT:
+                    self.send(packet(CONNACK, b'\x00\x00'))
+                elif packet_type == PUBLISH:
+                    self.handle_publish(flags, body)
+                elif packet_type == PUBREL:
+                    self.send(packet(PUBCOMP, body[:2]))
+                elif packet_type == SUBSCRIBE:
+                    self.handle_subscribe(body)
+                elif packet_type == UNSUBSCRIBE:
+                    self.send(packet(UNSUBACK, body[:2]))
+                elif packet_type == PINGREQ:
+                    self.send(packet(PINGRESP))
+                elif packet_type == DISCONNECT:
+                    break
+                await self.writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.broker.connections.discard(self)
+            self.writer.close()
+
+    def handle_publish(self, flags, body):
+        qos, retain = (flags >> 1) & 0x03, bool(flags & 0x01)
+        length = struct.unpack('!H', body[:2])[0]
+        topic = body[2:2 + length].decode()
+        offset = 2 + length
+        if qos:
+            message_id = body[offset:offset + 2]
+            offset += 2
+            self.send(packet(PUBACK if qos == 1 else PUBREC, message_id))
+        self.broker.route(topic, body[offset:], qos, retain)
+
+    def handle_subscribe(self, body):
+        message_id, offset, granted = body[:2], 2, bytearray()
+        while offset < len(body):
+            length = struct.unpack('!H', body[offset:offset + 2])[0]
+            topic_filter = body[offset + 2:offset + 2 + length].decode()
+            offset += 2 + length + 1
+            self.subscriptions.append(topic_filter)
+            granted.append(0)
+            for topic, payload in self.broker.retained.items():
+                if topic_matches(topic_filter, topic):
+                    self.deliver(topic, payload, retain=True)
+        self.send(packet(SUBACK, message_id + bytes(granted)))
+
+
+class FakeBroker:
+    def __init__(self):
+        self.connections = set()
+        self.retained = {}
+        self.published = []
+        self.listeners = []
+        self.port = None
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, name='FakeBroker', daemon=True)
+
+    def start(self):
+        self.server = self.loop.run_until_complete(
+            asyncio.start_server(self._connected, '127.0.0.1', 0)
+        )
+        self.port = self.server.sockets[0].getsockname()[1]
+        self._thread.start()
+        return self
+
+    def stop(self):
+        def close():
+            self.server.close()
+            for task in asyncio.all_tasks(self.loop):
+                task.cancel()
+            # Let the cancelled tasks finish before we stop.
+            self.loop.call_soon(self.loop.stop)
+        self.loop.call_soon_threadsafe(close)
+        self._thread.join()
+
+    async def _connected(self, reader, writer):
+        connection = Connection(self, reader, writer)
+        self.connections.add(connection)
+        await connection.serve()
+
+    def route(self, topic, payload, qos=0, retain=False):
+        """
+        Handle a message published to the broker: this must run in the broker's loop.
+        """
+        message = Published(topic, payload, qos, retain, time.perf_counter())
+        self.published.append(message)
+        for listener in self.listeners:
+            listener(message)
+        if retain:
+            if payload:
+                self.retained[topic] = payload
+            else:
+                self.retained.pop(topic, None)
+        for connection in list(self.connections):
+            if any(topic_matches(topic_filter, topic) for topic_filter in connection.subscriptions):
+                connection.deliver(topic, payload)
+
+    def publish(self, topic, payload, retain=False):
+        """
+        Publish a message, as if a device connected to the broker had sent it.
+        """
+        self.loop.call_soon_threadsafe(self.route, topic, payload, 0, retain)
+
+    def subscribed(self, prefix):
+        return any(
+            topic_filter.startswith(prefix)
+            for connection in list(self.connections)
+            for topic_filter in connection.subscriptions
+        )
@@ -0,0 +1,69 @@
+"""
+Time handling a sample from a multi-value device (an Inverter, from services.pv.json), sent
+as one MQTT message per characteristic, and as a single bulk JSON message.
+
+    $ PYTHONPATH=. python -m benchmarks.bulk
+"""
+import json
+import time
+
+from paho.mqtt.client import MQTTMessage
+
+from .utils import make_bridge, record_events
+
+SAMPLES = 2000
+COUNT = 20
+
+
+def message(topic, payload):
+    message = MQTTMessage(topic=topic.encode())
+    message.payload = payload
+    return message
+
+
+def sample(i, n):
+    return {
+        'Active': n % 2,
+        'Power': 1000 + n % 500,
+        'Energy': 10 + n / 100,
+        'Voltage': 230 + n % 10,
+        'Current': 4 + n % 3,
+    }
+
+
+def single(i, n):
+    return [
+        message('Benchmark/inverter-{}/Inverter/{}'.format(i, name), str(value).encode())
+        for name, value in sample(i, n).items()
+    ]
+
+
+def bulk(i, n):
+    return [message('Benchmark/inverter-{}/Inverter'.format(i), json.dumps(sample(i, n)).encode())]
+
+
+def measure(build):
+    bridge = make_bridge(bulk=True)
+    bridge.config_changed = lambda: None
+    events = record_events(bridge)
+    for i in range(COUNT):
+        for msg in build(i, 0):
+            bridge.handle_mqtt_message(None, None, msg)
+    messages = [build(n % COUNT, n) for n in range(1, SAMPLES + 1)]
+    del events[:]
+    start = time.perf_counter()
+    for sample_messages in messages:
+        for msg in sample_messages:
+            bridge.handle_mqtt_message(None, None, msg)
+    return (time.perf_counter() - start) / SAMPLES, len(messages[0]), len(events) / SAMPLES
+
+
+def main():
+    print('{:>8} {:>16} {:>16} {:>16}'.format('', 'per sample (us)', 'messages', 'events'))
+    for name, build in (('single', single), ('bulk', bulk)):
+        duration, messages, events = measure(build)
+        print('{:>8} {:>16.1f} {:>16} {:>16.1f}'.format(name, duration * 1e6, messages, events))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+"""
+Measure the time from a device publishing an MQTT message to the bridge sending the HomeKit
+event, with each of the MQTT loop implementations.
+
+    $ PYTHONPATH=. python -m benchmarks.latency
+"""
+import statistics
+
+from .broker import FakeBroker
+from .utils import record_events, run_until, start_bridge, stop_bridge
+
+MESSAGES = 500
+
+
+def measure(broker, mqtt_loop):
+    bridge = start_bridge(broker, mqtt_loop=mqtt_loop, prefix=mqtt_loop)
+    events = record_events(bridge)
+    published = {}
+    broker.listeners = [lambda message: published.__setitem__(message.payload, message.received)]
+    latencies = []
+    for i in range(MESSAGES):
+        payload = str(i % 100 + 1).encode()
+        count = len(events)
+        broker.publish('{}/sensor/TemperatureSensor/CurrentTemperature'.format(mqtt_loop), payload)
+        run_until(bridge, lambda: len(events) > count)
+        latencies.append(events[-1][0] - published[payload])
+    stop_bridge(bridge)
+    return latencies
+
+
+def main():
+    broker = FakeBroker().start()
+    print('{:>8} {:>12} {:>12}'.format('loop', 'p50 (us)', 'p99 (us)'))
+    for mqtt_loop in ('thread', 'asyncio'):
+        latencies = sorted(measure(broker, mqtt_loop))
+        print('{:>8} {:>12.0f} {:>12.0f}'.format(
+            mqtt_loop,
+            statistics.median(latencies) * 1e6,
+            latencies[int(len(latencies) * 0.99)] * 1e6,
+        ))
+    broker.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+"""
+Time handling MQTT messages at different log levels: both for topics we have not seen
+before (which creates accessories, and logs about it), and for topics we have.
+
+Records are formatted (into memory) as they would be by a real handler.
+
+    $ PYTHONPATH=. python -m benchmarks.logs
+"""
+import io
+import logging
+import time
+
+from paho.mqtt.client import MQTTMessage
+
+from .utils import make_bridge
+
+COUNT = 150
+
+
+def message(topic, payload):
+    message = MQTTMessage(topic=topic.encode())
+    message.payload = payload
+    return message
+
+
+def per_message(bridge, messages):
+    start = time.perf_counter()
+    for msg in messages:
+        bridge.handle_mqtt_message(None, None, msg)
+    return (time.perf_counter() - start) / len(messages)
+
+
+def main():
+    root = logging.getLogger()
+    handler = logging.StreamHandler(io.StringIO())
+    handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+    root.handlers[:] = [handler]
+
+    print('{:>10} {:>16} {:>16}'.format('level', 'new topic (us)', 'known topic (us)'))
+    for level in ('DEBUG', 'INFO', 'WARNING'):
+        root.setLevel(level)
+        bridge = make_bridge()
+        bridge.config_changed = lambda: None
+        new = [message('Benchmark/light-{}/Lightbulb/On'.format(i), b'1') for i in range(COUNT)]
+        new_topic = per_message(bridge, new)
+        known = [
+            message('Benchmark/light-{}/Lightbulb/On'.format(i), str(j % 2).encode())
+            for j in range(20) for i in range(COUNT)
+        ]
+        known_topic = per_message(bridge, known)
+        print('{:>10} {:>16.1f} {:>16.1f}'.format(level, new_topic * 1e6, known_topic * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,22 @@
+"""
+Time MQTTBridge.get_accessory as the number of accessories on the bridge grows.
+
+    $ PYTHONPATH=. python -m benchmarks.lookup
+"""
+from .utils import make_bridge, populate, timeit
+
+
+def main():
+    print('{:>12} {:>16}'.format('accessories', 'lookup (ns)'))
+    for count in (1, 10, 50, 100, 150):
+        bridge = make_bridge()
+        bridge.config_changed = lambda: None
+        populate(bridge, count)
+        # Always look for the last one added, which was the worst case for the linear scan.
+        accessory_id = 'accessory-{}'.format(count - 1)
+        assert bridge.get_accessory(accessory_id)
+        print('{:>12} {:>16.1f}'.format(count, timeit(lambda: bridge.get_accessory(accessory_id)) * 1e9))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""
+Measure the memory (with tracemalloc) that accessories take up on a bridge, once messages
+have been handled for every one of their characteristics: the top lines are where most of
+it was allocated.
+
+    $ PYTHONPATH=. python -m benchmarks.memory
+"""
+import gc
+import tracemalloc
+
+from paho.mqtt.client import MQTTMessage
+
+from .utils import make_bridge
+
+COUNT = 150
+CHARACTERISTICS = (
+    ('Lightbulb', 'On', b'1'),
+    ('Lightbulb', 'Brightness', b'50'),
+    ('TemperatureSensor', 'CurrentTemperature', b'21.5'),
+    ('TemperatureSensor', 'StatusActive', b'1'),
+    ('Switch', 'On', b'1'),
+)
+
+
+def message(topic, payload):
+    message = MQTTMessage(topic=topic.encode())
+    message.payload = payload
+    return message
+
+
+def populate(bridge, count):
+    for i in range(count):
+        service_type, characteristic, payload = CHARACTERISTICS[i % len(CHARACTERISTICS)]
+        bridge.handle_mqtt_message(None, None, message(
+            'Benchmark/accessory-{}/{}/{}'.format(i, service_type, characteristic), payload,
+        ))
+        # And the characteristics HomeKit would set.
+        for characteristic in bridge.get_accessory('accessory-{}'.format(i)).services[1].characteristics:
+            characteristic.setter_callback(characteristic.value)
+
+
+def main():
+    bridge = make_bridge()
+    bridge.config_changed = lambda: None
+    bridge.publish_mqtt_message = lambda topic, payload: None
+    gc.collect()
+    tracemalloc.start(1)
+    before = tracemalloc.take_snapshot()
+    populate(bridge, COUNT)
+    gc.collect()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    stats = after.compare_to(before, 'lineno')
+    total = sum(stat.size_diff for stat in stats)
+    print('{} accessories: {:.1f} KiB, {:.0f} bytes each'.format(COUNT, total / 1024, total / COUNT))
+    for stat in stats[:10]:
+        print('{:>10.1f} KiB  {}'.format(stat.size_diff / 1024, stat.traceback))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+"""
+Time handling a temperature reading on a topic we have seen before, with each payload codec,
+and how many bytes the payload takes.
+
+    $ PYTHONPATH=. python -m benchmarks.payloads
+"""
+import time
+
+from paho.mqtt.client import MQTTMessage
+
+from mqtt2homekit.payloads import get_codec
+
+from .utils import make_bridge
+
+COUNT = 20
+SAMPLES = 20000
+CODECS = ('text', 'struct:<h/100', 'struct:<e', 'cbor', 'msgpack')
+
+
+def message(topic, payload):
+    message = MQTTMessage(topic=topic.encode())
+    message.payload = payload
+    return message
+
+
+def measure(spec):
+    codec = get_codec(spec)
+    bridge = make_bridge(codecs=[('Benchmark/*', spec)], values_interval=0)
+    topics = ['Benchmark/sensor-{}/TemperatureSensor/CurrentTemperature'.format(i) for i in range(COUNT)]
+    for topic in topics:
+        bridge.handle_mqtt_message(None, None, message(topic, codec.encode(20.0)))
+    # Every message changes the value, so each one is sent on to HomeKit.
+    messages = [message(topics[n % COUNT], codec.encode(20 + n % 100 / 4)) for n in range(SAMPLES)]
+    start = time.perf_counter()
+    for msg in messages:
+        bridge.handle_mqtt_message(None, None, msg)
+    return (time.perf_counter() - start) / SAMPLES, len(messages[1].payload)
+
+
+def main():
+    print('{:>14} {:>16} {:>16}'.format('', 'per message (us)', 'bytes'))
+    for spec in CODECS:
+        duration, size = measure(spec)
+        print('{:>14} {:>16.2f} {:>16}'.format(spec, duration * 1e6, size))
+
+
+if __name__ == '__main__':
+    main()
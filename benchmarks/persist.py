@@ -0,0 +1,38 @@
+"""
+Time (and measure the peak memory allocated by) BridgeEncoder.persist, for bridges with
+different numbers of accessories.
+
+    $ PYTHONPATH=. python -m benchmarks.persist
+"""
+import io
+import tracemalloc
+
+from .utils import make_bridge, populate, timeit
+
+
+def main():
+    print('{:>12} {:>12} {:>12} {:>12}'.format('accessories', 'time (ms)', 'peak (KiB)', 'size (KiB)'))
+    for count in (10, 100, 150):
+        bridge = make_bridge()
+        bridge.config_changed = lambda: None
+        populate(bridge, count)
+        for accessory in bridge.accessories.values():
+            # Give each of them an optional characteristic, so there is something to find.
+            accessory.set_characteristic('TemperatureSensor', 0, 'StatusActive', '1')
+        encoder, state = bridge.driver.encoder, bridge.driver.state
+
+        duration = timeit(lambda: encoder.persist(io.StringIO(), state), repeat=50)
+
+        tracemalloc.start()
+        stream = io.StringIO()
+        encoder.persist(stream, state)
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        print('{:>12} {:>12.2f} {:>12.1f} {:>12.1f}'.format(
+            count, duration * 1000, peak / 1024, len(stream.getvalue()) / 1024,
+        ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,384 @@
+"""
+Replay a trace of MQTT messages through a FakeBroker to an MQTTBridge, with a stub HomeKit
+controller that is subscribed to every characteristic (and, optionally, writes to some of
+them), and report how the bridge kept up, as JSON:
+
+    $ PYTHONPATH=. python -m benchmarks.replay --accessories 150 --characteristics 4 --rate 500
+    $ PYTHONPATH=. python -m benchmarks.replay --rate 0 --output results.json
+
+The trace is synthetic (every characteristic of every accessory, changing in turn, at
+--rate messages per second: 0 publishes them as fast as possible), or one recorded from a
+real broker:
+
+    $ PYTHONPATH=. python -m benchmarks.replay --record trace.jsonl --broker mqtt://mqtt.lan --duration 600
+    $ PYTHONPATH=. python -m benchmarks.replay --trace trace.jsonl
+
+A trace has one JSON array per line: [seconds since the start, topic, payload].
+
+Inbound latency is from publishing a message to the broker, to the bridge having handled
+it: outbound latency is from the controller writing a characteristic, to the broker
+receiving the message. Messages that are replaced by a newer one for the same topic before
+they are handled (with --inbound-rate) are counted as coalesced, not handled.
+"""
+import argparse
+import heapq
+import json
+import os
+import resource
+import sys
+import threading
+import time
+from collections import defaultdict, deque
+from urllib.parse import urlparse
+
+from mqtt2homekit.bridge import build_client
+
+from .broker import FakeBroker
+from .utils import SubscribedToEverything, run_until, start_bridge, stop_bridge
+
+# (service type, characteristic, payload for its nth change): each one differs from the last.
+CHARACTERISTICS = (
+    ('Lightbulb', 'On', lambda n: str(n % 2)),
+    ('Lightbulb', 'Brightness', lambda n: str(n % 100 + 1)),
+    ('TemperatureSensor', 'CurrentTemperature', lambda n: '{:.1f}'.format(10 + n % 20)),
+    ('HumiditySensor', 'CurrentRelativeHumidity', lambda n: str(30 + n % 50)),
+    ('ContactSensor', 'ContactSensorState', lambda n: str(n % 2)),
+    ('LightSensor', 'CurrentAmbientLightLevel', lambda n: str(n % 1000 + 1)),
+    ('Lightbulb', 'Hue', lambda n: str(n % 360)),
+    ('Lightbulb', 'Saturation', lambda n: str(n % 100)),
+)
+# The characteristics the controller writes to.
+WRITABLE = (('Lightbulb', 'On'), ('Lightbulb', 'Brightness'))
+
+
+def synthetic_trace(prefix, accessories, characteristics, rate, duration):
+    """
+    Every characteristic of every accessory in turn, until duration seconds at rate messages
+    per second (or, with a rate of 0, duration seconds' worth at 1000 per second).
+    """
+    if not 1 <= characteristics <= len(CHARACTERISTICS):
+        raise ValueError('characteristics should be between 1 and {}'.format(len(CHARACTERISTICS)))
+    topics = [
+        ('{}/device-{}/{}/{}'.format(prefix, i, service_type, characteristic), payload)
+        for i in range(accessories)
+        for service_type, characteristic, payload in CHARACTERISTICS[:characteristics]
+    ]
+    count = int(duration * (rate or 1000))
+    return [
+        (n / rate if rate else 0, topics[n % len(topics)][0], topics[n % len(topics)][1](n // len(topics)))
+        for n in range(count)
+    ]
+
+
+def read_trace(path):
+    with open(path) as fp:
+        return [tuple(json.loads(line)) for line in fp if line.strip()]
+
+
+def write_trace(path, trace):
+    with open(path, 'w') as fp:
+        for entry in trace:
+            fp.write(json.dumps(entry) + '\n')
+
+
+def record(path, broker, prefix, duration):
+    """
+    Record the messages under prefix on a real broker for duration seconds, as a trace.
+    """
+    url = urlparse(broker)
+    trace = []
+    start = time.monotonic()
+    client = build_client()
+    client.on_connect = lambda client, userdata, flags, rc: client.subscribe('{}/#'.format(prefix))
+    client.on_message = lambda client, userdata, message: trace.append(
+        (round(time.monotonic() - start, 6), message.topic, message.payload.decode('ascii', 'replace')),
+    )
+    client.connect(url.hostname, port=url.port or 1883, keepalive=30)
+    client.loop_start()
+    time.sleep(duration)
+    client.loop_stop()
+    client.disconnect()
+    write_trace(path, trace)
+    return len(trace)
+
+
+class Controller:
+    """
+    A stub HomeKit controller: it is subscribed to every characteristic, and writes to
+    characteristics the way the HAP server would, from the driver's loop. It stands in for
+    the driver's HAP server too, so events go through the driver (and any limits on them).
+    """
+    def __init__(self, bridge):
+        self.bridge = bridge
+        self.events = []
+        bridge.driver.topics = SubscribedToEverything()
+        bridge.driver.http_server = self
+        # topic -> deque of (payload we expect the bridge to publish, when we wrote it)
+        self.pending = defaultdict(deque)
+        self.latencies = []
+        self.skipped = 0
+
+    def write(self, accessory_id, service_type, characteristic_name, value):
+        accessory = self.bridge.get_accessory(accessory_id)
+        service = accessory and accessory.get_service(service_type)
+        if not service:
+            # The trace hasn't created it (yet).
+            self.skipped += 1
+            return
+        characteristic = service.get_characteristic(characteristic_name)
+        topic = '{}/{}/{}/{}'.format(self.bridge.prefix, accessory_id, service_type, characteristic_name)
+        self.pending[topic].append((str(int(value)).encode(), time.perf_counter()))
+        self.bridge.driver.set_characteristics({'characteristics': [{
+            'aid': accessory.aid,
+            'iid': accessory.iid_manager.get_iid(characteristic),
+            'value': value,
+        }]}, ('127.0.0.1', 1))
+
+    def push_event(self, data, client_addr, immediate=False):
+        self.events.append(data)
+        return True
+
+    def published(self, message):
+        # Called by the broker for every message: the bridge always publishes retained.
+        pending = self.pending.get(message.topic)
+        if message.retain and pending and pending[0][0] == message.payload:
+            self.latencies.append(message.received - pending.popleft()[1])
+
+    def outstanding(self):
+        return sum(len(pending) for pending in self.pending.values())
+
+
+class Inbound:
+    """
+    Track each message we publish, until the bridge has handled it.
+    """
+    def __init__(self, bridge):
+        # topic -> deque of (payload, when it was published)
+        self.pending = defaultdict(deque)
+        self.latencies = []
+        self.coalesced = 0
+        self.published = 0
+        self.last_handled = None
+        self._lock = threading.Lock()
+        handle_mqtt_message = bridge.handle_mqtt_message
+
+        def handle(client, userdata, message):
+            handle_mqtt_message(client, userdata, message)
+            self.handled(message.topic, message.payload)
+
+        bridge.handle_mqtt_message = handle
+
+    def publish(self, broker, topic, payload):
+        with self._lock:
+            self.pending[topic].append((payload, time.perf_counter()))
+            self.published += 1
+        broker.publish(topic, payload)
+
+    def handled(self, topic, payload):
+        now = time.perf_counter()
+        with self._lock:
+            pending = self.pending.get(topic)
+            if not pending or all(entry[0] != payload for entry in pending):
+                # The broker echoing something the bridge published.
+                return
+            while pending[0][0] != payload:
+                pending.popleft()
+                self.coalesced += 1
+            self.latencies.append(now - pending.popleft()[1])
+            self.last_handled = now
+
+    def outstanding(self):
+        with self._lock:
+            return sum(len(pending) for pending in self.pending.values())
+
+
+def count_calls(obj, name):
+    """
+    Replace obj.name with a wrapper that counts calls to it: return the counts.
+    """
+    calls = [0]
+    func = getattr(obj, name)
+
+    def counted(*args, **kwargs):
+        calls[0] += 1
+        return func(*args, **kwargs)
+
+    setattr(obj, name, counted)
+    return calls
+
+
+def percentiles(latencies):
+    if not latencies:
+        return None
+    latencies = sorted(latencies)
+    return {
+        'p50_ms': latencies[len(latencies) // 2] * 1000,
+        'p99_ms': latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000,
+        'max_ms': latencies[-1] * 1000,
+    }
+
+
+def rss():
+    """
+    The current and peak resident set size of this process, in bytes.
+    """
+    # ru_maxrss is in KiB on Linux (but bytes on macOS).
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+    try:
+        with open('/proc/self/statm') as fp:
+            current = int(fp.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        current = None
+    return current, peak
+
+
+def schedule(trace, writes, duration, accessories):
+    """
+    Merge the trace with the controller's writes (writes per second, to the writable
+    characteristics of the accessories in turn) into one timeline.
+    """
+    inbound = (entry + ('publish',) for entry in trace)
+    count = int(duration * writes)
+    outbound = (
+        (n / writes, 'device-{}'.format(n // len(WRITABLE) % accessories), WRITABLE[n % len(WRITABLE)], n, 'write')
+        for n in range(count)
+    )
+    return heapq.merge(inbound, outbound, key=lambda entry: entry[0])
+
+
+def replay(trace, writes=0, accessories=1, mqtt_loop='thread', timeout=60, **kwargs):
+    """
+    Replay trace (and writes per second from the controller) through a FakeBroker to a new
+    MQTTBridge, built with kwargs: return the results.
+    """
+    duration = trace[-1][0] if trace else 0
+    prefix = trace[0][1].split('/')[0] if trace else 'Benchmark'
+    broker = FakeBroker().start()
+    bridge = start_bridge(broker, mqtt_loop=mqtt_loop, prefix=prefix, **kwargs)
+    loop = bridge.driver.loop
+    config_changed = count_calls(bridge.driver, '_config_changed')
+    persisted = count_calls(bridge.driver, 'persist')
+    controller = Controller(bridge)
+    inbound = Inbound(bridge)
+    broker.listeners.append(controller.published)
+    finished = threading.Event()
+
+    def publisher():
+        start = time.perf_counter()
+        for entry in schedule(trace, writes, duration, accessories):
+            delay = start + entry[0] - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            if entry[-1] == 'publish':
+                inbound.publish(broker, entry[1], entry[2].encode())
+            else:
+                (service_type, characteristic), n = entry[2], entry[3]
+                value = n % 100 + 1 if characteristic == 'Brightness' else n // len(WRITABLE) % 2
+                loop.call_soon_threadsafe(controller.write, entry[1], service_type, characteristic, value)
+        finished.set()
+
+    thread = threading.Thread(target=publisher, name='Replay', daemon=True)
+    start = time.perf_counter()
+    thread.start()
+    try:
+        run_until(
+            bridge,
+            lambda: finished.is_set() and not inbound.outstanding() and not controller.outstanding(),
+            timeout=duration + timeout,
+        )
+        timed_out = False
+    except TimeoutError:
+        timed_out = True
+    elapsed = (inbound.last_handled or time.perf_counter()) - start
+    # As stopping the bridge would.
+    bridge.driver.flush_config_changed()
+    stop_bridge(bridge)
+    broker.stop()
+    handled = len(inbound.latencies)
+    current_rss, peak_rss = rss()
+    return {
+        'inbound': {
+            'published': inbound.published,
+            'handled': handled,
+            'coalesced': inbound.coalesced,
+            'lost': inbound.outstanding(),
+            'throughput': handled / elapsed if elapsed else None,
+            'latency': percentiles(inbound.latencies),
+        },
+        'outbound': {
+            'written': len(controller.latencies) + controller.outstanding(),
+            'published': len(controller.latencies),
+            'skipped': controller.skipped,
+            'latency': percentiles(controller.latencies),
+        },
+        'events': len(controller.events),
+        'events_suppressed': bridge.driver.notifications.suppressed.values if bridge.driver.notifications else {},
+        'accessories': len(bridge.accessories),
+        'config_changed': config_changed[0],
+        'persist': persisted[0],
+        'rss_bytes': current_rss,
+        'max_rss_bytes': peak_rss,
+        'timed_out': timed_out,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--accessories', type=int, default=150)
+    parser.add_argument('--characteristics', type=int, default=4, help='Per accessory')
+    parser.add_argument('--rate', type=float, default=1000, help='Messages per second (0 for as fast as possible)')
+    parser.add_argument('--duration', type=float, default=10, help='Seconds')
+    parser.add_argument('--writes', type=float, default=0, help='Writes per second from the controller')
+    parser.add_argument('--trace', help='Replay this trace, rather than a synthetic one')
+    parser.add_argument('--save-trace', help='Also save the synthetic trace to this file')
+    parser.add_argument('--record', help='Record a trace from --broker to this file, rather than replaying one')
+    parser.add_argument('--broker', default='mqtt://mqtt.lan:1883')
+    parser.add_argument('--prefix', default='Benchmark')
+    parser.add_argument('--mqtt-loop', choices=['thread', 'asyncio'], default='thread')
+    parser.add_argument('--config-delay', type=float, default=2.0)
+    parser.add_argument('--inbound-rate', type=int, default=0)
+    parser.add_argument('--notify-interval', type=float, default=0)
+    parser.add_argument('--notify-rate', type=float, default=0)
+    parser.add_argument('--output', help='Write the results to this file, as well as to stdout')
+    args = parser.parse_args(argv)
+
+    if args.record:
+        print('Recorded {} messages'.format(record(args.record, args.broker, args.prefix, args.duration)))
+        return
+
+    if args.trace:
+        trace = read_trace(args.trace)
+        source = {'trace': args.trace}
+        accessories = len({entry[1].split('/')[1] for entry in trace}) or 1
+    else:
+        trace = synthetic_trace(args.prefix, args.accessories, args.characteristics, args.rate, args.duration)
+        source = {
+            'accessories': args.accessories,
+            'characteristics': args.characteristics,
+            'rate': args.rate,
+            'duration': args.duration,
+        }
+        accessories = args.accessories
+        if args.save_trace:
+            write_trace(args.save_trace, trace)
+
+    results = dict(source, **replay(
+        trace,
+        writes=args.writes,
+        accessories=accessories,
+        mqtt_loop=args.mqtt_loop,
+        config_changed_delay=args.config_delay,
+        inbound_rate=args.inbound_rate,
+        notify_interval=args.notify_interval,
+        notify_rate=args.notify_rate,
+    ))
+    results.update(mqtt_loop=args.mqtt_loop, writes=args.writes, messages=len(trace))
+    output = json.dumps(results, indent=2, sort_keys=True)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as fp:
+            fp.write(output + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+"""
+Measure the time from HomeKit setting a scene (a single write that changes every light on the
+bridge), to the broker receiving all of the messages, at each QoS.
+
+    $ PYTHONPATH=. python -m benchmarks.scene
+"""
+import statistics
+import time
+
+from .broker import FakeBroker
+from .utils import run_until, start_bridge, stop_bridge
+
+LIGHTS = 30
+SCENES = 50
+
+
+def set_scene(bridge, broker, value):
+    """
+    Set every light On (or Off), as HomeKit would: from the event loop. Return the time taken
+    for the broker to receive every message.
+    """
+    count = len(broker.published)
+
+    async def scene():
+        for accessory in bridge.accessories.values():
+            accessory.get_service('Lightbulb').get_characteristic('On').client_update_value(value)
+
+    start = time.perf_counter()
+    bridge.driver.loop.run_until_complete(scene())
+    run_until(bridge, lambda: len(broker.published) >= count + LIGHTS)
+    return broker.published[-1].received - start
+
+
+def measure(broker, qos):
+    bridge = start_bridge(broker, qos=qos, prefix='scene-{}'.format(qos))
+    for i in range(LIGHTS):
+        bridge.get_or_create_accessory('light-{}'.format(i), 'Lightbulb')
+    latencies = [set_scene(bridge, broker, scene % 2 == 0) for scene in range(SCENES)]
+    stop_bridge(bridge)
+    return latencies
+
+
+def main():
+    broker = FakeBroker().start()
+    print('{:>4} {:>12} {:>12}'.format('qos', 'p50 (ms)', 'max (ms)'))
+    for qos in (0, 1, 2):
+        latencies = measure(broker, qos)
+        print('{:>4} {:>12.2f} {:>12.2f}'.format(qos, statistics.median(latencies) * 1000, max(latencies) * 1000))
+    broker.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+"""
+Time building an MQTTBridge from its state file, with and without a snapshot (see
+mqtt2homekit.snapshot), for different numbers of accessories.
+
+    $ PYTHONPATH=. python -m benchmarks.startup
+"""
+import time
+
+from .utils import make_bridge
+
+SERVICES = ('TemperatureSensor', 'Lightbulb', 'Switch', 'HumiditySensor', 'ContactSensor')
+
+
+def build(count, fast_start):
+    bridge = make_bridge(fast_start=fast_start)
+    bridge.config_changed = lambda: None
+    for i in range(count):
+        bridge.get_or_create_accessory('accessory-{}'.format(i), SERVICES[i % len(SERVICES)])
+    for accessory in bridge.accessories.values():
+        # Some optional characteristics, as they would be added by messages.
+        service = accessory.services[1].display_name
+        accessory.set_characteristic(service, 0, 'StatusActive', '1')
+        accessory.set_characteristic(service, 0, 'Name', accessory.accessory_id)
+    bridge.driver.persist()
+    return bridge.persist_file
+
+
+def load(persist_file, fast_start, repeat=20):
+    # The best of repeat: building a bridge creates lots of garbage, so the mean is noisy.
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        bridge = make_bridge(persist_file=persist_file, fast_start=fast_start)
+        duration = time.perf_counter() - start
+        best = duration if best is None else min(best, duration)
+    return best, len(bridge.accessories)
+
+
+def main():
+    print('{:>12} {:>12} {:>16}'.format('accessories', 'json (ms)', 'snapshot (ms)'))
+    for count in (10, 50, 150):
+        json_time, loaded = load(build(count, False), False)
+        snapshot_time, restored = load(build(count, True), True)
+        assert loaded == restored == count
+        print('{:>12} {:>12.2f} {:>16.2f}'.format(count, json_time * 1000, snapshot_time * 1000))
+
+
+if __name__ == '__main__':
+    main()
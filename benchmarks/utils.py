@@ -0,0 +1,95 @@
+import asyncio
+import tempfile
+import threading
+import time
+from unittest import mock
+
+from mqtt2homekit.bridge import MQTTBridge
+
+
+def make_bridge(**kwargs):
+    """
+    Build an MQTTBridge that will not touch the network: mDNS advertisement is disabled,
+    and the state file lives in a temporary directory.
+    """
+    mock.patch('pyhap.accessory_driver.AccessoryDriver.update_advertisement').start()
+    kwargs.setdefault('persist_file', tempfile.mktemp())
+    kwargs.setdefault('mqtt_server', None)
+    kwargs.setdefault('prefix', 'Benchmark')
+    bridge = MQTTBridge('Benchmark Bridge', **kwargs)
+    if not kwargs['mqtt_server']:
+        bridge.client = mock.MagicMock()
+    return bridge
+
+
+def populate(bridge, count, service_type='TemperatureSensor'):
+    for i in range(count):
+        bridge.get_or_create_accessory('accessory-{}'.format(i), service_type)
+    return bridge
+
+
+def timeit(func, repeat=10000):
+    start = time.perf_counter()
+    for i in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat
+
+
+async def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise TimeoutError('Timed out waiting for {}'.format(condition))
+        await asyncio.sleep(0.0005)
+
+
+def run_until(bridge, condition, timeout=5):
+    bridge.driver.loop.run_until_complete(wait_for(condition, timeout))
+
+
+def start_bridge(broker, **kwargs):
+    """
+    Build an MQTTBridge connected to a FakeBroker, and wait until it has subscribed: each
+    bridge should have a different prefix.
+    """
+    kwargs.setdefault('mqtt_server', 'mqtt://127.0.0.1:{}'.format(broker.port))
+    bridge = make_bridge(**kwargs)
+    # Normally created by AccessoryDriver.async_start: the bridge's periodic tasks wait on it.
+    bridge.driver.aio_stop_event = asyncio.Event()
+    bridge.driver.loop.run_until_complete(bridge.run())
+    run_until(bridge, lambda: broker.subscribed(bridge.prefix + '/'))
+    return bridge
+
+
+def stop_bridge(bridge):
+    bridge.driver.aio_stop_event.set()
+    if bridge.mqtt_loop == 'asyncio':
+        bridge.transport.stop()
+    else:
+        bridge.client.disconnect()
+        bridge.client.loop_stop()
+    # Let the bridge's tasks (and the transport's) finish.
+    bridge.driver.loop.run_until_complete(asyncio.sleep(0.01))
+
+
+def record_events(bridge):
+    """
+    Subscribe a pretend HomeKit controller to every characteristic, and record when the
+    driver sends each event (and on which thread).
+    """
+    events = []
+
+    def send_event(topic, data, sender_client_addr, immediate):
+        events.append((time.perf_counter(), threading.current_thread(), topic, data))
+
+    bridge.driver.async_send_event = send_event
+    bridge.driver.topics = SubscribedToEverything()
+    return events
+
+
+class SubscribedToEverything(dict):
+    def __contains__(self, topic):
+        return True
+
+    def get(self, topic, default=None):
+        return {('127.0.0.1', 1)}
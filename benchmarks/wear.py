@@ -0,0 +1,122 @@
+"""
+Measure the bytes the bridge writes (to the state file and values journal, or to the SQLite
+database) during an hour of a realistic trace, played in simulated time: sensors reporting
+every minute, lights and switches changing now and then, values saved every minute, and a
+few configuration changes (an accessory added, and one removed). The values journal is the
+same either way.
+
+Bytes are counted by the kernel (wchar in /proc/self/io), so this only runs on Linux.
+
+    $ PYTHONPATH=. python -m benchmarks.wear
+"""
+import json
+import logging
+import os
+import random
+import tempfile
+from unittest import mock
+
+from paho.mqtt.client import MQTTMessage
+
+from .utils import make_bridge
+
+COUNT = 149
+MINUTES = 60
+# Minutes at which an accessory is added (and removed) during the hour.
+ADDED = (10, 40)
+REMOVED = (25,)
+
+
+def message(topic, payload):
+    message = MQTTMessage(topic=topic.encode())
+    message.payload = payload
+    return message
+
+
+def written():
+    with open('/proc/self/io') as fp:
+        return int(dict(line.split(': ') for line in fp)['wchar'])
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1700000000.0
+
+    def __call__(self):
+        return self.now
+
+
+def trace(minute, rand, everything=False):
+    """
+    The messages sent during a minute.
+    """
+    for i in range(COUNT):
+        kind = i % 4
+        if kind < 2:
+            # Temperature sensors report every minute, changing about half the time.
+            value = 20 + (minute + rand.randrange(2)) // 2 / 10
+            yield 'accessory-{}/TemperatureSensor/CurrentTemperature'.format(i), str(value)
+        elif everything or rand.random() < 0.05:
+            service_type = 'Lightbulb' if kind == 2 else 'Switch'
+            yield 'accessory-{}/{}/On'.format(i, service_type), str(rand.randrange(2))
+
+
+def measure(persist_file):
+    """
+    Bytes written during the hour, and by each time the state was persisted.
+    """
+    clock = Clock()
+    rand = random.Random(1)
+    with mock.patch('time.time', clock):
+        bridge = make_bridge(persist_file=persist_file)
+        for topic, payload in trace(0, rand, everything=True):
+            bridge.handle_mqtt_message(None, None, message('Benchmark/' + topic, payload.encode()))
+        bridge.driver.persist()
+        bridge.values.flush()
+
+        persisted = []
+
+        def persist(persist=bridge.driver.persist):
+            start = written()
+            persist()
+            persisted.append(written() - start)
+
+        bridge.driver.persist = persist
+        start = written()
+        for minute in range(1, MINUTES + 1):
+            clock.now += 60
+            for topic, payload in trace(minute, rand):
+                bridge.handle_mqtt_message(None, None, message('Benchmark/' + topic, payload.encode()))
+            if minute in ADDED:
+                bridge.handle_mqtt_message(None, None, message(
+                    'Benchmark/new-{}/MotionSensor/MotionDetected'.format(minute), b'0',
+                ))
+            if minute in REMOVED:
+                bridge.handle_mqtt_message(None, None, message('Benchmark/accessory-1/TemperatureSensor', b''))
+            bridge.values.flush()
+        bridge.driver.persist()
+        total = written() - start
+        mock.patch.stopall()
+        return total, persisted
+
+
+def main():
+    logging.disable(logging.CRITICAL)
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for name, persist_file in (
+            ('json', os.path.join(directory, 'json.state')),
+            # Not bridge.db, or it would migrate bridge.state.
+            ('sqlite', 'sqlite:///' + os.path.join(directory, 'sqlite.db')),
+        ):
+            size, persisted = measure(persist_file)
+            results[name] = {
+                'bytes_per_hour': size,
+                'state_bytes_per_hour': sum(persisted),
+                'persists': len(persisted),
+            }
+    print(json.dumps({'accessories': COUNT, 'results': results}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
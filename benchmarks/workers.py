@@ -0,0 +1,73 @@
+"""
+Throughput of the supervisor (see mqtt2homekit.supervisor) as the number of worker
+processes grows: publish a burst of messages to a FakeBroker, and time how long the
+workers take to handle all of them, according to their metrics.
+
+There is no HomeKit controller connected, so this does not include the cost of sending
+HAP events. Every worker receives (and skips) the messages for the other shards, and the
+broker is a single Python thread, so neither scales with the workers.
+
+    $ PYTHONPATH=. python -m benchmarks.workers
+"""
+import tempfile
+import time
+
+from mqtt2homekit.supervisor import Supervisor
+
+from .broker import FakeBroker
+from .utils import wait_for
+
+ACCESSORIES = 200
+MESSAGES = 20000
+
+
+def handled(supervisor):
+    total = 0
+    for worker in supervisor.workers:
+        for name, help, type, samples in (worker.health or {}).get('metrics') or []:
+            if name == 'mqtt2homekit_messages_received_total':
+                total += sum(value for sample, value in samples)
+    return total
+
+
+def run(workers):
+    broker = FakeBroker().start()
+    supervisor = Supervisor(
+        'Benchmark Bridge', workers,
+        persist_file=tempfile.mkdtemp() + '/bridge.state',
+        mqtt_server='mqtt://127.0.0.1:{}'.format(broker.port),
+        prefix='Benchmark',
+        mqtt_loop='asyncio',
+        config_changed_delay=2,
+        metrics=True,
+        heartbeat_interval=0.05,
+        log_level='WARNING',
+    )
+    loop = supervisor.loop
+    try:
+        loop.run_until_complete(supervisor.run())
+        loop.run_until_complete(wait_for(
+            lambda: len(broker.connections) == workers
+            and all(connection.subscriptions for connection in list(broker.connections)), timeout=60,
+        ))
+        start = time.perf_counter()
+        for i in range(MESSAGES):
+            broker.publish(
+                'Benchmark/light-{}/Lightbulb/Brightness'.format(i % ACCESSORIES),
+                str(i // ACCESSORIES % 100 + 1).encode(),
+            )
+        loop.run_until_complete(wait_for(lambda: handled(supervisor) >= MESSAGES, timeout=120))
+        return MESSAGES / (time.perf_counter() - start)
+    finally:
+        loop.run_until_complete(supervisor.stop())
+        broker.stop()
+
+
+def main():
+    print('{:>8} {:>16}'.format('workers', 'messages/s'))
+    for workers in (1, 2, 4):
+        print('{:>8} {:>16.0f}'.format(workers, run(workers)))
+
+
+if __name__ == '__main__':
+    main()
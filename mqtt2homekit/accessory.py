@@ -1,8 +1,11 @@
 import logging
+import time
 
 from pyhap import accessory, const
+from pyhap.service import Service
 
-from .loader import loader
+from .loader import COERCE, loader  # noqa: F401
+from .utils import ONE_DAY, ONE_HOUR
 
 LOGGER = logging.getLogger(__name__)
 
@@ -48,44 +51,70 @@ CATEGORIES = {
 }
 
 # These items should trigger a Not Responding state if we haven't seen them
-# recently - that is, they should be pushing data to us frequently.
-FLAG_UNSEEN = (
-    'AirQualitySensor',
-    'CarbonDioxideSensor',
-    'CarbonMonoxideSensor',
-    'HumiditySensor',
-    'LightSensor',  # ? - Or is this boolean?
-    'TemperatureSensor',
-)
-
-COERCE = {
-    'int': int,
-    'float': float,
-    'uint8': int,
-    'uint16': int,
-    'uint32': int,
-    'uint64': int,
-    'bool': lambda value: int(value in [True, 'true', 'True', 1, '1']),
+# recently (in seconds) - that is, they should be pushing data to us frequently.
+UNSEEN_TIMEOUTS = {
+    'AirQualitySensor': ONE_HOUR,
+    'CarbonDioxideSensor': ONE_HOUR,
+    'CarbonMonoxideSensor': ONE_HOUR,
+    'HumiditySensor': ONE_HOUR,
+    'LightSensor': ONE_HOUR,  # ? - Or is this boolean?
+    'TemperatureSensor': ONE_HOUR,
 }
 
+# Accessories we have not seen for this long (in seconds) are removed from the bridge.
+REMOVE_TIMEOUTS = {}
+DEFAULT_REMOVE_TIMEOUT = ONE_DAY * 28
+
+# Changes smaller than these (by service type, then characteristic format) will not be sent to
+# HomeKit: for instance, {'TemperatureSensor': {'float': 0.1}}.
+DEADBANDS = {}
+
+
+def get_coercer(characteristic):
+    return loader.char_type(characteristic.display_name).coerce
+
 
 def clean_value(characteristic, value):
-    if characteristic.properties['Format'] in COERCE:
-        return COERCE[characteristic.properties['Format']](value)
-    return value
+    return get_coercer(characteristic)(value)
+
+
+def get_deadband(service_type, characteristic):
+    return DEADBANDS.get(service_type, {}).get(characteristic.properties['Format'])
+
+
+def has_changed(characteristic, value, deadband=None):
+    current = characteristic.value
+    if value == current:
+        return False
+    if deadband and isinstance(value, (int, float)) and isinstance(current, (int, float)):
+        return abs(value - current) >= deadband
+    return True
 
 
 class Accessory(accessory.Accessory):
     def __init__(self, *args, **kwargs):
-        services = kwargs.pop('services')
+        # Services and characteristics, with their IIDs and values, to restore exactly: see snapshot.py.
+        snapshot = kwargs.pop('snapshot', None)
+        if snapshot:
+            services = [name for name, iid, characteristics in snapshot if name != 'AccessoryInformation']
+        else:
+            services = kwargs.pop('services')
+        self._snapshot = snapshot
+        # The MQTTBridge we have been added to, if any.
+        self.bridge = None
         self.accessory_id = kwargs.pop('accessory_id')
         self.category = CATEGORIES.get(services[0], const.CATEGORY_OTHER)
         self._model = 'MQTT Bridged {}'.format(services[0])
         optional_characteristics = kwargs.pop('optional_characteristics', {})
         super().__init__(*args, **kwargs)
-        self.add_service(*(loader.get_service(service) for service in services))
-        self._should_flag_unseen = services[0] in FLAG_UNSEEN
+        if snapshot:
+            self.restore(snapshot)
+        else:
+            self.add_service(*(loader.get_service(service) for service in services))
+        self._unseen_timeout = UNSEEN_TIMEOUTS.get(services[0])
+        self._remove_timeout = REMOVE_TIMEOUTS.get(services[0], DEFAULT_REMOVE_TIMEOUT)
         self._last_seen = None
+        self._flagged_at = None
         for service, characteristics in optional_characteristics.items():
             for characteristic in characteristics:
                 char = loader.get_char(characteristic)
@@ -94,6 +123,9 @@ class Accessory(accessory.Accessory):
                 self.get_service(service).add_characteristic(char)
 
     def add_info_service(self, **info):
+        if self._snapshot:
+            # It will be restored along with the other services.
+            return
         info_service = loader.get_service('AccessoryInformation')
         info_service.configure_char('Name', value=self.display_name)
         info_service.configure_char('SerialNumber', value=self.accessory_id)
@@ -102,6 +134,24 @@ class Accessory(accessory.Accessory):
         info_service.configure_char('FirmwareRevision', value='1')
         self.add_service(info_service)
 
+    def restore(self, snapshot):
+        iids, objs = self.iid_manager.iids, self.iid_manager.objs
+        for service_name, service_iid, characteristics in snapshot:
+            service = Service(loader.service_type(service_name).type_id, service_name)
+            service.broker = self
+            iids[service] = service_iid
+            objs[service_iid] = service
+            for name, iid, value in characteristics:
+                characteristic = loader.copy_char(name, value)
+                characteristic.broker = self
+                characteristic.service = service
+                service.characteristics.append(characteristic)
+                iids[characteristic] = iid
+                objs[iid] = characteristic
+            self.services.append(service)
+        self.iid_manager.counter = max(objs, default=0)
+        self._snapshot = None
+
     def get_service(self, name, index=0):
         try:
             return self.get_services(name)[index]
@@ -118,7 +168,10 @@ class Accessory(accessory.Accessory):
     def get_service_index(self, service):
         return self.get_services(service.display_name).index(service)
 
-    def set_characteristic(self, service_type, index, characteristic_name, value):
+    def set_characteristic(self, service_type, index, characteristic_name, value, should_notify=True):
+        """
+        Set (and add, if needed) a characteristic: return it if its value changed.
+        """
         service = self.get_service(service_type, index)
         try:
             characteristic = service.get_characteristic(characteristic_name)
@@ -127,17 +180,28 @@ class Accessory(accessory.Accessory):
             self.iid_manager.assign(characteristic)
             characteristic.broker = self
             service.add_characteristic(characteristic)
-            # This is a dynamically added method that sets the setter_callback. If it's missing,
-            # then this Accessory has not been added to a Bridge, and the setter_callback will be
-            # set on this Characteristic when it is added to the Bridge.
-            if hasattr(self, 'add_characteristic'):
-                self.add_characteristic(service, characteristic)
+            # If this Accessory has not been added to a Bridge yet, the setter_callback will be set
+            # on this Characteristic when it is.
+            if self.bridge is not None:
+                self.bridge.add_characteristic(self, service, characteristic)
             self.driver.config_changed()
         value = clean_value(characteristic, value)
-        characteristic.set_value(value)
+        # Only send the value to HomeKit if it has changed (enough).
+        if has_changed(characteristic, value, get_deadband(service_type, characteristic)):
+            characteristic.set_value(value, should_notify=should_notify)
+            if self.bridge is not None:
+                self.bridge.record_history(characteristic)
+            return characteristic
+        return None
+
+    @property
+    def not_responding(self):
+        # We don't clear this when we see the accessory, but compare it to when we last did.
+        return self._flagged_at is not None and self._flagged_at >= (self._last_seen or 0)
 
     def no_response(self):
-        LOGGER.debug('Marking {} as Not Responding'.format(self))
+        LOGGER.debug('Marking %s as Not Responding', self)
+        self._flagged_at = time.time()
         for service in self.services[1:]:
             for characteristic in service.characteristics:
                 characteristic.value = ''
@@ -1,52 +1,226 @@
+import json
 import logging
 import random
 import signal
+import threading
 import time
-from functools import partial
+from collections import deque
 from urllib.parse import urlparse
 
 from paho.mqtt import client as mqtt
+from pyhap import util
 from pyhap.accessory import Bridge
-from pyhap.accessory_driver import AccessoryDriver
-from pyhap.loader import get_loader
 
-from .accessory import Accessory
+from .accessory import Accessory, get_coercer, get_deadband, has_changed
+from .database import database_path, open_database
+from .driver import BridgeDriver
 from .encoder import BridgeEncoder
-from .utils import display_name
+from .expiry import ExpiryQueue
+from .history import HISTORY_INTERVAL, HISTORY_SIZE, History
+from .inbound import InboundQueue
+from .loader import loader
+from .metrics import METRICS_HOST, BridgeMetrics, serve
+from .notifications import BURST, NotificationScheduler
+from .payloads import TEXT, CodecRules
+from .routes import Route
+from .transport import AsyncioTransport
+from .utils import ONE_DAY, ONE_HOUR, ONE_MINUTE, display_name  # noqa: F401
+from .values import ValueStore
 
 LOGGER = logging.getLogger(__name__)
 
-ONE_MINUTE = 60
-ONE_HOUR = ONE_MINUTE * 60
-ONE_DAY = ONE_HOUR * 24
 
+# How often to save the history (which is much bigger than the values), as well as when we stop.
+HISTORY_SAVE_INTERVAL = ONE_HOUR
 
-def build_driver(bridge, port, persist_file):
-    driver = AccessoryDriver(
+# Enough for a scene to change every accessory on a bridge without waiting for acknowledgements.
+MAX_INFLIGHT_MESSAGES = 150
+
+
+def build_driver(bridge, port, persist_file, config_changed_delay=0, loop=None, snapshot_file=None, database=None):
+    driver = BridgeDriver(
         port=port,
         persist_file=persist_file,
-        encoder=BridgeEncoder(bridge)
+        encoder=BridgeEncoder(bridge, snapshot_file),
+        loader=loader,
+        loop=loop,
+        config_changed_delay=config_changed_delay,
+        database=database,
     )
     signal.signal(signal.SIGINT, driver.signal_handler)
     signal.signal(signal.SIGTERM, driver.signal_handler)
     return driver
 
 
+def build_client():
+    client = mqtt.Client(callback_api_version=mqtt.CallbackAPIVersion.VERSION1)
+    client.max_inflight_messages_set(MAX_INFLIGHT_MESSAGES)
+    return client
+
+
+def connect_client(client, mqtt_server, topics, callback, loop, mqtt_loop='thread'):
+    """
+    Connect client to mqtt_server, subscribe to topics (every time it connects), and pass
+    the messages for them to callback.
+
+    Returns the AsyncioTransport driving the client from loop, for the 'asyncio' mqtt_loop:
+    otherwise None.
+    """
+    transport = None
+    if mqtt_loop == 'asyncio':
+        transport = AsyncioTransport(client, loop)
+    client.on_connect = lambda client, userdata, flags, rc: client.subscribe(topics)
+    # We only subscribe to our own topics, so every message is for callback: this saves paho
+    # matching each one against the filters we would have to register with message_callback_add.
+    client.on_message = callback
+    client.connect(mqtt_server.hostname, port=mqtt_server.port or 1883, keepalive=30)
+    if transport:
+        transport.start()
+    else:
+        client.loop_start()
+    return transport
+
+
+def disconnect_client(client, transport):
+    if transport:
+        transport.stop()
+    else:
+        client.loop_stop()
+
+
+def as_payload(value):
+    """
+    The payload a device would have sent value (from a JSON object) in on its own topic.
+    """
+    if type(value) is str:
+        return value
+    if type(value) in (int, float):
+        return str(value)
+    return json.dumps(value)
+
+
+def parse_topic(topic):
+    """
+    Split {prefix}/{accessory_id}/{service_type}[/{index}]/{characteristic} into (accessory_id,
+    service_type, index, characteristic): None if topic does not look like that.
+
+    A topic for a whole service, {prefix}/{accessory_id}/{service_type}[/{index}], has a
+    characteristic of None.
+    """
+    parts = topic.split('/')
+    if len(parts) == 4:
+        if parts[3].isdecimal():
+            return parts[1], parts[2], int(parts[3]), None
+        return parts[1], parts[2], 0, parts[3]
+    if len(parts) == 5 and parts[3].isdecimal():
+        return parts[1], parts[2], int(parts[3]), parts[4]
+    if len(parts) == 3:
+        return parts[1], parts[2], 0, None
+    return None
+
+
+def is_unknown(service_type, characteristic):
+    """
+    Is service_type (or characteristic, if this isn't a topic for a whole service) not a type
+    we know?
+    """
+    return service_type not in loader.serv_types or (
+        characteristic is not None and characteristic not in loader.char_types
+    )
+
+
 class MQTTBridge(Bridge):
     def __init__(self, display_name, **kwargs):
         self.persist_file = kwargs.pop('persist_file')
+        # With a --persist of sqlite:///<path>, everything is kept in a database there instead: the
+        # snapshot (and so on) still go next to it.
+        self.database = None
+        path = database_path(self.persist_file)
+        if path:
+            self.persist_file = path
+            self.database = open_database(path)
         self.mqtt_server = urlparse(kwargs.pop('mqtt_server'))
-        self.port = random.randint(50000, 60000)
+        self.port = kwargs.pop('port', None) or random.randint(50000, 60000)
         self.prefix = kwargs.pop('prefix', 'HomeKit')
-        driver = build_driver(self, self.port, self.persist_file)
+        config_changed_delay = kwargs.pop('config_changed_delay', 0)
+        # 'thread' uses paho's loop_start(), 'asyncio' handles messages on the driver's event loop.
+        self.mqtt_loop = kwargs.pop('mqtt_loop', 'thread')
+        # Messages per second to handle: if set, messages are queued, and the latest value for
+        # each topic wins.
+        inbound_rate = kwargs.pop('inbound_rate', 0)
+        inbound_queue_size = kwargs.pop('inbound_queue_size', 1000)
+        self.qos = kwargs.pop('qos', 2)
+        self.metrics_port = kwargs.pop('metrics_port', None)
+        self.metrics_host = kwargs.pop('metrics_host', METRICS_HOST)
+        self.metrics_server = None
+        enable_metrics = kwargs.pop('metrics', self.metrics_port is not None)
+        # Several bridges may share one MQTT client (and event loop): see shards.ShardedBridges.
+        self.client = kwargs.pop('client', None)
+        self._shared_client = self.client is not None
+        loop = kwargs.pop('loop', None)
+        # Keep a snapshot of the accessories next to the state file, which is quicker to load.
+        snapshot_file = '{}.snapshot'.format(self.persist_file) if kwargs.pop('fast_start', False) else None
+        # How often to write the last value of each characteristic (0 to not keep them at all); and
+        # whether to ignore retained messages that would just set the value we already restored.
+        self.values_interval = kwargs.pop('values_interval', ONE_MINUTE)
+        self.skip_retained = kwargs.pop('skip_retained', False)
+        # Ignore topics for service types (or characteristics) we don't know, rather than trying (and
+        # failing, noisily) to create accessories for them.
+        self.ignore_unknown = kwargs.pop('ignore_unknown', False)
+        # Also accept a JSON object of characteristic values for a whole service.
+        self.bulk = kwargs.pop('bulk', False)
+        # How the payloads of each topic are encoded: text, unless one of these rules says otherwise.
+        self.codecs = CodecRules(kwargs.pop('codecs', ()))
+        # Limits on the HAP events we send: see notifications.NotificationScheduler.
+        notify_interval = kwargs.pop('notify_interval', 0)
+        notify_rate = kwargs.pop('notify_rate', 0)
+        notify_burst = kwargs.pop('notify_burst', BURST)
+        self.values = None
+        # The characteristics (by name) to keep the recent history of: see history.History. This
+        # needs to be loaded before the accessories are, so their routes get their history.
+        self.history = None
+        history = kwargs.pop('history', ())
+        history_size = kwargs.pop('history_size', HISTORY_SIZE)
+        history_interval = kwargs.pop('history_interval', HISTORY_INTERVAL)
+        if history:
+            self.history = History('{}.history'.format(self.persist_file), history, history_size, history_interval)
+            self.history.load()
+        self._outbound = deque()
+        self._outbound_scheduled = False
+        # accessory_id -> Accessory: this must be kept in sync with self.accessories (which is keyed
+        # by aid), and is what we use to find accessories when handling MQTT messages.
+        self._accessory_index = {}
+        # topic -> Route (the setter_callback of the characteristic it sets): any time we change the services or
+        # characteristics of an accessory, we need to drop its routes.
+        self._routes = {}
+        # (accessory_id, 'unseen' or 'remove'), by when we next need to check on them.
+        self._expiry = ExpiryQueue()
+        driver = build_driver(
+            self, self.port, self.persist_file, config_changed_delay, loop, snapshot_file, self.database,
+        )
         # This sets self.driver
         super().__init__(driver, display_name, **kwargs)
         driver.add_accessory(accessory=self)
-        # if Path(self.persist_file).exists():
-        #     driver.load()
+        if notify_interval or notify_rate:
+            driver.notifications = NotificationScheduler(driver, notify_interval, notify_rate, notify_burst)
+        self.inbound = None
+        if inbound_rate:
+            self.inbound = InboundQueue(
+                lambda message: self.handle_mqtt_message(self.client, None, message),
+                driver.loop,
+                rate=inbound_rate,
+                maxsize=inbound_queue_size,
+            )
+        # Metrics cost (almost) nothing unless they are enabled: serving them enables them.
+        self.metrics = None
+        if enable_metrics:
+            self.metrics = driver.metrics = BridgeMetrics(self)
+        if self.values_interval:
+            self.values = ValueStore('{}.values'.format(self.persist_file))
+            self.restore_values()
 
     def add_info_service(self):
-        info_service = get_loader().get_service("AccessoryInformation")
+        info_service = loader.get_service("AccessoryInformation")
         info_service.configure_char("Name", value='MQTT Bridge')
         info_service.configure_char("Manufacturer", value="Matthew Schinckel")
         info_service.configure_char("Model", value="Bridge")
@@ -59,23 +233,47 @@ class MQTTBridge(Bridge):
         # This will allow us to push onto the MQTT when we get notified by HomeKit that
         # something needs to change.
         super().add_accessory(accessory)
-
-        def add_characteristic(service, characteristic):
-            LOGGER.debug('Set setter_callback for {accessory}: {service}.{characteristic}'.format(
-                accessory=accessory,
-                service=service,
-                characteristic=characteristic,
-            ))
-            characteristic.setter_callback = partial(self.send_mqtt_message, accessory, service, characteristic)
-
-        accessory.add_characteristic = add_characteristic
+        accessory.bridge = self
+        self._accessory_index[accessory.accessory_id] = accessory
+        self._invalidate_routes(accessory)
+        self._schedule_expiry(accessory, time.time())
 
         for service in accessory.services:
             if service.display_name == 'AccessoryInformation':
                 continue
 
             for characteristic in service.characteristics:
-                accessory.add_characteristic(service, characteristic)
+                self._bind_characteristic(accessory, service, characteristic)
+
+    def _bind_characteristic(self, accessory, service, characteristic):
+        # The reprs of services and characteristics are expensive: only build them if we will log them.
+        if LOGGER.isEnabledFor(logging.DEBUG):
+            LOGGER.debug('Set setter_callback for %s: %s.%s', accessory, service, characteristic)
+        index = None
+        if len(accessory.get_services(service.display_name)) > 1:
+            index = accessory.get_service_index(service)
+        topic = self._get_topic_for_message(accessory, service, index, characteristic)
+        history = None
+        if self.history and self.history.tracks(characteristic):
+            history = self.history.buffer(topic)
+        characteristic.setter_callback = Route(
+            self,
+            accessory,
+            service,
+            characteristic,
+            topic,
+            get_coercer(characteristic),
+            get_deadband(service.display_name, characteristic),
+            self.codecs.select(topic),
+            history,
+        )
+
+    def add_characteristic(self, accessory, service, characteristic):
+        """
+        Called by accessory when it adds characteristic to service (after it was added to us).
+        """
+        self._bind_characteristic(accessory, service, characteristic)
+        self._invalidate_routes(accessory)
 
     def config_changed(self):
         self.driver.config_changed()
@@ -98,9 +296,9 @@ class MQTTBridge(Bridge):
             if not accessory.get_service(service_type, index):
                 # We need to add the service, but remove the accessory and then re-add it.
                 # Otherwise, HomeKit will get all screwed up, and the bridge won't work anymore.
-                self.accessories.pop(accessory.aid)
+                self._pop_accessory(accessory)
                 accessory.aid = None
-                accessory.add_service(get_loader().get_service(service_type))
+                accessory.add_service(loader.get_service(service_type))
                 self.add_accessory(accessory)
                 self.config_changed()
         else:
@@ -120,159 +318,398 @@ class MQTTBridge(Bridge):
             )
 
     def get_accessory(self, accessory_id):
-        for accessory in self.accessories.values():
-            if accessory.accessory_id == accessory_id:
-                return accessory
+        return self._accessory_index.get(accessory_id)
 
     def remove_accessory(self, accessory_id):
-        for aid, accessory in self.accessories.items():
-            if accessory_id == accessory.accessory_id:
-                break
-        else:
+        accessory = self.get_accessory(accessory_id)
+        if not accessory:
             return
 
-        self.accessories.pop(aid)
+        self._pop_accessory(accessory)
+        self._forget(accessory)
         self.config_changed()
 
+    def _forget(self, accessory):
+        # An accessory's values and history are kept when it is popped to add a service: only
+        # once it is removed are they forgotten.
+        topic = '{}/{}'.format(self.prefix, accessory.accessory_id)
+        if self.values:
+            self.values.forget(topic)
+        if self.history:
+            self.history.forget(topic)
+
+    def _pop_accessory(self, accessory):
+        self.accessories.pop(accessory.aid)
+        self._accessory_index.pop(accessory.accessory_id, None)
+        self._invalidate_routes(accessory)
+        # If it comes back (or is added again, with another service), it is scheduled afresh.
+        self._expiry.discard((accessory.accessory_id, 'unseen'))
+        self._expiry.discard((accessory.accessory_id, 'remove'))
+
+    def restore_values(self):
+        """
+        Give characteristics the last values we had for them (and route their topics): we
+        forget about any that no longer exist.
+        """
+        for topic, payload in list(self.values.load().items()):
+            parsed = parse_topic(topic)
+            try:
+                accessory_id, service_type, index, characteristic = parsed
+                accessory = self._accessory_index[accessory_id]
+                route = self._add_route(topic, accessory, service_type, index, characteristic)
+                route.characteristic.value = route.coerce(payload)
+            except (AttributeError, KeyError, TypeError, ValueError):
+                self.values.forget(topic)
+
+    def _add_route(self, topic, accessory, service_type, index, characteristic_name):
+        characteristic = accessory.get_service(service_type, index).get_characteristic(characteristic_name)
+        route = self._routes[topic] = characteristic.setter_callback
+        # The topic we publish to may not be the one messages come in on (which may have an index
+        # of 0, say): the codec is the one for the topic the device uses.
+        route.codec = self.codecs.select(topic)
+        return route
+
+    def _codec(self, topic):
+        route = self._routes.get(topic)
+        if route:
+            return route.codec
+        return self.codecs.select(topic)
+
+    def _invalidate_routes(self, accessory):
+        # We replace the dict rather than mutating it, so a message being handled concurrently
+        # never sees it change size under it.
+        self._routes = {
+            topic: route
+            for topic, route in self._routes.items()
+            if route.accessory is not accessory
+        }
+
     def topics(self):
-        return [ ('{}/+/+/+'.format(self.prefix), 1), ('{}/+/+/+/+'.format(self.prefix), 1) ]
+        topics = [ ('{}/+/+/+'.format(self.prefix), 1), ('{}/+/+/+/+'.format(self.prefix), 1) ]
+        if self.bulk:
+            topics.append(('{}/+/+'.format(self.prefix), 1))
+        return topics
 
     async def run(self):
         """
         Create, and start, a driver for this accessory.
         """
-        self.client = mqtt.Client(callback_api_version=mqtt.CallbackAPIVersion.VERSION1)
-        self.client.on_connect = lambda client, userdata, flags, rc: client.subscribe(self.topics())
-        for topic, qos in self.topics():
-            self.client.message_callback_add(topic, self.handle_mqtt_message)
-        try:
-            self.client.connect(self.mqtt_server.hostname, port=self.mqtt_server.port or 1883, keepalive=30)
-        except ConnectionRefusedError:
-            LOGGER.critical('Unable to connect to MQTT Broker')
-            return
-        self.client.loop_start()
+        if not self._shared_client:
+            self.client = build_client()
+            try:
+                self.transport = connect_client(
+                    self.client, self.mqtt_server, self.topics(), self.receive_mqtt_message, self.driver.loop,
+                    self.mqtt_loop,
+                )
+            except ConnectionRefusedError:
+                LOGGER.critical('Unable to connect to MQTT Broker')
+                return
+        self.driver.async_add_job(self.check_missing)
+        if self.values:
+            self.driver.async_add_job(self.flush_values)
+        if self.history:
+            self.driver.async_add_job(self.save_history)
+        if self.metrics_port is not None:
+            self.metrics_server = await serve(self.metrics, self.metrics_port, self.metrics_host)
         await super().run()
 
     async def stop(self):
         await super().stop()
-        self.client.loop_stop()
+        if not self._shared_client:
+            disconnect_client(self.client, self.transport)
+        if self.metrics_server:
+            self.metrics_server.close()
+            await self.metrics_server.wait_closed()
         # Make sure we write our current data.
+        self.driver.flush_config_changed()
         self.driver.persist()
+        if self.values:
+            self.values.flush()
+        if self.history:
+            self.history.save()
+        if self.database:
+            self.database.close()
+
+    async def flush_values(self):
+        while not await util.event_wait(self.driver.aio_stop_event, self.values_interval):
+            self.values.flush()
+
+    async def save_history(self):
+        while not await util.event_wait(self.driver.aio_stop_event, HISTORY_SAVE_INTERVAL):
+            await self.driver.async_add_job(self.history.save)
 
     @Accessory.run_at_interval(ONE_MINUTE)
     def check_missing(self):
-        self.flag_unseen()
-        self.remove_missing()
+        self.expire()
 
-    def flag_unseen(self):
-        """
-        Any that we haven't seen in the past hour we want to show in HomeKit as "not connected".
+    def _schedule_expiry(self, accessory, now):
+        base = accessory._last_seen or now
+        if accessory._unseen_timeout:
+            self._expiry.schedule(base + accessory._unseen_timeout, (accessory.accessory_id, 'unseen'))
+        self._expiry.schedule(base + accessory._remove_timeout, (accessory.accessory_id, 'remove'))
 
-        This should only be those that were done with QoS=0?
+    def expire(self, now=None):
         """
-        now = time.time()
-        for acc in list(self.accessories.values()):
-            if acc._last_seen and now - acc._last_seen > ONE_HOUR:
-                # Set all characteristics we have ever known about to None.
-                LOGGER.info("Look like {accessory_id} has no data for {interval} seconds".format(
-                    accessory_id=acc.accessory_id,
-                    interval=now - acc._last_seen,
-                ))
-                if acc._should_flag_unseen:
-                    acc.no_response()
+        Any that we haven't seen recently (an hour, for sensors) we want to show in HomeKit as
+        "not connected": and any that we have not seen in 28 days, we want to remove.
 
-    def remove_missing(self):
-        """
-        Any that we have not seen in 28 days, we want to remove.
+        We only look at accessories whose deadline has passed: if we have seen them since
+        it was set, they are scheduled again from when we last saw them.
         """
-        now = time.time()
+        now = now or time.time()
         changed = False
-        for acc in list(self.accessories.values()):
-            if acc._last_seen and now - acc._last_seen > ONE_DAY * 28:
-                self.accessories.pop(acc.aid)
+        for accessory_id, action in list(self._expiry.expired(now)):
+            acc = self.get_accessory(accessory_id)
+            if not acc or (action == 'unseen' and not acc._unseen_timeout):
+                continue
+            timeout = acc._unseen_timeout if action == 'unseen' else acc._remove_timeout
+            if acc._last_seen is None or now - acc._last_seen <= timeout:
+                self._schedule_expiry(acc, now)
+            elif action == 'remove':
+                self._pop_accessory(acc)
+                self._forget(acc)
                 changed = True
+            else:
+                if not acc.not_responding:
+                    LOGGER.info('Look like %s has no data for %s seconds', acc.accessory_id, now - acc._last_seen)
+                    acc.no_response()
+                # Check again later, in case we see it and then lose it again.
+                self._expiry.schedule(now + acc._unseen_timeout, (acc.accessory_id, 'unseen'))
         if changed:
             self.config_changed()
 
+    def receive_mqtt_message(self, client, userdata, message):
+        if self.skip_retained and message.retain and self.values:
+            restored = self.values.payloads.get(message.topic)
+            # We keep the values as text: a binary payload is never the same as that.
+            if restored is not None and restored.encode() == message.payload and self._codec(message.topic) is TEXT:
+                return
+        if self.inbound:
+            self.inbound.put(message)
+        else:
+            self.handle_mqtt_message(client, userdata, message)
+
     def handle_mqtt_message(self, client, userdata, message):
-        try:
-            _prefix, accessory_id, service_type, characteristic = message.topic.split('/')
-            index = 0
-        except ValueError:
-            _prefix, accessory_id, service_type, index, characteristic = message.topic.split('/')
-            index = int(index)
+        if not self.metrics:
+            self._handle_mqtt_message(message)
+            return
+
+        start = time.perf_counter()
+        service_type = self._handle_mqtt_message(message)
+        self.metrics.handle_seconds.observe(time.perf_counter() - start)
+        if service_type is None:
+            self.metrics.messages_ignored.inc()
+        else:
+            self.metrics.messages_in.inc(service_type)
+
+    def _handle_mqtt_message(self, message):
+        # Fast path: we have seen this topic before, so we already know which characteristic
+        # it refers to, and how to coerce the value.
+        topic = message.topic
+        route = self._routes.get(topic)
+        if route and message.payload:
+            route.accessory._last_seen = time.time()
+            if self.metrics:
+                self.metrics.routes.inc('hit')
+            try:
+                decoded = route.codec.decode(message.payload)
+                value = route.coerce(decoded)
+                characteristic = route.characteristic
+                if has_changed(characteristic, value, route.deadband):
+                    characteristic.set_value(value)
+                    if route.history is not None:
+                        self.history.record(route.history, value)
+                    if self.values:
+                        self.values.changed(topic, as_payload(decoded))
+            except Exception as exc:
+                LOGGER.error('Exception handling message %s: %s', exc.__class__.__name__, exc.args)
+            return route.service.display_name
+
+        if self.metrics:
+            self.metrics.routes.inc('miss')
+
+        parsed = parse_topic(topic)
+        if parsed is None:
+            LOGGER.debug('Ignoring %s: not a characteristic topic', topic)
+            return None
+        accessory_id, service_type, index, characteristic = parsed
+        if self.ignore_unknown and is_unknown(service_type, characteristic):
+            LOGGER.debug('Ignoring %s: unknown service or characteristic', topic)
+            return None
+        if characteristic is None:
+            if self.bulk:
+                return self._handle_bulk_message(topic, accessory_id, service_type, index, message.payload)
+            LOGGER.debug('Ignoring %s: not a characteristic topic', topic)
+            return None
 
         if service_type == 'AccessoryInformation':
-            return
+            return service_type
 
         if not message.payload:
             # Should we only do this if it's the only service?
             # Otherwise we should remove the service, maybe?
-            LOGGER.info('REMOVE {accessory_id}: {service_type}.{characteristic}'.format(
-                accessory_id=accessory_id,
-                service_type=service_type,
-                characteristic=characteristic,
-            ))
-            return self.remove_accessory(accessory_id)
+            LOGGER.info('REMOVE %s: %s.%s', accessory_id, service_type, characteristic)
+            self.remove_accessory(accessory_id)
+            return service_type
         try:
             accessory = self.get_or_create_accessory(accessory_id, service_type, index)
             accessory._last_seen = time.time()
-            value = message.payload.decode('ascii')
-            LOGGER.debug('SET {accessory_id}: {service_type}[{index}].{characteristic} -> {value}'.format(
-                accessory_id=accessory_id,
-                service_type=service_type,
-                index=index,
-                characteristic=characteristic,
-                value=value,
-            ))
+            value = self.codecs.select(topic).decode(message.payload)
+            LOGGER.debug('SET %s: %s[%s].%s -> %s', accessory_id, service_type, index, characteristic, value)
             # If we have an empty message, then perhaps we need to do nothing...?
             accessory.set_characteristic(service_type, index, characteristic, value)
+            self._add_route(topic, accessory, service_type, index, characteristic)
+            if self.values:
+                self.values.changed(topic, as_payload(value))
+        except Exception as exc:
+            LOGGER.error('Exception handling message %s: %s', exc.__class__.__name__, exc.args)
+        return service_type
+
+    def _handle_bulk_message(self, topic, accessory_id, service_type, index, payload):
+        """
+        Set the characteristics of one service from a JSON object of their values, and then
+        send HomeKit the ones that changed, together.
+
+        Each characteristic is routed (and its value kept) as if it had its own topic.
+        """
+        if service_type == 'AccessoryInformation':
+            return service_type
+
+        if not payload:
+            LOGGER.info('REMOVE %s: %s', accessory_id, service_type)
+            self.remove_accessory(accessory_id)
+            return service_type
+        try:
+            values = json.loads(payload)
+            if not isinstance(values, dict):
+                raise ValueError('Expected a JSON object, not {}'.format(type(values).__name__))
+            accessory = self.get_or_create_accessory(accessory_id, service_type, index)
         except Exception as exc:
-            LOGGER.error('Exception handling message {}: {}'.format(exc.__class__.__name__, exc.args))
+            LOGGER.error('Exception handling message %s: %s', exc.__class__.__name__, exc.args)
+            return service_type
+        accessory._last_seen = time.time()
+
+        changed = []
+        topic += '/'
+        for name, value in values.items():
+            if self.ignore_unknown and name not in loader.char_types:
+                continue
+            characteristic_topic = topic + name
+            try:
+                route = self._routes.get(characteristic_topic)
+                if route:
+                    characteristic = route.characteristic
+                    coerced = route.coerce(value)
+                    if not has_changed(characteristic, coerced, route.deadband):
+                        continue
+                    characteristic.set_value(coerced, should_notify=False)
+                    if route.history is not None:
+                        self.history.record(route.history, coerced)
+                else:
+                    LOGGER.debug('SET %s: %s[%s].%s -> %s', accessory_id, service_type, index, name, value)
+                    characteristic = accessory.set_characteristic(
+                        service_type, index, name, value, should_notify=False,
+                    )
+                    self._add_route(characteristic_topic, accessory, service_type, index, name)
+                    if not characteristic:
+                        continue
+                changed.append(characteristic)
+                if self.values:
+                    self.values.changed(characteristic_topic, as_payload(value))
+            except Exception as exc:
+                LOGGER.error('Exception handling message %s: %s', exc.__class__.__name__, exc.args)
+        if changed:
+            self.notify(changed)
+        return service_type
+
+    def record_history(self, characteristic):
+        """
+        Record the value of characteristic in its history, if we keep one.
+        """
+        history = getattr(characteristic.setter_callback, 'history', None)
+        if history is not None:
+            self.history.record(history, characteristic.value)
+
+    def notify(self, characteristics):
+        """
+        Send HomeKit the values of characteristics, all at once: pyhap sends events that are
+        queued together to each controller in a single message.
+        """
+        if threading.current_thread() is self.driver.tid or not self.driver.loop.is_running():
+            for characteristic in characteristics:
+                characteristic.notify()
+        else:
+            self.driver.loop.call_soon_threadsafe(self.notify, characteristics)
 
-    def send_mqtt_message(self, accessory, service, characteristic, value):
-        # We always send messages with QoS 2 - this means clients may choose how they want
+    def send_mqtt_message(self, accessory, service, characteristic, value, topic=None):
+        if not self.metrics:
+            self._send_mqtt_message(accessory, service, characteristic, value, topic)
+            return
+
+        start = time.perf_counter()
+        self._send_mqtt_message(accessory, service, characteristic, value, topic)
+        self.metrics.send_seconds.observe(time.perf_counter() - start)
+        self.metrics.messages_out.inc(getattr(service, 'display_name', service))
+
+    def _send_mqtt_message(self, accessory, service, characteristic, value, topic):
+        # We send messages with QoS 2 by default - this means clients may choose how they want
         # to subscribe.
         # We also assume that data being pushed from HomeKit should "persist" (retain=True),
         # because the user has set a state. Devices that can be controlled out of band of
         # HomeKit should also set retain=True on their messages.
         if service == 'AccessoryInformation':
             LOGGER.info(
-                'Received AccessoryInformation message: {accessory}: {service}.{characteristic} -> {value}'.format(
-                    accessory=accessory,
-                    service=service,
-                    characteristic=characteristic,
-                    value=value,
-                )
+                'Received AccessoryInformation message: %s: %s.%s -> %s', accessory, service, characteristic, value,
             )
             return
 
         if characteristic.display_name == 'Identify':
-            LOGGER.info('Identify: {accessory_id}'.format(accessory_id=accessory))
+            LOGGER.info('Identify: %s', accessory)
             return
 
-        index = None
-        if len(accessory.get_services(service.display_name)) > 1:
-            index = accessory.get_service_index(service)
-
         try:
             characteristic.set_value(value)
-            topic = self._get_topic_for_message(accessory, service, index, characteristic)
+            self.record_history(characteristic)
+            if topic is None:
+                index = None
+                if len(accessory.get_services(service.display_name)) > 1:
+                    index = accessory.get_service_index(service)
+                topic = self._get_topic_for_message(accessory, service, index, characteristic)
             LOGGER.debug(topic)
 
             if value in (True, False):
                 value = int(value)
 
-            payload = self._get_payload_for_message(topic, value)
-
-            self.client.publish(
-                topic,
-                payload,
-                qos=2,
-                retain=True,
-            )
+            codec = getattr(characteristic.setter_callback, 'codec', None)
+            payload = self._get_payload_for_message(topic, value, codec)
+            self.publish_mqtt_message(topic, payload)
+            if self.values:
+                # When the broker echoes it back to us (it is retained), this is the value we will see.
+                self.values.changed(topic, str(value))
         except Exception as exc:
-            LOGGER.error('Exception sending message: {}'.format(exc.args))
+            LOGGER.error('Exception sending message: %s', exc.args)
+
+    def publish_mqtt_message(self, topic, payload):
+        """
+        Publish a message to the broker, retained.
+
+        When HomeKit sets a scene, we get a call for each characteristic: while the event loop
+        is running, we queue them up, and publish them all together once HomeKit has finished.
+        """
+        if not self.driver.loop.is_running():
+            self.client.publish(topic, payload, qos=self.qos, retain=True)
+            return
+
+        self._outbound.append((topic, payload))
+        if not self._outbound_scheduled:
+            self._outbound_scheduled = True
+            self.driver.loop.call_soon_threadsafe(self._flush_outbound)
+
+    def _flush_outbound(self):
+        self._outbound_scheduled = False
+        while self._outbound:
+            topic, payload = self._outbound.popleft()
+            self.client.publish(topic, payload, qos=self.qos, retain=True)
 
     def _get_topic_for_message(self, accessory, service, index, characteristic):
         service_topic_name = service.display_name
@@ -286,5 +723,8 @@ class MQTTBridge(Bridge):
             characteristic=characteristic.display_name,
         )
 
-    def _get_payload_for_message(self, topic, value):
-        return str(value).encode()
+    def _get_payload_for_message(self, topic, value, codec=None):
+        """
+        Encode value for topic, with codec: the one its rules choose, if that isn't given.
+        """
+        return (codec or self.codecs.select(topic)).encode(value)
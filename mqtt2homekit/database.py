@@ -0,0 +1,221 @@
+"""
+The bridge's state in SQLite, instead of the JSON state file.
+
+pyhap's state (keys, pairings, config version) is one row per key, and each accessory (with
+its services and optional characteristics) is one row, with when we last saw it in a narrow
+table of its own, as that is what changes most. Persisting writes just the rows that have
+changed since we last wrote them, rather than the whole file: the database is in WAL mode, so
+each write appends the pages it changed to the log, and SQLite only copies them back into
+the database every so often.
+
+The last values of characteristics are still kept in the values journal (see values.py),
+next to the database, as appending to that is already about as little as we can write.
+
+    --persist sqlite:///bridge.db         # relative to the current directory
+    --persist sqlite:////var/lib/bridge.db
+"""
+import json
+import logging
+import os
+import shutil
+import threading
+
+LOGGER = logging.getLogger(__name__)
+
+SCHEME = 'sqlite:///'
+
+# last_seen is only used to tell whether an accessory is Not Responding (after an hour or
+# so), or should be removed (after days): we don't rewrite an accessory just to move it on
+# by less than this many seconds.
+LAST_SEEN_RESOLUTION = 300
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS state (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS accessories (
+    accessory_id TEXT PRIMARY KEY,
+    aid INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    services TEXT NOT NULL,
+    optional_characteristics TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS last_seen (
+    accessory_id TEXT PRIMARY KEY,
+    last_seen REAL
+);
+"""
+
+
+def database_path(persist):
+    """
+    The path of the database for a --persist of sqlite:///<path>: None for a state file.
+    """
+    if persist.startswith(SCHEME):
+        return persist[len(SCHEME):]
+    return None
+
+
+def dumps(value):
+    return json.dumps(value, separators=(',', ':'), sort_keys=True)
+
+
+def row_size(row):
+    return sum(len(column) if isinstance(column, str) else 8 for column in row)
+
+
+class Database:
+    """
+    One bridge's database.
+
+    We remember what is in each row we have read or written, so that save() can skip the
+    ones that are the same. The driver persists from its executor (and from the event loop),
+    so every use of the connection holds the lock.
+    """
+    def __init__(self, path):
+        # Only bridges with a database need sqlite3, so we don't import it until then.
+        import sqlite3
+
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        # Each write appends every page it changes to the log: our rows are small, so smaller
+        # pages mean writing less. (This only applies to a new database.)
+        self._connection.execute('PRAGMA page_size=1024')
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        # In WAL mode, this only syncs when checkpointing: a power cut may lose the last
+        # transactions, but never corrupts the database.
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.executescript(SCHEMA)
+        self._state = {}
+        self._accessories = {}
+        self._last_seen = {}
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    def load_state(self):
+        """
+        pyhap's state (and our snapshot token), as a dict like the JSON state file.
+        """
+        with self._lock:
+            rows = self._connection.execute('SELECT key, value FROM state').fetchall()
+        self._state = dict(rows)
+        return {key: json.loads(value) for key, value in rows}
+
+    def load_accessories(self):
+        """
+        Each accessory, as a dict like BridgeEncoder.encode_accessory(), in aid order.
+        """
+        with self._lock:
+            rows = self._connection.execute(
+                'SELECT accessory_id, aid, name, services, optional_characteristics '
+                'FROM accessories ORDER BY aid'
+            ).fetchall()
+            self._last_seen = dict(self._connection.execute('SELECT accessory_id, last_seen FROM last_seen'))
+        self._accessories = {row[0]: row for row in rows}
+        return [
+            {
+                'accessory_id': accessory_id,
+                'aid': aid,
+                'name': name,
+                'services': json.loads(services),
+                'optional_characteristics': json.loads(optional_characteristics),
+                'last_seen': self._last_seen.get(accessory_id),
+            }
+            for accessory_id, aid, name, services, optional_characteristics in rows
+        ]
+
+    def save(self, state, accessories):
+        """
+        Write the keys of state, and the accessories (as encoded by BridgeEncoder), that have
+        changed, in one transaction: accessories that aren't in the list are deleted.
+
+        Returns the number of bytes of row data written.
+        """
+        state_rows = [(key, dumps(value)) for key, value in state.items()]
+        state_rows = [row for row in state_rows if self._state.get(row[0]) != row[1]]
+        accessory_rows = [
+            (
+                accessory['accessory_id'],
+                accessory['aid'],
+                accessory['name'],
+                dumps(accessory['services']),
+                dumps(accessory['optional_characteristics']),
+            )
+            for accessory in accessories
+        ]
+        removed = set(self._accessories) - {row[0] for row in accessory_rows}
+        accessory_rows = [row for row in accessory_rows if self._accessories.get(row[0]) != row]
+        last_seen_rows = [
+            (accessory['accessory_id'], accessory['last_seen'])
+            for accessory in accessories
+            if self._has_been_seen(accessory['accessory_id'], accessory['last_seen'])
+        ]
+        if not (state_rows or accessory_rows or last_seen_rows or removed):
+            return 0
+        removed_rows = [(accessory_id,) for accessory_id in removed]
+        with self._lock:
+            with self._transaction():
+                self._connection.executemany('REPLACE INTO state (key, value) VALUES (?, ?)', state_rows)
+                self._connection.executemany('REPLACE INTO accessories VALUES (?, ?, ?, ?, ?)', accessory_rows)
+                self._connection.executemany('REPLACE INTO last_seen VALUES (?, ?)', last_seen_rows)
+                self._connection.executemany('DELETE FROM accessories WHERE accessory_id = ?', removed_rows)
+                self._connection.executemany('DELETE FROM last_seen WHERE accessory_id = ?', removed_rows)
+        self._state.update(state_rows)
+        self._accessories.update((row[0], row) for row in accessory_rows)
+        self._last_seen.update(last_seen_rows)
+        for accessory_id in removed:
+            del self._accessories[accessory_id]
+            self._last_seen.pop(accessory_id, None)
+        LOGGER.debug('Wrote %s state, %s accessory and %s last seen rows, and removed %s accessories',
+                     len(state_rows), len(accessory_rows), len(last_seen_rows), len(removed))
+        return sum(map(row_size, state_rows + accessory_rows + last_seen_rows))
+
+    def _has_been_seen(self, accessory_id, last_seen):
+        if accessory_id not in self._last_seen:
+            return True
+        saved = self._last_seen[accessory_id]
+        if saved is None or last_seen is None:
+            return saved != last_seen
+        return abs(last_seen - saved) >= LAST_SEEN_RESOLUTION
+
+    def _transaction(self):
+        # With isolation_level=None, the connection leaves transactions to us: as a context
+        # manager, it commits (or rolls back) the one we begin.
+        self._connection.execute('BEGIN')
+        return self._connection
+
+
+def migrate(database, state_file):
+    """
+    Copy a JSON state file into an empty database, and its values journal (if there is one)
+    next to it.
+    """
+    with open(state_file) as fp:
+        state = json.load(fp)
+    accessories = state.pop('accessories', [])
+    for accessory in accessories:
+        accessory.setdefault('optional_characteristics', {})
+        accessory.setdefault('last_seen', None)
+    database.save(state, accessories)
+    values_file = '{}.values'.format(state_file)
+    if os.path.exists(values_file):
+        shutil.copyfile(values_file, '{}.values'.format(database.path))
+    LOGGER.info('Migrated %s accessories from %s to %s', len(accessories), state_file, database.path)
+
+
+def open_database(path):
+    """
+    Open the database at path: if it doesn't exist yet, but there is a JSON state file with
+    the same name (bridge.state for bridge.db), that is migrated into it.
+    """
+    exists = os.path.exists(path)
+    database = Database(path)
+    if not exists:
+        state_file = '{}.state'.format(os.path.splitext(path)[0])
+        if os.path.exists(state_file):
+            migrate(database, state_file)
+    return database
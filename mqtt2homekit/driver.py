@@ -0,0 +1,117 @@
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from pyhap.accessory_driver import AccessoryDriver
+
+LOGGER = logging.getLogger(__name__)
+
+
+class BridgeDriver(AccessoryDriver):
+    """
+    Every call to config_changed bumps the config version, updates the mDNS advertisement
+    and persists the whole state file. When lots of accessories change at once (like when the
+    broker restarts, and every device republishes its retained topics), we only want to do
+    that once: so we collect calls within config_changed_delay seconds into a single one.
+
+    A delay of 0 means config_changed is handled immediately.
+
+    With a database, the state is persisted to (and loaded from) that, rather than the
+    persist_file.
+    """
+    def __init__(self, *args, **kwargs):
+        self.config_changed_delay = kwargs.pop('config_changed_delay', 0)
+        self.database = kwargs.pop('database', None)
+        self._config_changed_lock = threading.Lock()
+        self._config_changed_pending = False
+        self.metrics = None
+        # A NotificationScheduler, if HAP events are being limited.
+        self.notifications = None
+        super().__init__(*args, **kwargs)
+
+    def config_changed(self):
+        if not self.config_changed_delay:
+            return self._config_changed()
+
+        with self._config_changed_lock:
+            if self._config_changed_pending:
+                return
+            self._config_changed_pending = True
+
+        LOGGER.debug('Scheduling config_changed in %s seconds', self.config_changed_delay)
+        # This may be called from the MQTT thread, so we need to get the event loop to schedule it.
+        self.loop.call_soon_threadsafe(self.loop.call_later, self.config_changed_delay, self.flush_config_changed)
+
+    def flush_config_changed(self):
+        """
+        Handle any pending config_changed right now.
+        """
+        with self._config_changed_lock:
+            if not self._config_changed_pending:
+                return
+            self._config_changed_pending = False
+
+        self._config_changed()
+
+    def _config_changed(self):
+        if self.metrics:
+            self.metrics.config_changed.inc()
+        super().config_changed()
+
+    def persist(self):
+        """
+        Write the state to a temporary file, and then move it over the existing one: a crash (or
+        power loss) part way through never leaves us with a truncated state file.
+
+        With a database, just write the rows that have changed.
+        """
+        start = time.perf_counter()
+        if self.database is not None:
+            size = self.encoder.persist_database(self.database, self.state)
+        else:
+            directory = os.path.dirname(os.path.abspath(self.persist_file))
+            with tempfile.NamedTemporaryFile('w', dir=directory, delete=False) as fp:
+                try:
+                    self.encoder.persist(fp, self.state)
+                except Exception:
+                    os.unlink(fp.name)
+                    raise
+                size = fp.tell()
+            os.replace(fp.name, self.persist_file)
+        if self.metrics:
+            self.metrics.persist_seconds.observe(time.perf_counter() - start)
+            self.metrics.persist_bytes.set(size)
+
+    def load(self):
+        if self.database is None:
+            return super().load()
+        if not self.encoder.load_database(self.database, self.state):
+            LOGGER.info('Storing Accessory state in %s', self.database.path)
+            self.persist()
+
+    def async_send_event(self, topic, data, sender_client_addr, immediate):
+        if self.notifications is None:
+            super().async_send_event(topic, data, sender_client_addr, immediate)
+        elif self.notifications.bypass(data, sender_client_addr, immediate):
+            self.notifications.bypassed(topic)
+            super().async_send_event(topic, data, sender_client_addr, immediate)
+        elif not self.aio_stop_event.is_set():
+            self.notifications.schedule(topic, data)
+
+    def send_event(self, topic, data):
+        """
+        Send an event to every controller subscribed to topic, right now.
+        """
+        super().async_send_event(topic, data, None, False)
+
+    def push_event(self, client_addr, topic, data):
+        """
+        Send an event to one controller, as async_send_event does for each of them: return
+        False (and unsubscribe it) if it has gone away.
+        """
+        if self.aio_stop_event.is_set() or self.http_server.push_event(data, client_addr):
+            return True
+        self.async_subscribe_client_topic(client_addr, topic, False)
+        return False
@@ -5,6 +5,7 @@ from io import StringIO
 
 from pyhap.encoder import AccessoryEncoder
 
+from . import snapshot
 from .accessory import Accessory
 from .loader import loader
 
@@ -15,49 +16,104 @@ class BridgeEncoder(AccessoryEncoder):
     """
     We want to override the functionality of the standard encoder, and add the accessories
     we know about to the state file.
+
+    With a snapshot_file, we also write a snapshot of the accessories there, and load them
+    from it (if it is the snapshot the state file was written with) instead.
+
+    With a database (see database.py), the same state is kept in its rows, rather than a file.
     """
-    def __init__(self, bridge):
+    def __init__(self, bridge, snapshot_file=None):
         self.bridge = bridge
+        self.snapshot_file = snapshot_file
 
     def persist(self, fp, state):
-        bridge = self.bridge
+        # Rather than parsing the state that pyhap writes and then serialising it again, we
+        # write it straight out with our accessories spliced in before the closing brace.
         _fp = StringIO()
         super().persist(_fp, state)
-        state = json.loads(_fp.getvalue())
-        state['accessories'] = [
-            {
-                "accessory_id": accessory.accessory_id,
-                "name": accessory.display_name,
-                "services": [
-                    service.display_name
-                    for service in accessory.services
-                    if service.display_name != 'AccessoryInformation'
-                ],
-                "aid": accessory.aid,
-                "last_seen": getattr(accessory, '_last_seen', time.time()),
-                "optional_characteristics": {
-                    service.display_name: [
-                        characteristic.display_name
-                        for characteristic in service.characteristics
-                        if characteristic.display_name not in [
-                            char.display_name
-                            for char in loader.get_service(service.display_name).characteristics
-                        ]
-                    ]
-                    for service in accessory.services
-                    if service.display_name != 'AccessoryInformation'
-                }
-            }
-            for aid, accessory in bridge.accessories.items() if aid != 1
+        pyhap_state = _fp.getvalue().rstrip()
+        if not pyhap_state.endswith('}'):
+            raise ValueError('Unable to add accessories to state: {}'.format(pyhap_state))
+        pyhap_state = pyhap_state[:-1].rstrip()
+        fp.write(pyhap_state)
+        if pyhap_state != '{':
+            fp.write(',')
+        accessories = [accessory for aid, accessory in list(self.bridge.accessories.items()) if aid != 1]
+        if self.snapshot_file:
+            fp.write('"snapshot":{},'.format(json.dumps(snapshot.write(self.snapshot_file, accessories))))
+        fp.write('"accessories":[')
+        separator = ''
+        for accessory in accessories:
+            fp.write(separator)
+            json.dump(self.encode_accessory(accessory), fp, separators=(',', ':'))
+            separator = ','
+        fp.write(']}')
+
+    def persist_database(self, database, state):
+        """
+        Write the rows of state that have changed to database: return the bytes written.
+        """
+        _fp = StringIO()
+        super().persist(_fp, state)
+        pyhap_state = json.loads(_fp.getvalue())
+        accessories = [accessory for aid, accessory in list(self.bridge.accessories.items()) if aid != 1]
+        if self.snapshot_file:
+            pyhap_state['snapshot'] = snapshot.write(self.snapshot_file, accessories)
+        return database.save(pyhap_state, [self.encode_accessory(accessory) for accessory in accessories])
+
+    def encode_accessory(self, accessory):
+        services = [
+            service
+            for service in accessory.services
+            if service.display_name != 'AccessoryInformation'
         ]
-        json.dump(state, fp, indent=2)
+        return {
+            "accessory_id": accessory.accessory_id,
+            "name": accessory.display_name,
+            "services": [service.display_name for service in services],
+            "aid": accessory.aid,
+            "last_seen": getattr(accessory, '_last_seen', time.time()),
+            "optional_characteristics": {
+                service.display_name: [
+                    characteristic.display_name
+                    for characteristic in service.characteristics
+                    if characteristic.display_name not in loader.service_type(service.display_name).required
+                ]
+                for service in services
+            }
+        }
 
     def load_into(self, fp, state):
-        bridge = self.bridge
         super().load_into(fp, state)
 
         fp.seek(0)
-        loaded = json.load(fp)
+        self.add_accessories(json.load(fp))
+
+    def load_database(self, database, state):
+        """
+        Load state, and our accessories, from database: return False if it is empty.
+        """
+        loaded = database.load_state()
+        if not loaded:
+            return False
+        super().load_into(StringIO(json.dumps(loaded)), state)
+        loaded['accessories'] = database.load_accessories()
+        self.add_accessories(loaded)
+        return True
+
+    def add_accessories(self, loaded):
+        bridge = self.bridge
+        if self.snapshot_file and loaded.get('snapshot'):
+            try:
+                records = snapshot.read(self.snapshot_file, loaded['snapshot'])
+            except Exception as exc:
+                LOGGER.warning('Unable to load snapshot, loading the state file instead: %s', exc)
+            else:
+                for aid, accessory_id, name, last_seen, services in records:
+                    acc = Accessory(bridge.driver, name, aid=aid, accessory_id=accessory_id, snapshot=services)
+                    acc._last_seen = last_seen
+                    bridge.add_accessory(acc)
+                return
 
         for accessory in loaded.get('accessories', []):
             acc = Accessory(
@@ -0,0 +1,41 @@
+import heapq
+import itertools
+
+
+class ExpiryQueue:
+    """
+    A heap of (deadline, key): popping only touches the entries whose deadline has passed.
+
+    Each key may only be scheduled once at a time: scheduling it again before it has been
+    popped (or discarded) does nothing.
+    """
+    def __init__(self):
+        self._heap = []
+        # key -> the count of its entry in the heap: entries for keys that have been discarded
+        # (and maybe scheduled again) are skipped when they are popped.
+        self._keys = {}
+        self._counter = itertools.count()
+
+    def __len__(self):
+        return len(self._keys)
+
+    def schedule(self, deadline, key):
+        if key in self._keys:
+            return
+        # The counter means we never need to compare keys, if the deadlines match.
+        count = self._keys[key] = next(self._counter)
+        heapq.heappush(self._heap, (deadline, count, key))
+
+    def discard(self, key):
+        self._keys.pop(key, None)
+
+    def expired(self, now):
+        """
+        Remove, and yield, every key whose deadline is at or before now.
+        """
+        while self._heap and self._heap[0][0] <= now:
+            deadline, count, key = heapq.heappop(self._heap)
+            if self._keys.get(key) != count:
+                continue
+            del self._keys[key]
+            yield key
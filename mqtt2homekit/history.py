@@ -0,0 +1,209 @@
+"""
+Recent history of the characteristics we are asked to keep it for, so that it can be
+queried (downsampled into windows) without a separate time-series database.
+
+Each characteristic's history is a RingBuffer of at most size samples: when it is full,
+the oldest sample is dropped. A sample is a timestamp (in whole seconds), stored as the
+number of seconds since the sample before it (an unsigned 32 bit int), and a value (a 32 bit
+float): so a characteristic takes at most 8 bytes a sample, and an accessory (which has a
+fixed set of characteristics) is bounded too.
+
+At most one sample is kept for each interval: a value within interval seconds of the last
+sample replaces that sample's value.
+"""
+import logging
+import os
+import pickle
+import tempfile
+import threading
+import time
+from array import array
+
+LOGGER = logging.getLogger(__name__)
+
+HISTORY_SIZE = 1440
+HISTORY_INTERVAL = 60
+HISTORY_VERSION = 1
+
+# The formats of characteristics that have a history: those with numeric values.
+NUMERIC = {'bool', 'int', 'float', 'uint8', 'uint16', 'uint32', 'uint64'}
+
+
+class RingBuffer:
+    __slots__ = ('size', 'interval', 'deltas', 'values', 'start', 'first', 'last')
+
+    def __init__(self, size=HISTORY_SIZE, interval=HISTORY_INTERVAL):
+        self.size = size
+        self.interval = interval
+        # These grow until they hold size samples: then they wrap around, with start the index
+        # of the oldest sample, whose timestamp is first (and whose delta is meaningless).
+        self.deltas = array('I')
+        self.values = array('f')
+        self.start = 0
+        self.first = None
+        self.last = None
+
+    def __len__(self):
+        return len(self.values)
+
+    def append(self, timestamp, value):
+        timestamp = int(timestamp)
+        if self.last is not None:
+            if timestamp < self.last:
+                # The clock has gone backwards: pretend it hasn't.
+                timestamp = self.last
+            if timestamp - self.last < self.interval:
+                self.values[(self.start + len(self) - 1) % self.size] = value
+                return
+        if len(self) < self.size:
+            self.deltas.append(0 if self.last is None else timestamp - self.last)
+            self.values.append(value)
+        else:
+            # Drop the oldest sample, and put this one in its place.
+            self.deltas[self.start] = timestamp - self.last
+            self.values[self.start] = value
+            self.start = (self.start + 1) % self.size
+            self.first += self.deltas[self.start]
+        if self.first is None:
+            self.first = timestamp
+        self.last = timestamp
+
+    def __iter__(self):
+        """
+        (timestamp, value) for each sample, oldest first.
+        """
+        timestamp = self.first
+        count = len(self)
+        for i in range(count):
+            index = (self.start + i) % count
+            if i:
+                timestamp += self.deltas[index]
+            yield timestamp, self.values[index]
+
+    def downsample(self, step, start=None, end=None):
+        """
+        Summarise the samples from start to end (timestamps: the oldest and newest samples, by
+        default) into windows of step seconds: (window start, count, min, max, mean) for each
+        window with samples in it.
+        """
+        windows = []
+        window = None
+        for timestamp, value in self:
+            if start is not None and timestamp < start:
+                continue
+            if end is not None and timestamp > end:
+                break
+            window_start = timestamp - (timestamp - (start or 0)) % step
+            if window is None or window[0] != window_start:
+                window = [window_start, 0, value, value, 0.0]
+                windows.append(window)
+            window[1] += 1
+            window[2] = min(window[2], value)
+            window[3] = max(window[3], value)
+            window[4] += value
+        return [
+            (window_start, count, minimum, maximum, total / count)
+            for window_start, count, minimum, maximum, total in windows
+        ]
+
+    def dump(self):
+        """
+        The samples, oldest first, as (first timestamp, deltas, values): see load().
+        """
+        order = list(range(self.start, len(self))) + list(range(self.start))
+        return (
+            self.first,
+            array('I', (self.deltas[i] for i in order)).tobytes(),
+            array('f', (self.values[i] for i in order)).tobytes(),
+        )
+
+    @classmethod
+    def load(cls, dumped, size=HISTORY_SIZE, interval=HISTORY_INTERVAL):
+        first, deltas, values = dumped
+        buffer = cls(size, interval)
+        timestamp = first
+        for i, (delta, value) in enumerate(zip(array('I', deltas), array('f', values))):
+            if i:
+                timestamp += delta
+            buffer.append(timestamp, value)
+        return buffer
+
+
+class History:
+    """
+    The history of each characteristic (by its topic) with one of names, kept in path.
+
+    Samples are recorded from the MQTT thread, and saved from the event loop, so both hold
+    the lock.
+    """
+    def __init__(self, path, names, size=HISTORY_SIZE, interval=HISTORY_INTERVAL):
+        self.path = path
+        self.names = frozenset(names)
+        self.size = size
+        self.interval = interval
+        self.buffers = {}
+        self._lock = threading.Lock()
+
+    def tracks(self, characteristic):
+        return characteristic.display_name in self.names and characteristic.properties['Format'] in NUMERIC
+
+    def buffer(self, topic):
+        try:
+            return self.buffers[topic]
+        except KeyError:
+            buffer = self.buffers[topic] = RingBuffer(self.size, self.interval)
+            return buffer
+
+    def record(self, buffer, value):
+        with self._lock:
+            buffer.append(time.time(), value)
+
+    def query(self, topic, step, start=None, end=None):
+        """
+        The history of topic, downsampled into windows of step seconds: see RingBuffer.downsample.
+        """
+        buffer = self.buffers.get(topic)
+        if buffer is None:
+            return []
+        with self._lock:
+            return buffer.downsample(step, start, end)
+
+    def forget(self, prefix):
+        """
+        Forget prefix, and every topic under it.
+        """
+        under = prefix + '/'
+        for topic in [topic for topic in self.buffers if topic == prefix or topic.startswith(under)]:
+            del self.buffers[topic]
+
+    def load(self):
+        """
+        Load the history we saved: if we can't, we start without it, rather than not at all.
+        """
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'rb') as fp:
+                version, buffers = pickle.load(fp)
+            if version != HISTORY_VERSION:
+                return
+            buffers = {
+                topic: RingBuffer.load(dumped, self.size, self.interval)
+                for topic, dumped in buffers.items()
+            }
+        except Exception as exc:
+            LOGGER.warning('Unable to load history from %s, starting without it: %s', self.path, exc)
+            return
+        self.buffers.update(buffers)
+
+    def save(self):
+        with self._lock:
+            buffers = {topic: buffer.dump() for topic, buffer in list(self.buffers.items()) if len(buffer)}
+        directory = os.path.dirname(os.path.abspath(self.path))
+        with tempfile.NamedTemporaryFile('wb', dir=directory, delete=False) as fp:
+            try:
+                pickle.dump((HISTORY_VERSION, buffers), fp, protocol=pickle.HIGHEST_PROTOCOL)
+            except Exception:
+                os.unlink(fp.name)
+                raise
+        os.replace(fp.name, self.path)
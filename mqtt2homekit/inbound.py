@@ -0,0 +1,149 @@
+import logging
+import threading
+from collections import OrderedDict
+
+from .loader import loader
+
+LOGGER = logging.getLogger(__name__)
+
+# Events: every one of these is something that happened, rather than a current state.
+LOSSLESS_CHARACTERISTICS = (
+    'ProgrammableSwitchEvent',
+)
+
+
+def is_lossless(topic):
+    """
+    Can we drop a message to this topic, if there is a newer one?
+
+    Booleans and events must always be delivered. Anything we do not know the format of
+    may be replaced: otherwise, a flood of junk topics could fill the queue without limit.
+    """
+    characteristic = topic.rsplit('/', 1)[-1]
+    if characteristic in LOSSLESS_CHARACTERISTICS:
+        return True
+    try:
+        return loader.char_type(characteristic).properties['Format'] == 'bool'
+    except KeyError:
+        return False
+
+
+class InboundQueue:
+    """
+    A bounded queue between the MQTT client and the bridge, that hands messages to
+    handler (on the event loop) at no more than rate messages per second.
+
+    While a message is waiting, a newer message to the same topic replaces it, unless the
+    topic is lossless (or the message is empty, which removes the accessory): a newer message
+    is never handled before an older one to the same topic. The queue holds at most maxsize
+    messages: when it is full, the oldest message that may be replaced is dropped, or, if
+    there are none, the oldest of the rest.
+
+    The rate is kept with a token bucket, so that rates that aren't a whole number of
+    messages per interval (or are less than one) are honoured too.
+    """
+    interval = 0.05
+
+    def __init__(self, handler, loop, rate, maxsize=1000):
+        self.handler = handler
+        self.loop = loop
+        self.rate = rate
+        self.maxsize = maxsize
+        self.coalesced = 0
+        self.dropped = 0
+        # topic -> message, except for messages that must not be replaced, which get a unique key.
+        self._messages = OrderedDict()
+        self._replaceable = 0
+        # Topics whose waiting message has a message that may not be replaced queued after it.
+        self._overtaken = set()
+        self._lossless = {}
+        self._sequence = 0
+        self._lock = threading.Lock()
+        self._scheduled = False
+        # Messages we may handle now, and when (by the loop's clock) that was worked out.
+        self._credit = 0.0
+        self._updated = None
+
+    @property
+    def depth(self):
+        return len(self._messages)
+
+    def put(self, message):
+        topic = message.topic
+        if topic not in self._lossless:
+            self._lossless[topic] = is_lossless(topic)
+
+        with self._lock:
+            if not message.payload or self._lossless[topic]:
+                if len(self._messages) >= self.maxsize:
+                    self._drop_oldest()
+                self._sequence += 1
+                self._messages[self._sequence] = message
+                if topic in self._messages:
+                    self._overtaken.add(topic)
+            elif topic in self._messages:
+                self._messages[topic] = message
+                if topic in self._overtaken:
+                    # Replacing it in place would handle it before the message queued after it.
+                    self._messages.move_to_end(topic)
+                    self._overtaken.discard(topic)
+                self.coalesced += 1
+            else:
+                if len(self._messages) >= self.maxsize:
+                    self._drop_oldest()
+                self._messages[topic] = message
+                self._replaceable += 1
+
+            if self._scheduled:
+                return
+            self._scheduled = True
+
+        self.loop.call_soon_threadsafe(self._drain_later)
+
+    def _drop_oldest(self):
+        key = next(iter(self._messages))
+        if self._replaceable:
+            key = next(key for key in self._messages if isinstance(key, str))
+        message = self._messages.pop(key)
+        LOGGER.warning('Inbound queue full, dropping message for %s', message.topic)
+        if isinstance(key, str):
+            self._overtaken.discard(key)
+            self._replaceable -= 1
+        self.dropped += 1
+
+    def _drain_later(self):
+        self.loop.call_later(self.interval, self._drain_batch)
+
+    def _drain_batch(self):
+        # The bucket holds a batch, and one more, so that the fractions left over from one
+        # batch aren't lost to the next.
+        now = self.loop.time()
+        burst = self.rate * self.interval + 1
+        if self._updated is None:
+            self._credit = burst
+        else:
+            self._credit = min(burst, self._credit + (now - self._updated) * self.rate)
+        self._updated = now
+        self._credit -= self.drain(int(self._credit))
+        with self._lock:
+            self._scheduled = bool(self._messages)
+        if self._scheduled:
+            # Below one message an interval, wait until we may handle the next one.
+            self.loop.call_later(max(self.interval, (1 - self._credit) / self.rate), self._drain_batch)
+
+    def drain(self, limit=None):
+        """
+        Handle up to limit waiting messages (or all of them, if there is no limit).
+        """
+        handled = 0
+        while limit is None or handled < limit:
+            with self._lock:
+                if not self._messages:
+                    break
+                key, message = self._messages.popitem(last=False)
+                if isinstance(key, str):
+                    self._replaceable -= 1
+                    self._overtaken.discard(key)
+            self.handler(message)
+            handled += 1
+        return handled
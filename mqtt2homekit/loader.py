@@ -1,35 +1,217 @@
 import json
+import logging
+import os
+import pickle
+import tempfile
+from collections import namedtuple
 from pathlib import Path
 
-from pyhap.loader import get_loader
+from pyhap import CHARACTERISTICS_FILE, SERVICES_FILE
+from pyhap.characteristic import Characteristic
+from pyhap.loader import Loader, get_loader
+from pyhap.service import Service
+from pyhap.util import hap_type_to_uuid
 
-loader = get_loader()
+LOGGER = logging.getLogger(__name__)
 
 path = Path(__file__).parent / 'contrib'
 
+# The merged types are cached here, and used for as long as none of the files they were merged
+# from have changed: reading one file is quicker than reading (and merging) all of them.
+CACHE_VERSION = 1
+
+COERCE = {
+    'int': int,
+    'float': float,
+    'uint8': int,
+    'uint16': int,
+    'uint32': int,
+    'uint64': int,
+    'bool': lambda value: int(value in [True, 'true', 'True', 1, '1']),
+}
+
+
+def _unchanged(value):
+    return value
+
+
+CharacteristicType = namedtuple('CharacteristicType', ['name', 'type_id', 'properties', 'coerce'])
+ServiceType = namedtuple('ServiceType', ['name', 'type_id', 'required', 'optional'])
+
 
 def merge(existing, new):
+    """
+    Return a copy of existing, with the types in new added to it: the dicts (and lists) in
+    existing are not changed.
+    """
+    merged = dict(existing)
     for key, value in new.items():
-        if key in existing:
+        if key in merged:
             # Check the UUID matches. If not, throw an exception?
-            assert existing[key]['UUID'] == value['UUID']
-            for char in value.get('OptionalCharacteristics'):
-                if char not in existing[key]['OptionalCharacteristics']:
-                    print("Added char: {} to {}".format(char, key))
-                    existing[key]['OptionalCharacteristics'].append(char)
-            for char in value.get('RequiredCharacteristics'):
-                if char not in existing[key]['RequiredCharacteristics']:
-                    print("Added char: {} to {}".format(char, key))
-                    existing[key]['RequiredCharacteristics'].append(char)
+            assert merged[key]['UUID'] == value['UUID']
+            merged[key] = dict(merged[key])
+            for field in ('OptionalCharacteristics', 'RequiredCharacteristics'):
+                if field not in value:
+                    continue
+                merged[key][field] = list(merged[key].get(field, []))
+                for char in value[field]:
+                    if char not in merged[key][field]:
+                        LOGGER.debug('Added char: %s to %s', char, key)
+                        merged[key][field].append(char)
         else:
-            existing[key] = value
+            merged[key] = value
+    return merged
+
+
+class SharedCharacteristic(Characteristic):
+    """
+    A Characteristic that shares its properties dict with every other one of the same type,
+    rather than having its own copy: the only thing that changes them is override_properties,
+    which takes a copy first.
+    """
+    __slots__ = ()
+
+    def override_properties(self, properties=None, valid_values=None):
+        self._properties = dict(self._properties)
+        super().override_properties(properties, valid_values)
+
+
+class TypeLoader(Loader):
+    """
+    A Loader for the HAP types, plus our contrib types.
+
+    The metadata for each type (UUID, characteristic names, how to coerce values) is only
+    computed from the json dicts the first time it is needed: services and characteristics
+    are then built from that.
+    """
+    def __init__(self, char_types, serv_types):
+        self.char_types = char_types
+        self.serv_types = serv_types
+        self._char_metadata = {}
+        self._serv_metadata = {}
+        self._char_prototypes = {}
+
+    def char_type(self, name):
+        try:
+            return self._char_metadata[name]
+        except KeyError:
+            pass
+        char_dict = dict(self.char_types[name])
+        if 'Format' not in char_dict or 'Permissions' not in char_dict or 'UUID' not in char_dict:
+            raise KeyError('Could not load char {}!'.format(name))
+        self._char_metadata[name] = CharacteristicType(
+            name=name,
+            type_id=hap_type_to_uuid(char_dict.pop('UUID')),
+            properties=char_dict,
+            coerce=COERCE.get(char_dict['Format'], _unchanged),
+        )
+        return self._char_metadata[name]
+
+    def service_type(self, name):
+        try:
+            return self._serv_metadata[name]
+        except KeyError:
+            pass
+        service_dict = self.serv_types[name]
+        if 'RequiredCharacteristics' not in service_dict or 'UUID' not in service_dict:
+            raise KeyError('Could not load service {}!'.format(name))
+        self._serv_metadata[name] = ServiceType(
+            name=name,
+            type_id=hap_type_to_uuid(service_dict['UUID']),
+            required=tuple(service_dict['RequiredCharacteristics']),
+            optional=frozenset(service_dict.get('OptionalCharacteristics', [])),
+        )
+        return self._serv_metadata[name]
+
+    def get_char(self, name):
+        metadata = self.char_type(name)
+        char = SharedCharacteristic(name, metadata.type_id, properties=metadata.properties)
+        # Prevents pyhap from sending the description to HomeKit, as it does for chars from it's loader.
+        char._loader_display_name = name
+        return char
+
+    def copy_char(self, name, value):
+        """
+        The same as get_char(name), with value: but copied from one we built earlier, which is
+        much quicker than building it (and working out its default value) again.
+        """
+        try:
+            prototype = self._char_prototypes[name]
+        except KeyError:
+            prototype = self._char_prototypes[name] = self.get_char(name)
+        char = SharedCharacteristic.__new__(SharedCharacteristic)
+        for slot in Characteristic.__slots__:
+            setattr(char, slot, getattr(prototype, slot))
+        char._value = value
+        return char
+
+    def get_service(self, name):
+        metadata = self.service_type(name)
+        service = Service(metadata.type_id, name)
+        service.add_characteristic(*(self.get_char(char) for char in metadata.required))
+        return service
+
+
+def cache_file():
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'mqtt2homekit', 'types.pickle')
+
+
+def sources():
+    """
+    The files the types are merged from, with their sizes and modification times.
+    """
+    files = [CHARACTERISTICS_FILE, SERVICES_FILE]
+    files.extend(str(name) for name in sorted(path.glob('characteristics.*.json')))
+    files.extend(str(name) for name in sorted(path.glob('services.*.json')))
+    return [(name, os.stat(name).st_mtime_ns, os.stat(name).st_size) for name in files]
+
+
+def read_cache(filename, key):
+    try:
+        with open(filename, 'rb') as fp:
+            cached_key, char_types, serv_types = pickle.load(fp)
+    except FileNotFoundError:
+        return None
+    except Exception as exc:
+        LOGGER.debug('Unable to read types from %s: %s', filename, exc)
+        return None
+    if cached_key != key:
+        return None
+    return char_types, serv_types
+
+
+def write_cache(filename, key, char_types, serv_types):
+    try:
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with tempfile.NamedTemporaryFile('wb', dir=os.path.dirname(filename), delete=False) as fp:
+            pickle.dump((key, char_types, serv_types), fp, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(fp.name, filename)
+    except OSError as exc:
+        # We are no worse off than without a cache.
+        LOGGER.debug('Unable to cache types in %s: %s', filename, exc)
+
+
+def load_types(cache=True):
+    if cache:
+        filename, key = cache_file(), (CACHE_VERSION, sources())
+        cached = read_cache(filename, key)
+        if cached:
+            return TypeLoader(*cached)
+
+    char_types = get_loader().char_types
+    for char_file in sorted(path.glob('characteristics.*.json')):
+        with char_file.open() as fp:
+            char_types = merge(char_types, json.load(fp))
 
+    serv_types = get_loader().serv_types
+    for serv_file in sorted(path.glob('services.*.json')):
+        with serv_file.open() as fp:
+            serv_types = merge(serv_types, json.load(fp))
 
-for char_file in path.glob('characteristics.*.json'):
-    characteristics = json.load(char_file.open())
-    merge(loader.char_types, characteristics)
+    if cache:
+        write_cache(filename, key, char_types, serv_types)
+    return TypeLoader(char_types, serv_types)
 
 
-for serv_file in path.glob('services.*.json'):
-    services = json.load(serv_file.open())
-    merge(loader.serv_types, services)
+loader = load_types()
@@ -1,19 +1,146 @@
-import logging
-
 import click
 
+from mqtt2homekit.accessory import DEADBANDS, REMOVE_TIMEOUTS, UNSEEN_TIMEOUTS
 from mqtt2homekit.bridge import MQTTBridge
+from mqtt2homekit.logs import LEVELS, configure_logging
+from mqtt2homekit.payloads import CodecRules
+
+
+def parse_deadbands(ctx, param, values):
+    deadbands = {}
+    for value in values:
+        try:
+            name, deadband = value.split('=')
+            service_type, value_format = name.split('.')
+            deadbands.setdefault(service_type, {})[value_format] = float(deadband)
+        except ValueError:
+            raise click.BadParameter('{} should look like TemperatureSensor.float=0.1'.format(value))
+    return deadbands
+
+
+def parse_timeouts(ctx, param, values):
+    timeouts = {}
+    for value in values:
+        try:
+            service_type, seconds = value.split('=')
+            timeouts[service_type] = int(seconds)
+        except ValueError:
+            raise click.BadParameter('{} should look like TemperatureSensor=3600'.format(value))
+    return timeouts
+
 
-logging.basicConfig(level=logging.DEBUG)
+def parse_codecs(ctx, param, values):
+    codecs = []
+    for value in values:
+        try:
+            pattern, spec = value.rsplit('=', 1)
+            CodecRules([(pattern, spec)])
+        except ValueError:
+            raise click.BadParameter('{} should look like */CurrentTemperature=struct:<h/100'.format(value))
+        codecs.append((pattern, spec))
+    return codecs
 
 
 @click.command()
-@click.option('--persist', default='bridge.state', help='Persist to file')
+@click.option('--persist', default='bridge.state', help='Persist to file, or a SQLite database: sqlite:///bridge.db')
 @click.option('--broker', default='mqtt://mqtt.lan:1883', help='URL to use for MQTT broker')
 @click.option('--name', default='MQTT Bridge', help='Name of MQTT Bridge')
 @click.option('--prefix', default='HomeKit', help='MQTT Topic Prefix')
-def main(name, persist, broker, prefix):
-    MQTTBridge(name, persist_file=persist, mqtt_server=broker, prefix=prefix).driver.start()
+@click.option('--config-delay', default=2.0, help='Seconds to collect configuration changes before publishing them')
+@click.option(
+    '--mqtt-loop', type=click.Choice(['thread', 'asyncio']), default='thread',
+    help='Handle MQTT messages in a separate thread, or on the HomeKit event loop',
+)
+@click.option('--inbound-rate', default=0, help='Maximum MQTT messages to handle per second (0 for no limit)')
+@click.option(
+    '--inbound-queue-size', default=1000, type=click.IntRange(min=1),
+    help='Maximum number of messages waiting to be handled',
+)
+@click.option(
+    '--deadband', multiple=True, callback=parse_deadbands,
+    help='Ignore changes smaller than this, for a service type and format: TemperatureSensor.float=0.1',
+)
+@click.option('--qos', type=click.IntRange(0, 2), default=2, help='QoS for messages sent to the broker')
+@click.option(
+    '--unseen-timeout', multiple=True, callback=parse_timeouts,
+    help='Seconds without data before a service type is Not Responding: TemperatureSensor=3600',
+)
+@click.option(
+    '--remove-timeout', multiple=True, callback=parse_timeouts,
+    help='Seconds without data before a service type is removed: Switch=86400',
+)
+@click.option('--metrics-port', type=int, help='Serve Prometheus metrics over HTTP on this port')
+@click.option('--metrics-host', default='127.0.0.1', help='Address to serve metrics on (0.0.0.0 for every interface)')
+@click.option('--fast-start', is_flag=True, help='Keep a snapshot of the accessories, that is quicker to load')
+@click.option(
+    '--values-interval', default=60,
+    help='Seconds between saving the last known values of characteristics (0 not to save them)',
+)
+@click.option('--skip-retained', is_flag=True, help='Skip retained messages with the value we already have')
+@click.option('--ignore-unknown', is_flag=True, help='Ignore topics for unknown service types or characteristics')
+@click.option(
+    '--codec', multiple=True, callback=parse_codecs,
+    help='Payload codec (text, struct:<format>, cbor or msgpack) for topics like a pattern: */CurrentTemperature=cbor',
+)
+@click.option('--bulk', is_flag=True, help='Also accept a JSON object of characteristic values for a whole service')
+@click.option(
+    '--notify-interval', default=0.0,
+    help='Minimum seconds between HomeKit events for each characteristic (0 for no limit)',
+)
+@click.option('--notify-rate', default=0.0, help='Maximum HomeKit events per second to each controller (0 for none)')
+@click.option('--notify-burst', default=10, help='HomeKit events a controller may be sent at once, with --notify-rate')
+@click.option(
+    '--history', multiple=True,
+    help='Keep the recent history of this characteristic (e.g. CurrentTemperature) for each accessory. Repeatable',
+)
+@click.option('--history-size', default=1440, help='Samples of history to keep for each characteristic')
+@click.option('--history-interval', default=60, help='Minimum seconds between samples of history')
+@click.option('--shards', default=1, help='Number of HomeKit bridges to spread accessories across')
+@click.option('--supervise', is_flag=True, help='Run each shard in its own process, restarting any that exit')
+@click.option('--log-level', type=click.Choice(LEVELS, case_sensitive=False), default='INFO', help='Log level')
+@click.option('--log-format', type=click.Choice(['text', 'json']), default='text', help='Log as text, or JSON lines')
+def main(name, persist, broker, prefix, config_delay, mqtt_loop, inbound_rate, inbound_queue_size, deadband, qos,
+         unseen_timeout, remove_timeout, metrics_port, metrics_host, fast_start, values_interval, skip_retained,
+         ignore_unknown, codec, bulk, notify_interval, notify_rate, notify_burst, history, history_size,
+         history_interval, shards, supervise, log_level, log_format):
+    configure_logging(log_level.upper(), log_format)
+    DEADBANDS.update(deadband)
+    UNSEEN_TIMEOUTS.update(unseen_timeout)
+    REMOVE_TIMEOUTS.update(remove_timeout)
+    kwargs = dict(
+        persist_file=persist,
+        mqtt_server=broker,
+        prefix=prefix,
+        config_changed_delay=config_delay,
+        mqtt_loop=mqtt_loop,
+        inbound_rate=inbound_rate,
+        inbound_queue_size=inbound_queue_size,
+        qos=qos,
+        metrics_port=metrics_port,
+        metrics_host=metrics_host,
+        fast_start=fast_start,
+        values_interval=values_interval,
+        skip_retained=skip_retained,
+        ignore_unknown=ignore_unknown,
+        codecs=codec,
+        bulk=bulk,
+        notify_interval=notify_interval,
+        notify_rate=notify_rate,
+        notify_burst=notify_burst,
+        history=history,
+        history_size=history_size,
+        history_interval=history_interval,
+    )
+    # Sharding is imported only when it is used, as it (and multiprocessing) slow down starting
+    # a single bridge.
+    if supervise:
+        from mqtt2homekit.supervisor import Supervisor
+        Supervisor(name, shards, log_level=log_level.upper(), log_format=log_format, **kwargs).start()
+    elif shards > 1:
+        from mqtt2homekit.shards import ShardedBridges
+        ShardedBridges(name, shards, **kwargs).start()
+    else:
+        MQTTBridge(name, **kwargs).driver.start()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,222 @@
+import asyncio
+import bisect
+import logging
+import threading
+
+LOGGER = logging.getLogger(__name__)
+
+# Metrics are for whoever runs the bridge: only serve them to this machine, unless asked to.
+METRICS_HOST = '127.0.0.1'
+
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+
+def format_labels(label, value):
+    if label is None:
+        return ''
+    return '{{{}="{}"}}'.format(label, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+
+
+class Counter:
+    type = 'counter'
+
+    def __init__(self, name, help, label=None):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, value=None, amount=1):
+        with self._lock:
+            self.values[value] = self.values.get(value, 0) + amount
+
+    def samples(self):
+        for value, count in sorted(self.values.items(), key=lambda item: str(item[0])):
+            yield self.name + format_labels(self.label, value), count
+
+
+class Gauge:
+    """
+    A value that is read when the metrics are collected: either set directly, or from a function.
+    """
+    type = 'gauge'
+
+    def __init__(self, name, help, function=None):
+        self.name = name
+        self.help = help
+        self.function = function
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self):
+        yield self.name, self.function() if self.function else self.value
+
+
+class CounterFunction(Gauge):
+    """
+    A counter that is kept somewhere else, and read from a function when collected.
+    """
+    type = 'counter'
+
+
+class Histogram:
+    type = 'histogram'
+
+    def __init__(self, name, help, label=None, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.buckets = buckets
+        # label value -> [count per bucket..., count above the last bucket, sum]
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, amount, value=None):
+        with self._lock:
+            if value not in self.values:
+                self.values[value] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts = self.values[value]
+            counts[bisect.bisect_left(self.buckets, amount)] += 1
+            counts[-1] += amount
+
+    def samples(self):
+        for value, counts in sorted(self.values.items(), key=lambda item: str(item[0])):
+            labels = format_labels(self.label, value)[1:-1]
+            cumulative = 0
+            for bucket, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                le = 'le="{}"'.format(bucket)
+                yield '{}_bucket{{{}}}'.format(self.name, ','.join(filter(None, [labels, le]))), cumulative
+            suffix = '{{{}}}'.format(labels) if labels else ''
+            yield '{}_count{}'.format(self.name, suffix), cumulative
+            yield '{}_sum{}'.format(self.name, suffix), counts[-1]
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def collect(self):
+        """
+        A snapshot of every metric, as (name, help, type, [(sample, value)...]): these can be
+        pickled, to send them to another process.
+        """
+        return [
+            (metric.name, metric.help, metric.type, list(metric.samples()))
+            for metric in self.metrics
+        ]
+
+    def render(self):
+        return render(self.collect())
+
+
+def render(families):
+    lines = []
+    for name, help, type, samples in families:
+        lines.append('# HELP {} {}'.format(name, help))
+        lines.append('# TYPE {} {}'.format(name, type))
+        for sample, value in samples:
+            lines.append('{} {}'.format(sample, value))
+    return '\n'.join(lines) + '\n'
+
+
+def add_label(sample, label, value):
+    """
+    Add a label to a sample name: 'foo{a="b"}' -> 'foo{label="value",a="b"}'.
+    """
+    name, brace, labels = sample.partition('{')
+    labels = labels[:-1]
+    return name + format_labels(label, value)[:-1] + (',' + labels if labels else '') + '}'
+
+
+class BridgeMetrics(Registry):
+    """
+    The metrics for an MQTTBridge. These are only collected if the bridge has been created
+    with metrics enabled: otherwise bridge.metrics is None.
+    """
+    def __init__(self, bridge):
+        super().__init__()
+        self.messages_in = self.register(Counter(
+            'mqtt2homekit_messages_received_total', 'MQTT messages received, by service type', 'service_type',
+        ))
+        self.messages_ignored = self.register(Counter(
+            'mqtt2homekit_messages_ignored_total', 'MQTT messages ignored, for topics that are not characteristics',
+        ))
+        self.messages_out = self.register(Counter(
+            'mqtt2homekit_messages_sent_total', 'MQTT messages sent, by service type', 'service_type',
+        ))
+        self.handle_seconds = self.register(Histogram(
+            'mqtt2homekit_handle_mqtt_message_seconds', 'Time taken to handle an MQTT message',
+        ))
+        self.send_seconds = self.register(Histogram(
+            'mqtt2homekit_send_mqtt_message_seconds', 'Time taken to send a change from HomeKit to MQTT',
+        ))
+        self.routes = self.register(Counter(
+            'mqtt2homekit_route_lookups_total', 'Topic route cache lookups, by result', 'result',
+        ))
+        self.config_changed = self.register(Counter(
+            'mqtt2homekit_config_changed_total', 'Configuration changes published to HomeKit',
+        ))
+        self.persist_seconds = self.register(Histogram(
+            'mqtt2homekit_persist_seconds', 'Time taken to write the state file',
+        ))
+        self.persist_bytes = self.register(Gauge(
+            'mqtt2homekit_persist_bytes',
+            'Size of the state file (or of the rows written to the database) when it was last written',
+        ))
+        self.register(Gauge(
+            'mqtt2homekit_accessories', 'Accessories on the bridge (HomeKit allows 150)',
+            lambda: len(bridge.accessories),
+        ))
+        self.register(Gauge(
+            'mqtt2homekit_stale_accessories', 'Accessories currently shown as Not Responding',
+            lambda: sum(1 for accessory in list(bridge.accessories.values()) if accessory.not_responding),
+        ))
+        if bridge.driver.notifications:
+            self.register(bridge.driver.notifications.suppressed)
+        if bridge.inbound:
+            self.register(Gauge(
+                'mqtt2homekit_inbound_queue_depth', 'Messages waiting to be handled',
+                lambda: bridge.inbound.depth,
+            ))
+            self.register(CounterFunction(
+                'mqtt2homekit_inbound_coalesced_total', 'Messages replaced by a newer one for the same topic',
+                lambda: bridge.inbound.coalesced,
+            ))
+            self.register(CounterFunction(
+                'mqtt2homekit_inbound_dropped_total', 'Messages dropped because the queue was full',
+                lambda: bridge.inbound.dropped,
+            ))
+
+
+async def serve(registry, port, host=METRICS_HOST):
+    """
+    Serve the metrics (in Prometheus' text format) over HTTP, on any path.
+    """
+    async def handle(reader, writer):
+        try:
+            # We don't care about the request, but we do need to read it.
+            while (await reader.readline()).strip():
+                pass
+            body = registry.render().encode()
+            writer.write(
+                b'HTTP/1.0 200 OK\r\n'
+                b'Content-Type: text/plain; version=0.0.4\r\n'
+                b'Content-Length: ' + str(len(body)).encode() + b'\r\n\r\n' + body
+            )
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    LOGGER.info('Serving metrics on %s:%s', host, port)
+    return server
@@ -0,0 +1,142 @@
+from .metrics import Counter
+
+# Changes that people make (or see happen) should always be sent straight away.
+BYPASS = {'On', 'ProgrammableSwitchEvent'}
+BURST = 10
+
+
+class TokenBucket:
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def take(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def delay(self):
+        """
+        Seconds until there will be a token.
+        """
+        return max(0, 1 - self.tokens) / self.rate
+
+
+class NotificationScheduler:
+    """
+    Limit the HAP events the driver sends to controllers, for accessories (like power
+    monitors) that change several times a second.
+
+    Each characteristic is sent at most once every interval seconds: a change within that
+    is held back, and when the interval is up, the latest value is sent. Each controller
+    (connection) is also sent at most rate events per second, with bursts of up to burst:
+    beyond that, events wait in a queue for that controller, where again only the latest
+    value for each characteristic is kept.
+
+    Events for characteristics in BYPASS, events pyhap sends immediately (button presses),
+    and changes made by a controller are not limited at all.
+
+    Everything here runs in the driver's event loop.
+    """
+    def __init__(self, driver, interval=0, rate=0, burst=BURST):
+        self.driver = driver
+        self.interval = interval
+        self.rate = rate
+        self.burst = burst
+        self.suppressed = Counter(
+            'mqtt2homekit_events_suppressed_total',
+            'HAP events replaced by a later value before being sent, by reason',
+            'reason',
+        )
+        # topic -> when we last sent it, and the latest data waiting for its interval to be up.
+        self._sent = {}
+        self._waiting = {}
+        # client address -> TokenBucket, and {topic: data} waiting for a token.
+        self._buckets = {}
+        self._queued = {}
+
+    def bypass(self, data, sender_client_addr, immediate):
+        if immediate or sender_client_addr:
+            return True
+        characteristic = self.driver.accessory.get_characteristic(data['aid'], data['iid'])
+        return characteristic is not None and characteristic.display_name in BYPASS
+
+    def bypassed(self, topic):
+        """
+        An event for topic has been sent without limits: any older one still waiting must not
+        be sent after it.
+        """
+        self._waiting.pop(topic, None)
+        for queued in self._queued.values():
+            queued.pop(topic, None)
+
+    def schedule(self, topic, data):
+        if self.interval:
+            now = self.driver.loop.time()
+            due = self._sent.get(topic, now - self.interval) + self.interval
+            if now < due:
+                if topic in self._waiting:
+                    self.suppressed.inc('interval')
+                else:
+                    self.driver.loop.call_at(due, self._send_waiting, topic)
+                self._waiting[topic] = data
+                return
+            self._sent[topic] = now
+        self._send(topic, data)
+
+    def _send_waiting(self, topic):
+        data = self._waiting.pop(topic, None)
+        if data is None:
+            return
+        self._sent[topic] = self.driver.loop.time()
+        self._send(topic, data)
+
+    def _send(self, topic, data):
+        if not self.rate:
+            self.driver.send_event(topic, data)
+            return
+        now = self.driver.loop.time()
+        for client_addr in list(self.driver.topics.get(topic, ())):
+            bucket = self._buckets.get(client_addr)
+            if bucket is None:
+                bucket = self._buckets[client_addr] = TokenBucket(self.rate, self.burst, now)
+            queued = self._queued.get(client_addr)
+            if queued is None:
+                if bucket.take(now):
+                    self._push(client_addr, topic, data)
+                    continue
+                queued = self._queued[client_addr] = {}
+                self.driver.loop.call_later(bucket.delay(), self._drain, client_addr)
+            if topic in queued:
+                self.suppressed.inc('rate')
+            queued[topic] = data
+
+    def _drain(self, client_addr):
+        queued = self._queued.get(client_addr)
+        if queued is None:
+            return
+        bucket = self._buckets[client_addr]
+        now = self.driver.loop.time()
+        while queued and bucket.take(now):
+            topic = next(iter(queued))
+            if not self._push(client_addr, topic, queued.pop(topic)):
+                return
+        if queued:
+            self.driver.loop.call_later(bucket.delay(), self._drain, client_addr)
+        else:
+            del self._queued[client_addr]
+
+    def _push(self, client_addr, topic, data):
+        if self.driver.push_event(client_addr, topic, data):
+            return True
+        # The controller has gone away.
+        self._buckets.pop(client_addr, None)
+        self._queued.pop(client_addr, None)
+        return False
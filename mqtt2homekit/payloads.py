@@ -0,0 +1,289 @@
+"""
+How the payloads of characteristic topics are encoded: as text (the default), or, for devices
+that would rather send a few bytes than a string (like battery powered sensors), packed with
+struct, or as a CBOR or MessagePack scalar.
+
+A codec's decode() takes the payload (bytes) and returns the value, which is then coerced
+to the characteristic's format like text would be: encode() does the reverse, for values we
+publish. The binary codecs read straight from the payload, without building a str of it.
+
+Which codec a topic uses is set by rules (see CodecRules), and chosen once, when the topic
+is routed:
+
+    --codec 'HomeKit/garden-*=struct:<h/100'     # topics starting with HomeKit/garden-
+    --codec '*/CurrentTemperature=cbor'          # topics ending with /CurrentTemperature
+"""
+import struct
+from operator import methodcaller
+
+_FLOAT16 = struct.Struct('>e')
+_FLOAT32 = struct.Struct('>f')
+_FLOAT64 = struct.Struct('>d')
+_UINTS = {1: struct.Struct('>B'), 2: struct.Struct('>H'), 4: struct.Struct('>I'), 8: struct.Struct('>Q')}
+_INTS = {1: struct.Struct('>b'), 2: struct.Struct('>h'), 4: struct.Struct('>i'), 8: struct.Struct('>q')}
+
+
+def _exactly(codec, value):
+    try:
+        return codec.unpack(codec.pack(value))[0] == value
+    except (OverflowError, struct.error):
+        return False
+
+
+class TextCodec:
+    name = 'text'
+    # A methodcaller isn't bound as a method, so this is payload.decode('ascii'), without a
+    # Python call in between: this is what almost every message uses.
+    decode = methodcaller('decode', 'ascii')
+
+    def encode(self, value):
+        return str(value).encode()
+
+    def __repr__(self):
+        return '<TextCodec>'
+
+
+class StructCodec:
+    """
+    A payload of exactly one value packed with struct, like '<h' (a little endian int16), or
+    '<f' (a float32). With a divisor, the value is divided by it when decoding (and multiplied
+    by it, and rounded, when encoding): '<h/100' is a temperature in hundredths of a degree.
+    """
+    def __init__(self, fmt, divisor=None):
+        try:
+            self.struct = struct.Struct(fmt)
+        except struct.error as exc:
+            raise ValueError('{} is not a struct format: {}'.format(fmt, exc))
+        if len(self.struct.unpack(bytes(self.struct.size))) != 1:
+            raise ValueError('{} should pack exactly one value'.format(fmt))
+        self.name = 'struct:{}'.format(fmt) + ('/{}'.format(divisor) if divisor else '')
+        self.divisor = divisor
+        self._integer = fmt[-1] not in 'efd'
+
+    def decode(self, payload):
+        value, = self.struct.unpack(payload)
+        if self.divisor:
+            return value / self.divisor
+        return value
+
+    def encode(self, value):
+        if self.divisor:
+            value = round(float(value) * self.divisor)
+        elif self._integer:
+            value = int(value)
+        return self.struct.pack(value)
+
+    def __repr__(self):
+        return '<StructCodec {}>'.format(self.name)
+
+
+class CBORCodec:
+    """
+    A single CBOR scalar (RFC 8949): an integer, float (of any width), bool, null, text or
+    byte string.
+    """
+    name = 'cbor'
+
+    def decode(self, payload):
+        view = memoryview(payload)
+        head = view[0]
+        major, info = head >> 5, head & 0x1f
+        if major == 7:
+            if info in (20, 21):
+                value, end = info == 21, 1
+            elif info == 22:
+                value, end = None, 1
+            elif info in (25, 26, 27):
+                codec = {25: _FLOAT16, 26: _FLOAT32, 27: _FLOAT64}[info]
+                value, = codec.unpack_from(view, 1)
+                end = 1 + codec.size
+            else:
+                raise ValueError('Unsupported CBOR simple value {}'.format(info))
+        else:
+            if info < 24:
+                argument, start = info, 1
+            elif info in (24, 25, 26, 27):
+                codec = _UINTS[1 << (info - 24)]
+                argument, = codec.unpack_from(view, 1)
+                start = 1 + codec.size
+            else:
+                raise ValueError('Unsupported CBOR argument {}'.format(info))
+            if major == 0:
+                value, end = argument, start
+            elif major == 1:
+                value, end = -1 - argument, start
+            elif major in (2, 3):
+                end = start + argument
+                value = bytes(view[start:end])
+                if major == 3:
+                    value = value.decode('utf-8')
+            else:
+                raise ValueError('Unsupported CBOR major type {}'.format(major))
+        if end != len(view):
+            raise ValueError('Expected {} bytes of CBOR, not {}'.format(end, len(view)))
+        return value
+
+    def encode(self, value):
+        if value is None:
+            return b'\xf6'
+        if value is True or value is False:
+            return b'\xf5' if value else b'\xf4'
+        if isinstance(value, float):
+            # The smallest float that holds value exactly, like a device would send it.
+            for head, codec in ((b'\xf9', _FLOAT16), (b'\xfa', _FLOAT32)):
+                if _exactly(codec, value):
+                    return head + codec.pack(value)
+            return b'\xfb' + _FLOAT64.pack(value)
+        if isinstance(value, int):
+            if value < 0:
+                return self._head(1, -1 - value)
+            return self._head(0, value)
+        if isinstance(value, bytes):
+            return self._head(2, len(value)) + value
+        value = str(value).encode('utf-8')
+        return self._head(3, len(value)) + value
+
+    def _head(self, major, argument):
+        if argument < 24:
+            return bytes([major << 5 | argument])
+        for info, size in ((24, 1), (25, 2), (26, 4), (27, 8)):
+            if argument < 1 << (size * 8):
+                return bytes([major << 5 | info]) + _UINTS[size].pack(argument)
+        raise ValueError('{} is too big for CBOR'.format(argument))
+
+    def __repr__(self):
+        return '<CBORCodec>'
+
+
+class MessagePackCodec:
+    """
+    A single MessagePack scalar: an integer, float, bool, nil, str or bin.
+    """
+    name = 'msgpack'
+
+    def decode(self, payload):
+        view = memoryview(payload)
+        head = view[0]
+        if head <= 0x7f:
+            value, end = head, 1
+        elif head >= 0xe0:
+            value, end = head - 0x100, 1
+        elif head == 0xc0:
+            value, end = None, 1
+        elif head in (0xc2, 0xc3):
+            value, end = head == 0xc3, 1
+        elif head in (0xca, 0xcb):
+            codec = _FLOAT32 if head == 0xca else _FLOAT64
+            value, = codec.unpack_from(view, 1)
+            end = 1 + codec.size
+        elif 0xcc <= head <= 0xd3:
+            codec = (_UINTS if head <= 0xcf else _INTS)[1 << ((head - 0xcc) % 4)]
+            value, = codec.unpack_from(view, 1)
+            end = 1 + codec.size
+        else:
+            if 0xa0 <= head <= 0xbf:
+                length, start = head & 0x1f, 1
+            elif head in (0xd9, 0xda, 0xdb, 0xc4, 0xc5, 0xc6):
+                codec = _UINTS[1 << ((head - 0xd9) if head >= 0xd9 else (head - 0xc4))]
+                length, = codec.unpack_from(view, 1)
+                start = 1 + codec.size
+            else:
+                raise ValueError('Unsupported MessagePack type 0x{:02x}'.format(head))
+            end = start + length
+            value = bytes(view[start:end])
+            if head <= 0xbf or head >= 0xd9:
+                value = value.decode('utf-8')
+        if end != len(view):
+            raise ValueError('Expected {} bytes of MessagePack, not {}'.format(end, len(view)))
+        return value
+
+    def encode(self, value):
+        if value is None:
+            return b'\xc0'
+        if value is True or value is False:
+            return b'\xc3' if value else b'\xc2'
+        if isinstance(value, float):
+            if _exactly(_FLOAT32, value):
+                return b'\xca' + _FLOAT32.pack(value)
+            return b'\xcb' + _FLOAT64.pack(value)
+        if isinstance(value, int):
+            if 0 <= value <= 0x7f or -32 <= value < 0:
+                return bytes([value & 0xff])
+            types, first = (_UINTS, 0xcc) if value >= 0 else (_INTS, 0xd0)
+            for i, size in enumerate((1, 2, 4, 8)):
+                try:
+                    return bytes([first + i]) + types[size].pack(value)
+                except struct.error:
+                    continue
+            raise ValueError('{} is too big for MessagePack'.format(value))
+        if isinstance(value, bytes):
+            return self._head(0xc4, None, len(value)) + value
+        value = str(value).encode('utf-8')
+        return self._head(0xd9, 0xa0, len(value)) + value
+
+    def _head(self, first, fixed, length):
+        if fixed is not None and length < 32:
+            return bytes([fixed | length])
+        for i, size in enumerate((1, 2, 4)):
+            if length < 1 << (size * 8):
+                return bytes([first + i]) + _UINTS[size].pack(length)
+        raise ValueError('{} bytes is too long for MessagePack'.format(length))
+
+    def __repr__(self):
+        return '<MessagePackCodec>'
+
+
+TEXT = TextCodec()
+
+CODECS = {
+    'text': TEXT,
+    'cbor': CBORCodec(),
+    'msgpack': MessagePackCodec(),
+}
+
+
+def get_codec(spec):
+    """
+    The codec for spec: text, cbor, msgpack, or struct:<format>[/<divisor>].
+    """
+    if spec in CODECS:
+        return CODECS[spec]
+    if spec.startswith('struct:'):
+        fmt, _, divisor = spec[len('struct:'):].partition('/')
+        return StructCodec(fmt, float(divisor) if divisor else None)
+    raise ValueError('Unknown codec {}'.format(spec))
+
+
+class CodecRules:
+    """
+    Which codec each topic uses: the first of rules, (pattern, codec spec) pairs, whose
+    pattern matches it, or text. A pattern ending with * matches the topics starting with the
+    rest of it, one starting with * those ending with the rest, and any other just that topic.
+    """
+    def __init__(self, rules=()):
+        self.rules = []
+        for pattern, spec in rules:
+            codec = get_codec(spec)
+            if pattern.endswith('*'):
+                self.rules.append((pattern[:-1], None, codec))
+            elif pattern.startswith('*'):
+                self.rules.append((None, pattern[1:], codec))
+            elif '*' in pattern:
+                raise ValueError('{} should start or end with *, or not have one'.format(pattern))
+            else:
+                self.rules.append((pattern, pattern, codec))
+
+    def __bool__(self):
+        return bool(self.rules)
+
+    def select(self, topic):
+        for prefix, suffix, codec in self.rules:
+            if prefix is not None and suffix is not None:
+                if topic == prefix:
+                    return codec
+            elif prefix is not None:
+                if topic.startswith(prefix):
+                    return codec
+            elif topic.endswith(suffix):
+                return codec
+        return TEXT
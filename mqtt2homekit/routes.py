@@ -0,0 +1,28 @@
+class Route:
+    """
+    One characteristic on the bridge, and everything we need to pass values for it in either
+    direction: it is the characteristic's setter_callback (so HomeKit setting the value
+    publishes it to topic), and it is what the bridge's route cache holds for each topic
+    that sets the value. It holds the codec for the topic's payloads (see payloads.py), and,
+    if we keep the characteristic's history, the history.RingBuffer for it.
+
+    There is one of these for every characteristic, so it is slotted.
+    """
+    __slots__ = ('bridge', 'accessory', 'service', 'characteristic', 'topic', 'coerce', 'deadband', 'codec', 'history')
+
+    def __init__(self, bridge, accessory, service, characteristic, topic, coerce, deadband, codec, history=None):
+        self.bridge = bridge
+        self.accessory = accessory
+        self.service = service
+        self.characteristic = characteristic
+        self.topic = topic
+        self.coerce = coerce
+        self.deadband = deadband
+        self.codec = codec
+        self.history = history
+
+    def __call__(self, value):
+        self.bridge.send_mqtt_message(self.accessory, self.service, self.characteristic, value, topic=self.topic)
+
+    def __repr__(self):
+        return '<Route {}>'.format(self.topic)
@@ -0,0 +1,240 @@
+import asyncio
+import json
+import logging
+import os
+import random
+import signal
+import tempfile
+import threading
+import zlib
+from pathlib import Path
+
+from .bridge import (MQTTBridge, build_client, connect_client,
+                     disconnect_client, is_unknown, parse_topic)
+from .database import SCHEME, database_path, open_database
+
+LOGGER = logging.getLogger(__name__)
+
+# HomeKit allows 150 accessories on a bridge, and the bridge itself is one of them.
+MAX_ACCESSORIES = 149
+
+
+def stable_hash(accessory_id):
+    # hash() is randomised for each process, so we can't use that.
+    return zlib.crc32(accessory_id.encode())
+
+
+def shard_persist_file(persist_file, shard):
+    """
+    The first shard uses the persist file as given, so a single bridge can be sharded
+    without having to be paired again: the others get a numbered file next to it.
+
+    The shard table is always a JSON file (bridge.shards.json for bridge.db), even if the
+    bridges have databases.
+    """
+    if shard == 0:
+        return persist_file
+    if database_path(persist_file):
+        path = Path(database_path(persist_file))
+        if shard == 'shards':
+            return str(path.with_name('{}.shards.json'.format(path.stem)))
+        return SCHEME + str(path.with_name('{}.{}{}'.format(path.stem, shard, path.suffix)))
+    path = Path(persist_file)
+    return str(path.with_name('{}.{}{}'.format(path.stem, shard, path.suffix)))
+
+
+class ShardTable:
+    """
+    Which shard each accessory belongs to.
+
+    An accessory is first assigned by a stable hash of its id (or the next shard along, if
+    that one is full): after that, the assignment is persisted, so accessories never move
+    between bridges, even if the number of shards grows. If it shrinks, the accessories of
+    the shards that are gone are assigned again, as if they were new.
+    """
+    def __init__(self, path, shards, ask=None):
+        self.path = path
+        self.shards = shards
+        # Worker processes can't see each other's assignments, so they ask the supervisor
+        # (which owns the table) where accessories they don't know go, and don't write anything:
+        # see supervisor.Supervisor.
+        self.ask = ask
+        self.assignments = {}
+        self._counts = [0] * shards
+        self._lock = threading.Lock()
+        orphans = []
+        if os.path.exists(path):
+            with open(path) as fp:
+                for accessory_id, shard in json.load(fp).items():
+                    if shard < shards:
+                        self._assign(accessory_id, shard)
+                    elif not ask:
+                        orphans.append((accessory_id, shard))
+        for accessory_id, gone in orphans:
+            shard = self._choose(accessory_id)
+            # It will be created again on its new bridge (in HomeKit, too) when it next publishes.
+            LOGGER.warning('Shard %s is gone: moving %s to shard %s', gone, accessory_id, shard)
+            self._assign(accessory_id, shard)
+        if orphans:
+            self.persist()
+
+    def _assign(self, accessory_id, shard):
+        self.assignments[accessory_id] = shard
+        self._counts[shard] += 1
+
+    def _choose(self, accessory_id):
+        first = stable_hash(accessory_id) % self.shards
+        for offset in range(self.shards):
+            shard = (first + offset) % self.shards
+            if self._counts[shard] < MAX_ACCESSORIES:
+                return shard
+        LOGGER.error('All %s shards are full: adding %s to shard %s', self.shards, accessory_id, first)
+        return first
+
+    def seed(self, shard, accessory_ids):
+        """
+        Assign accessories we already have (in a shard's state file) to that shard.
+        """
+        with self._lock:
+            for accessory_id in accessory_ids:
+                if accessory_id not in self.assignments:
+                    self._assign(accessory_id, shard)
+        self.persist()
+
+    def shard_for(self, accessory_id):
+        try:
+            return self.assignments[accessory_id]
+        except KeyError:
+            pass
+        with self._lock:
+            if accessory_id not in self.assignments:
+                if self.ask:
+                    self._assign(accessory_id, self.ask(accessory_id))
+                else:
+                    self._assign(accessory_id, self._choose(accessory_id))
+                    self.persist()
+            return self.assignments[accessory_id]
+
+    def persist(self):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        with tempfile.NamedTemporaryFile('w', dir=directory, delete=False) as fp:
+            json.dump(self.assignments, fp, separators=(',', ':'), sort_keys=True)
+        os.replace(fp.name, self.path)
+
+
+def persisted_accessory_ids(persist_file):
+    """
+    The ids of the accessories in a bridge's state file, without building the bridge.
+    """
+    if database_path(persist_file):
+        path = database_path(persist_file)
+        if not os.path.exists(path):
+            return []
+        database = open_database(path)
+        try:
+            return [accessory['accessory_id'] for accessory in database.load_accessories()]
+        finally:
+            database.close()
+    if not os.path.exists(persist_file):
+        return []
+    with open(persist_file) as fp:
+        return [accessory['accessory_id'] for accessory in json.load(fp).get('accessories', [])]
+
+
+def creates_accessory(message, ignore_unknown=False):
+    """
+    Would a bridge create an accessory for message? Removing an accessory we have never
+    seen wouldn't, and with --ignore-unknown, neither would a topic for a type we don't know.
+    """
+    if not message.payload:
+        return False
+    if not ignore_unknown:
+        return True
+    parsed = parse_topic(message.topic)
+    return parsed is not None and not is_unknown(parsed[1], parsed[3])
+
+
+class ShardedBridges:
+    """
+    Several MQTTBridges, in one process: they share one MQTT connection and one event
+    loop, and each accessory belongs to exactly one of them (see ShardTable).
+
+    Each bridge is a separate HAP bridge, with its own state file and port, and must be
+    paired separately.
+    """
+    def __init__(self, display_name, shards, **kwargs):
+        self.mqtt_loop = kwargs.get('mqtt_loop', 'thread')
+        self.ignore_unknown = kwargs.get('ignore_unknown', False)
+        persist_file = kwargs['persist_file']
+        metrics_port = kwargs.pop('metrics_port', None)
+        self.loop = asyncio.new_event_loop()
+        self.client = build_client()
+        self.transport = None
+        self.table = ShardTable(shard_persist_file(persist_file, 'shards'), shards)
+
+        ports = random.sample(range(50000, 60001), shards)
+        self.bridges = []
+        for shard in range(shards):
+            bridge = MQTTBridge(
+                display_name if shard == 0 else '{} {}'.format(display_name, shard + 1),
+                **dict(
+                    kwargs,
+                    persist_file=shard_persist_file(persist_file, shard),
+                    port=ports[shard],
+                    loop=self.loop,
+                    client=self.client,
+                    metrics_port=None if metrics_port is None else metrics_port + shard,
+                )
+            )
+            self.table.seed(shard, bridge._accessory_index)
+            self.bridges.append(bridge)
+
+        # Each driver installs its own signal handlers: we need to stop all of them.
+        signal.signal(signal.SIGINT, self.signal_handler)
+        signal.signal(signal.SIGTERM, self.signal_handler)
+
+    def bridge_for(self, accessory_id):
+        return self.bridges[self.table.shard_for(accessory_id)]
+
+    def receive_mqtt_message(self, client, userdata, message):
+        parts = message.topic.split('/')
+        if len(parts) < 3:
+            return
+        accessory_id = parts[1]
+        if accessory_id not in self.table.assignments and not creates_accessory(message, self.ignore_unknown):
+            # Don't give a shard to an accessory no bridge would create.
+            return
+        self.bridge_for(accessory_id).receive_mqtt_message(client, userdata, message)
+
+    async def connect(self):
+        bridge = self.bridges[0]
+        try:
+            self.transport = connect_client(
+                self.client, bridge.mqtt_server, bridge.topics(), self.receive_mqtt_message, self.loop,
+                self.mqtt_loop,
+            )
+        except ConnectionRefusedError:
+            LOGGER.critical('Unable to connect to MQTT Broker')
+
+    def start(self):
+        try:
+            for bridge in self.bridges:
+                bridge.driver.add_job(bridge.driver.async_start())
+            self.loop.call_soon_threadsafe(self.loop.create_task, self.connect())
+            self.loop.run_forever()
+        except KeyboardInterrupt:
+            self.loop.call_soon_threadsafe(self.loop.create_task, self.async_stop())
+            self.loop.run_forever()
+        finally:
+            self.loop.close()
+
+    def signal_handler(self, _signal, _frame):
+        self.loop.call_soon_threadsafe(self.loop.create_task, self.async_stop())
+
+    async def async_stop(self):
+        for bridge in self.bridges:
+            await bridge.driver.async_stop()
+        disconnect_client(self.client, self.transport)
+        # Let the transport's task finish being cancelled.
+        await asyncio.sleep(0)
+        self.loop.stop()
@@ -0,0 +1,70 @@
+"""
+A compact snapshot of a bridge's accessories, for starting up quickly.
+
+The state file describes each accessory by its service and characteristic names: loading
+it means building every service from the loader, and assigning IIDs in the same order as
+last time. A snapshot records, for each accessory, exactly which services and
+characteristics it had, with their IIDs and last values:
+
+    (aid, accessory_id, name, last_seen, (
+        (service name, iid, ((characteristic name, iid, value), ...)),
+        ...
+    ))
+
+as a pickle of plain tuples, which Accessory(snapshot=...) restores without going back
+through the loader's service definitions.
+
+Each snapshot has a token, which is also written to the state file: we only use a snapshot
+whose token matches, so a stale one (if we crashed between writing the two) is ignored.
+"""
+import os
+import pickle
+import tempfile
+import uuid
+
+SNAPSHOT_VERSION = 1
+
+
+def dump_accessory(accessory):
+    iids = accessory.iid_manager.iids
+    return (
+        accessory.aid,
+        accessory.accessory_id,
+        accessory.display_name,
+        accessory._last_seen,
+        tuple(
+            (service.display_name, iids[service], tuple(
+                (characteristic.display_name, iids[characteristic], characteristic.value)
+                for characteristic in service.characteristics
+            ))
+            for service in accessory.services
+        ),
+    )
+
+
+def write(path, accessories):
+    """
+    Write a snapshot of accessories to path (atomically), and return its token.
+    """
+    token = uuid.uuid4().hex
+    records = [dump_accessory(accessory) for accessory in accessories]
+    directory = os.path.dirname(os.path.abspath(path))
+    with tempfile.NamedTemporaryFile('wb', dir=directory, delete=False) as fp:
+        try:
+            pickle.dump((SNAPSHOT_VERSION, token, records), fp, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            os.unlink(fp.name)
+            raise
+    os.replace(fp.name, path)
+    return token
+
+
+def read(path, token):
+    """
+    The records from the snapshot at path: if it is not the one with token, raise ValueError.
+    """
+    with open(path, 'rb') as fp:
+        version, found, records = pickle.load(fp)
+    if version != SNAPSHOT_VERSION or found != token:
+        raise ValueError('Snapshot {} does not match the state file'.format(path))
+    return records
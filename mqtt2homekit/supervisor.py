@@ -0,0 +1,290 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import random
+import signal
+import threading
+import time
+
+from pyhap import util
+
+from . import accessory
+from .bridge import MQTTBridge
+from .logs import configure_logging
+from .metrics import METRICS_HOST, add_label, render, serve
+from .shards import (ShardTable, creates_accessory, persisted_accessory_ids,
+                     shard_persist_file, stable_hash)
+
+LOGGER = logging.getLogger(__name__)
+
+HEARTBEAT_INTERVAL = 5
+RESTART_DELAY = 1
+ASK_TIMEOUT = 5
+
+
+class WorkerBridge(MQTTBridge):
+    """
+    The MQTTBridge for one shard, in a worker process. Every worker sees every message,
+    and ignores those for accessories in other shards (asking the supervisor about those it
+    doesn't know): it also reports how it is doing to the supervisor, every
+    heartbeat_interval seconds.
+    """
+    def __init__(self, display_name, shard, shards, table_path, connection, **kwargs):
+        self.shard = shard
+        self.table = ShardTable(table_path, shards, ask=self.ask)
+        self.connection = connection
+        # The heartbeat and the MQTT thread both use the connection.
+        self._connection_lock = threading.Lock()
+        self.heartbeat_interval = kwargs.pop('heartbeat_interval', HEARTBEAT_INTERVAL)
+        super().__init__(display_name, **kwargs)
+
+    def receive_mqtt_message(self, client, userdata, message):
+        parts = message.topic.split('/')
+        if len(parts) < 3:
+            return
+        if parts[1] not in self.table.assignments and not creates_accessory(message, self.ignore_unknown):
+            # Don't ask about an accessory no bridge would create.
+            return
+        if self.table.shard_for(parts[1]) == self.shard:
+            super().receive_mqtt_message(client, userdata, message)
+
+    def ask(self, accessory_id):
+        """
+        Which shard the supervisor has assigned accessory_id to.
+        """
+        with self._connection_lock:
+            try:
+                self.connection.send(('shard_for', accessory_id))
+                while self.connection.poll(ASK_TIMEOUT):
+                    # Skip any answer to a question we stopped waiting for.
+                    answered, shard = self.connection.recv()
+                    if answered == accessory_id:
+                        return shard
+            except (EOFError, OSError):
+                pass
+        shard = stable_hash(accessory_id) % self.table.shards
+        LOGGER.error('The supervisor did not say where %s goes: assuming shard %s', accessory_id, shard)
+        return shard
+
+    async def run(self):
+        self.driver.async_add_job(self.heartbeat)
+        await super().run()
+
+    async def heartbeat(self):
+        while True:
+            try:
+                with self._connection_lock:
+                    self.connection.send(('health', self.health()))
+            except OSError:
+                LOGGER.critical('Lost the supervisor, stopping')
+                self.driver.stop()
+                return
+            if await util.event_wait(self.driver.aio_stop_event, self.heartbeat_interval):
+                return
+
+    def health(self):
+        return {
+            'pid': os.getpid(),
+            'time': time.time(),
+            'accessories': len(self.accessories),
+            'paired': self.driver.state.paired,
+            'connected': bool(self.client and self.client.is_connected()),
+            'metrics': self.metrics.collect() if self.metrics else None,
+        }
+
+
+def run_worker(connection, shard, shards, display_name, table_path, log_level, log_format, settings, kwargs):
+    configure_logging(log_level, log_format)
+    # Workers are spawned, not forked, so they need to be told about any changes to these.
+    for name, value in settings.items():
+        getattr(accessory, name).update(value)
+    WorkerBridge(display_name, shard, shards, table_path, connection, **kwargs).driver.start()
+
+
+class Worker:
+    def __init__(self, shard, port):
+        self.shard = shard
+        self.port = port
+        self.process = None
+        self.connection = None
+        self.health = None
+        self.restarts = 0
+
+
+class Supervisor:
+    """
+    Run each shard (see shards.ShardTable) in its own worker process, so they can use more
+    than one core: restart any that exit, and collect their health and metrics.
+
+    Each worker has its own MQTT connection, state file and port. The supervisor assigns the
+    accessories in each shard's state file to that shard when it starts, and owns the table:
+    workers ask it where new accessories go, so that every worker agrees, and no shard gets
+    more than MAX_ACCESSORIES.
+    """
+    def __init__(self, display_name, shards, **kwargs):
+        self.display_name = display_name
+        self.shards = shards
+        self.log_level = kwargs.pop('log_level', 'INFO')
+        self.log_format = kwargs.pop('log_format', 'text')
+        self.metrics_port = kwargs.pop('metrics_port', None)
+        self.metrics_host = kwargs.pop('metrics_host', METRICS_HOST)
+        self.metrics_server = None
+        # Workers collect metrics, if we are going to serve them.
+        kwargs.setdefault('metrics', self.metrics_port is not None)
+        self.kwargs = kwargs
+        self.persist_file = kwargs['persist_file']
+        self.table_path = shard_persist_file(self.persist_file, 'shards')
+        self.table = ShardTable(self.table_path, shards)
+        for shard in range(shards):
+            self.table.seed(shard, persisted_accessory_ids(shard_persist_file(self.persist_file, shard)))
+
+        ports = random.sample(range(50000, 60001), shards)
+        self.workers = [Worker(shard, ports[shard]) for shard in range(shards)]
+        self.context = multiprocessing.get_context('spawn')
+        self.loop = asyncio.new_event_loop()
+        self.stopping = False
+
+    def spawn(self, worker):
+        if self.stopping:
+            return
+        connection, worker_connection = self.context.Pipe()
+        worker.process = self.context.Process(
+            target=run_worker,
+            name='mqtt2homekit-shard-{}'.format(worker.shard),
+            args=(
+                worker_connection,
+                worker.shard,
+                self.shards,
+                self.display_name if worker.shard == 0 else '{} {}'.format(self.display_name, worker.shard + 1),
+                self.table_path,
+                self.log_level,
+                self.log_format,
+                {name: getattr(accessory, name) for name in ('DEADBANDS', 'UNSEEN_TIMEOUTS', 'REMOVE_TIMEOUTS')},
+                dict(self.kwargs, persist_file=shard_persist_file(self.persist_file, worker.shard), port=worker.port),
+            ),
+        )
+        worker.process.start()
+        # Only the worker may hold its end: then we see EOF when it exits.
+        worker_connection.close()
+        worker.connection = connection
+        self.loop.add_reader(connection.fileno(), self.receive, worker)
+        LOGGER.info('Started shard %s (pid %s)', worker.shard, worker.process.pid)
+
+    def receive(self, worker):
+        try:
+            while worker.connection.poll():
+                kind, value = worker.connection.recv()
+                if kind == 'health':
+                    worker.health = value
+                else:
+                    worker.connection.send((value, self.table.shard_for(value)))
+        except (EOFError, OSError):
+            self.loop.remove_reader(worker.connection.fileno())
+            worker.connection.close()
+            self.loop.create_task(self.exited(worker))
+
+    async def exited(self, worker):
+        await self.loop.run_in_executor(None, worker.process.join)
+        if self.stopping:
+            return
+        worker.restarts += 1
+        LOGGER.error(
+            'Shard %s (pid %s) exited with %s: restarting it',
+            worker.shard, worker.process.pid, worker.process.exitcode,
+        )
+        self.loop.call_later(RESTART_DELAY, self.spawn, worker)
+
+    def health(self):
+        now = time.time()
+        return [
+            {
+                'shard': worker.shard,
+                'alive': bool(worker.process and worker.process.is_alive()),
+                'restarts': worker.restarts,
+                'heartbeat_age': now - worker.health['time'] if worker.health else None,
+                **{
+                    key: value
+                    for key, value in (worker.health or {}).items()
+                    if key not in ('time', 'metrics')
+                },
+            }
+            for worker in self.workers
+        ]
+
+    def render(self):
+        """
+        Our metrics about the workers, and every worker's own metrics, labelled by shard.
+        """
+        health = self.health()
+        families = [
+            ('mqtt2homekit_worker_up', 'Whether the worker process is running', 'gauge', [
+                (add_label('mqtt2homekit_worker_up', 'shard', worker['shard']), int(worker['alive']))
+                for worker in health
+            ]),
+            ('mqtt2homekit_worker_restarts_total', 'Times the worker process has been restarted', 'counter', [
+                (add_label('mqtt2homekit_worker_restarts_total', 'shard', worker['shard']), worker['restarts'])
+                for worker in health
+            ]),
+            ('mqtt2homekit_worker_heartbeat_age_seconds', 'Seconds since the worker last reported', 'gauge', [
+                (add_label('mqtt2homekit_worker_heartbeat_age_seconds', 'shard', worker['shard']),
+                 worker['heartbeat_age'])
+                for worker in health
+                if worker['heartbeat_age'] is not None
+            ]),
+        ]
+        collected = {}
+        for worker in self.workers:
+            if not worker.health or not worker.health['metrics']:
+                continue
+            for name, help, type, samples in worker.health['metrics']:
+                if name not in collected:
+                    collected[name] = (name, help, type, [])
+                    families.append(collected[name])
+                collected[name][3].extend(
+                    (add_label(sample, 'shard', worker.shard), value) for sample, value in samples
+                )
+        return render(families)
+
+    async def run(self):
+        for worker in self.workers:
+            self.spawn(worker)
+        if self.metrics_port is not None:
+            self.metrics_server = await serve(self, self.metrics_port, self.metrics_host)
+
+    def start(self):
+        signal.signal(signal.SIGINT, self.signal_handler)
+        signal.signal(signal.SIGTERM, self.signal_handler)
+        try:
+            self.loop.run_until_complete(self.run())
+            self.loop.run_forever()
+        finally:
+            self.loop.close()
+
+    def signal_handler(self, _signal, _frame):
+        self.loop.call_soon_threadsafe(self.loop.create_task, self.shutdown())
+
+    async def shutdown(self):
+        await self.stop()
+        self.loop.stop()
+
+    async def stop(self, timeout=10):
+        """
+        Ask every worker to stop (so they write their state), and wait for them to.
+        """
+        self.stopping = True
+        if self.metrics_server:
+            self.metrics_server.close()
+            await self.metrics_server.wait_closed()
+        for worker in self.workers:
+            if worker.connection and not worker.connection.closed:
+                self.loop.remove_reader(worker.connection.fileno())
+                worker.connection.close()
+            if worker.process and worker.process.is_alive():
+                worker.process.terminate()
+        for worker in self.workers:
+            if worker.process:
+                await self.loop.run_in_executor(None, worker.process.join, timeout)
+                if worker.process.is_alive():
+                    LOGGER.error('Shard %s (pid %s) did not stop: killing it', worker.shard, worker.process.pid)
+                    worker.process.kill()
@@ -0,0 +1,57 @@
+import asyncio
+import logging
+
+from paho.mqtt import client as mqtt
+
+LOGGER = logging.getLogger(__name__)
+
+
+class AsyncioTransport:
+    """
+    Drive a paho client's socket from an asyncio event loop, instead of the thread
+    that loop_start() creates.
+
+    Messages are then handled on the same loop as HAP, so characteristic changes
+    do not need to cross threads.
+    """
+    def __init__(self, client, loop, interval=1):
+        self.client = client
+        self.loop = loop
+        self.interval = interval
+        self._task = None
+        client.on_socket_open = self.on_socket_open
+        client.on_socket_close = self.on_socket_close
+        client.on_socket_register_write = self.on_socket_register_write
+        client.on_socket_unregister_write = self.on_socket_unregister_write
+
+    def on_socket_open(self, client, userdata, sock):
+        self.loop.add_reader(sock, client.loop_read)
+
+    def on_socket_close(self, client, userdata, sock):
+        self.loop.remove_reader(sock)
+
+    def on_socket_register_write(self, client, userdata, sock):
+        self.loop.add_writer(sock, client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self.loop.remove_writer(sock)
+
+    def start(self):
+        self._task = self.loop.create_task(self._misc_loop())
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        self.client.disconnect()
+
+    async def _misc_loop(self):
+        # Keepalive pings and retries; and reconnecting if we lose the broker, which
+        # loop_start() would otherwise handle for us.
+        while True:
+            if self.client.loop_misc() == mqtt.MQTT_ERR_NO_CONN:
+                try:
+                    self.client.reconnect()
+                except OSError as exc:
+                    LOGGER.warning('Unable to reconnect to MQTT Broker: %s', exc)
+            await asyncio.sleep(self.interval)
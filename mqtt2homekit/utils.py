@@ -2,6 +2,10 @@ import re
 
 TITLE_CASE = re.compile(r'(\S)([A-Z][a-z])')
 
+ONE_MINUTE = 60
+ONE_HOUR = ONE_MINUTE * 60
+ONE_DAY = ONE_HOUR * 24
+
 
 def display_name(title_case):
     return TITLE_CASE.sub(r'\1 \2', title_case)
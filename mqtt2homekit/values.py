@@ -0,0 +1,94 @@
+import json
+import logging
+import os
+import tempfile
+import threading
+
+LOGGER = logging.getLogger(__name__)
+
+# Rewrite the journal as a single line once it has this many.
+COMPACT_AFTER = 100
+
+
+class ValueStore:
+    """
+    The last payload we saw (or sent) for each topic, so that characteristics have their
+    last known values when we start, rather than defaults.
+
+    The file is a journal: each flush appends one line, with just the topics that have
+    changed since the last one (null for a topic we have forgotten). Every so often (and
+    when we load it) it is compacted, by rewriting it as a single line. If we crash in the
+    middle of a flush, the partial line is ignored.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.payloads = {}
+        self._changed = {}
+        self._lines = 0
+        self._lock = threading.Lock()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return self.payloads
+        with open(self.path) as fp:
+            for line in fp:
+                try:
+                    changes = json.loads(line)
+                except ValueError:
+                    LOGGER.warning('Ignoring incomplete line in %s', self.path)
+                    break
+                for topic, payload in changes.items():
+                    if payload is None:
+                        self.payloads.pop(topic, None)
+                    else:
+                        self.payloads[topic] = payload
+        self.compact()
+        return self.payloads
+
+    def changed(self, topic, payload):
+        with self._lock:
+            self.payloads[topic] = payload
+            self._changed[topic] = payload
+
+    def forget(self, prefix):
+        """
+        Forget prefix, and every topic under it.
+        """
+        with self._lock:
+            under = prefix + '/'
+            for topic in [topic for topic in self.payloads if topic == prefix or topic.startswith(under)]:
+                del self.payloads[topic]
+                self._changed[topic] = None
+
+    def flush(self):
+        with self._lock:
+            if not self._changed:
+                return
+            changed, self._changed = self._changed, {}
+            if self._lines >= COMPACT_AFTER:
+                payloads = dict(self.payloads)
+            else:
+                payloads = None
+        if payloads is not None:
+            self._write(payloads)
+            return
+        with open(self.path, 'a') as fp:
+            fp.write(json.dumps(changed, separators=(',', ':')) + '\n')
+        self._lines += 1
+
+    def compact(self):
+        with self._lock:
+            self._changed = {}
+            payloads = dict(self.payloads)
+        self._write(payloads)
+
+    def _write(self, payloads):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        with tempfile.NamedTemporaryFile('w', dir=directory, delete=False) as fp:
+            try:
+                fp.write(json.dumps(payloads, separators=(',', ':')) + '\n')
+            except Exception:
+                os.unlink(fp.name)
+                raise
+        os.replace(fp.name, self.path)
+        self._lines = 1
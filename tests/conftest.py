@@ -1,13 +1,27 @@
+import os
+import shutil
 import tempfile
 from unittest.mock import PropertyMock
 
 import pytest
 
-from mqtt2homekit.bridge import MQTTBridge
+
+def pytest_configure(config):
+    # The loader caches the types (see loader.cache_file) when it is imported: keep that out of
+    # the real cache. This runs before the tests (and so mqtt2homekit) are imported, which is
+    # why the fixtures below import MQTTBridge themselves.
+    config._cache_home = tempfile.mkdtemp(prefix='mqtt2homekit-tests-')
+    os.environ['XDG_CACHE_HOME'] = config._cache_home
+
+
+def pytest_unconfigure(config):
+    shutil.rmtree(config._cache_home, ignore_errors=True)
 
 
 @pytest.fixture
 def bridge(mocker):
+    from mqtt2homekit.bridge import MQTTBridge
+
     mocker.patch('pyhap.accessory_driver.AccessoryDriver.update_advertisement')
     bridge = MQTTBridge(
         display_name='Test Bridge',
@@ -17,3 +31,23 @@ def bridge(mocker):
     )
     bridge.client = PropertyMock()
     return bridge
+
+
+@pytest.fixture
+def build_bridge(mocker, tmp_path):
+    """
+    Build bridges that don't touch the network: their state is in tmp_path, unless they are
+    given another persist_file.
+    """
+    from mqtt2homekit.bridge import MQTTBridge
+
+    mocker.patch('pyhap.accessory_driver.AccessoryDriver.update_advertisement')
+
+    def build(persist_file=None, **kwargs):
+        bridge = MQTTBridge(
+            display_name='Bridge', persist_file=persist_file or str(tmp_path / 'bridge.state'), mqtt_server=None,
+            prefix='__TEST__', **kwargs,
+        )
+        bridge.client = mocker.MagicMock()
+        return bridge
+    return build
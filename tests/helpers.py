@@ -0,0 +1,8 @@
+from paho.mqtt.client import MQTTMessage
+
+
+class Message(MQTTMessage):
+    def __init__(self, topic=b'', payload=b'', retain=False):
+        super().__init__(topic=topic.encode() if isinstance(topic, str) else topic)
+        self.payload = payload
+        self.retain = retain
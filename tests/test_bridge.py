@@ -1,13 +1,12 @@
+import time
+
 import pyhap.accessory_driver
 from paho.mqtt.client import MQTTMessage
 
 from mqtt2homekit.accessory import Accessory
-
-
-class Message(MQTTMessage):
-    def __init__(self, topic=b'', payload=b''):
-        super().__init__(topic=topic)
-        self.payload = payload
+from mqtt2homekit.bridge import parse_topic
+from mqtt2homekit.utils import ONE_DAY, ONE_HOUR
+from tests.helpers import Message
 
 
 def test_config_changed(bridge):
@@ -59,6 +58,85 @@ def test_handle_mqtt_messages(bridge, mocker):
     assert not bridge.accessories
 
 
+def test_parse_topic():
+    assert parse_topic('HomeKit/Foo/Lightbulb/On') == ('Foo', 'Lightbulb', 0, 'On')
+    assert parse_topic('HomeKit/Foo/Lightbulb/2/On') == ('Foo', 'Lightbulb', 2, 'On')
+    assert parse_topic('HomeKit/Foo/Lightbulb/two/On') is None
+    # A whole service.
+    assert parse_topic('HomeKit/Foo/Lightbulb') == ('Foo', 'Lightbulb', 0, None)
+    assert parse_topic('HomeKit/Foo/Lightbulb/1') == ('Foo', 'Lightbulb', 1, None)
+    assert parse_topic('HomeKit/Foo') is None
+    assert parse_topic('HomeKit/Foo/Lightbulb/0/On/extra') is None
+
+
+def test_malformed_topics_are_ignored(bridge):
+    bridge.handle_mqtt_message(None, None, Message(topic=b'__TEST__/Foo/Lightbulb/two/On', payload=b'1'))
+    bridge.handle_mqtt_message(None, None, Message(topic=b'__TEST__/Foo/Lightbulb/0/On/extra', payload=b'1'))
+    assert not bridge.accessories
+
+
+def test_bulk(bridge, mocker):
+    topic = b'__TEST__/Foo/Lightbulb'
+    bridge.handle_mqtt_message(None, None, Message(topic=topic, payload=b'{"On": 1, "Brightness": 50}'))
+    # Not unless it is enabled.
+    assert not bridge.accessories
+
+    bridge.bulk = True
+    assert ('__TEST__/+/+', 1) in bridge.topics()
+    publish = mocker.patch.object(bridge.driver, 'publish')
+    bridge.handle_mqtt_message(None, None, Message(topic=topic, payload=b'{"On": true, "Brightness": 50}'))
+    lightbulb = bridge.get_accessory('Foo').get_service('Lightbulb')
+    assert lightbulb.get_characteristic('On').value == 1
+    assert lightbulb.get_characteristic('Brightness').value == 50
+    assert publish.call_count == 2
+
+    # Only the characteristics that changed are sent.
+    publish.reset_mock()
+    get_or_create_accessory = mocker.spy(bridge, 'get_or_create_accessory')
+    bridge.handle_mqtt_message(None, None, Message(topic=topic, payload=b'{"On": 1, "Brightness": "60"}'))
+    assert lightbulb.get_characteristic('Brightness').value == 60
+    assert [call.args[0]['value'] for call in publish.call_args_list] == [60]
+    # Each characteristic is routed as if it had its own topic.
+    assert set(bridge._routes) == {'__TEST__/Foo/Lightbulb/On', '__TEST__/Foo/Lightbulb/Brightness'}
+    # They can also be mixed with single characteristic topics.
+    bridge.handle_mqtt_message(None, None, Message(topic=b'__TEST__/Foo/Lightbulb/On', payload=b'0'))
+    assert lightbulb.get_characteristic('On').value == 0
+    assert get_or_create_accessory.call_count == 1
+
+    # With an index.
+    bridge.handle_mqtt_message(None, None, Message(topic=b'__TEST__/Foo/Lightbulb/1', payload=b'{"On": 1}'))
+    assert bridge.get_accessory('Foo').get_service('Lightbulb', 1).get_characteristic('On').value == 1
+
+    error = mocker.patch('mqtt2homekit.bridge.LOGGER.error')
+    bridge.handle_mqtt_message(None, None, Message(topic=topic, payload=b'[1, 2]'))
+    bridge.handle_mqtt_message(None, None, Message(topic=topic, payload=b'{"On": 1, "Nonsense": 1, "Brightness": 70}'))
+    assert error.call_count == 2
+    assert lightbulb.get_characteristic('Brightness').value == 70
+    assert bridge.values.payloads['__TEST__/Foo/Lightbulb/Brightness'] == '70'
+
+    bridge.handle_mqtt_message(None, None, Message(topic=topic, payload=b''))
+    assert not bridge.accessories
+
+
+def test_ignore_unknown(bridge, mocker):
+    error = mocker.patch('mqtt2homekit.bridge.LOGGER.error')
+    bridge.handle_mqtt_message(None, None, Message(topic=b'__TEST__/Foo/Junk/On', payload=b'1'))
+    # Without ignore_unknown, we try (and fail) to create it.
+    error.assert_called_once()
+
+    bridge.ignore_unknown = True
+    get_or_create_accessory = mocker.spy(bridge, 'get_or_create_accessory')
+    bridge.handle_mqtt_message(None, None, Message(topic=b'__TEST__/Foo/Junk/On', payload=b'1'))
+    bridge.handle_mqtt_message(None, None, Message(topic=b'__TEST__/Foo/Lightbulb/Junk', payload=b'1'))
+    get_or_create_accessory.assert_not_called()
+    error.assert_called_once()
+
+    # Nor can they remove accessories.
+    bridge.handle_mqtt_message(None, None, Message(topic=b'__TEST__/Foo/Lightbulb/On', payload=b'1'))
+    bridge.handle_mqtt_message(None, None, Message(topic=b'__TEST__/Foo/Junk/On', payload=b''))
+    assert bridge.get_accessory('Foo')
+
+
 def test_accessory_with_multiple_services(bridge, mocker):
     mocker.patch('mqtt2homekit.accessory.Accessory.set_characteristic')
     bridge.handle_mqtt_message(None, None, Message(topic=b'__TEST__/Foo/Lightbulb/3/On', payload=b'1'))
@@ -97,3 +175,155 @@ def test_setting_characteristics_multiple_services(bridge, mocker):
 def test_setting_Accessory(bridge):
     name = bridge.get_service('AccessoryInformation').get_characteristic('Name')
     name.client_update_value('Renamed')
+
+
+def test_accessory_index(bridge):
+    bulb = bridge.get_or_create_accessory('Foo', 'Lightbulb')
+    assert bridge.get_accessory('Foo') is bulb
+
+    # Adding a service removes and re-adds the accessory: it must still be in the index.
+    bridge.get_or_create_accessory('Foo', 'TemperatureSensor')
+    assert bridge.get_accessory('Foo') is bulb
+
+    bridge.get_or_create_accessory('Bar', 'Switch')
+    bridge.get_accessory('Bar')._last_seen = time.time()
+    bridge.expire(time.time() + ONE_DAY * 29)
+    assert bridge.get_accessory('Bar') is None
+    assert bridge.get_accessory('Foo') is bulb
+
+    bridge.remove_accessory('Foo')
+    assert bridge.get_accessory('Foo') is None
+
+
+def test_routing_cache(bridge, mocker):
+    topic = b'__TEST__/Foo/TemperatureSensor/CurrentTemperature'
+    bridge.handle_mqtt_message(None, None, Message(topic=topic, payload=b'21.5'))
+    route = bridge._routes[topic.decode()]
+    characteristic = route.characteristic
+    # The route is also how values from HomeKit are sent back to the topic.
+    assert characteristic.setter_callback is route
+    assert characteristic.value == 21.5
+
+    # Repeated messages do not need to find the accessory again.
+    get_or_create_accessory = mocker.patch.object(bridge, 'get_or_create_accessory')
+    bridge.handle_mqtt_message(None, None, Message(topic=topic, payload=b'22'))
+    get_or_create_accessory.assert_not_called()
+    assert characteristic.value == 22.0
+    mocker.stop(get_or_create_accessory)
+
+    # Changing the services of the accessory drops the routes.
+    bridge.get_or_create_accessory('Foo', 'HumiditySensor')
+    assert not bridge._routes
+
+    bridge.handle_mqtt_message(None, None, Message(topic=topic, payload=b'23'))
+    assert bridge._routes
+    bridge.remove_accessory('Foo')
+    assert not bridge._routes
+
+
+# A recorded trace from a DS18B20 temperature sensor: it republishes every reading, changed or not.
+TEMPERATURE_TRACE = [
+    b'21.5', b'21.5', b'21.5', b'21.5625', b'21.5', b'21.5', b'21.625', b'21.5625', b'21.625',
+    b'21.6875', b'21.75', b'21.75', b'21.8125', b'21.75', b'21.875', b'22', b'22', b'22.0625',
+]
+
+
+def count_notifications(bridge, mocker, trace):
+    publish = mocker.patch.object(bridge.driver, 'publish')
+    for payload in trace:
+        bridge.handle_mqtt_message(None, None, Message(
+            topic=b'__TEST__/Foo/TemperatureSensor/CurrentTemperature',
+            payload=payload,
+        ))
+    return publish.call_count
+
+
+def test_unchanged_values_are_not_sent(bridge, mocker):
+    # pyhap rounds to the characteristic's minStep (0.1), so only 9 of these are changes.
+    assert count_notifications(bridge, mocker, TEMPERATURE_TRACE) == 9
+    assert bridge.get_accessory('Foo')._last_seen
+
+
+def test_deadband(bridge, mocker):
+    mocker.patch.dict('mqtt2homekit.accessory.DEADBANDS', {'TemperatureSensor': {'float': 0.25}})
+    # 21.5, 21.75, 22.0
+    assert count_notifications(bridge, mocker, TEMPERATURE_TRACE) == 3
+
+
+def test_outbound_topic_is_bound(bridge):
+    bulb = bridge.get_or_create_accessory('Foo', 'Lightbulb')
+    on = bulb.get_service('Lightbulb').get_characteristic('On')
+    assert on.setter_callback.topic == '__TEST__/Foo/Lightbulb/On'
+
+    # Once there are more services of this type, the topics include the index.
+    bridge.get_or_create_accessory('Foo', 'Lightbulb', index=1)
+    assert on.setter_callback.topic == '__TEST__/Foo/Lightbulb/0/On'
+    on.client_update_value(0)
+    bridge.client.publish.assert_called_once_with('__TEST__/Foo/Lightbulb/0/On', b'0', qos=2, retain=True)
+
+
+def test_expire(bridge, mocker):
+    now = time.time()
+    temperature = bridge.get_or_create_accessory('Temperature', 'TemperatureSensor')
+    temperature._last_seen = now
+    switch = bridge.get_or_create_accessory('Switch', 'Switch')
+    switch._last_seen = now
+    no_response = mocker.spy(Accessory, 'no_response')
+
+    bridge.expire(now + ONE_HOUR / 2)
+    no_response.assert_not_called()
+
+    # Only the sensor is flagged, and only once.
+    bridge.expire(now + ONE_HOUR + 1)
+    no_response.assert_called_once_with(temperature)
+    assert temperature.not_responding
+    bridge.expire(now + ONE_HOUR * 3)
+    no_response.assert_called_once_with(temperature)
+
+    # Until it has been seen again.
+    temperature._last_seen = now + ONE_HOUR * 3
+    assert not temperature.not_responding
+    bridge.expire(now + ONE_HOUR * 5)
+    assert no_response.call_count == 2
+
+    switch._last_seen = now + ONE_DAY * 2
+    bridge.expire(now + ONE_DAY * 29)
+    assert bridge.get_accessory('Temperature') is None
+    assert bridge.get_accessory('Switch') is switch
+    bridge.expire(now + ONE_DAY * 31)
+    assert not bridge.accessories
+
+
+def test_expire_reused_accessory_id(bridge):
+    now = time.time()
+    bridge.handle_mqtt_message(None, None, Message(b'__TEST__/Foo/TemperatureSensor/CurrentTemperature', b'20'))
+    bridge.handle_mqtt_message(None, None, Message(b'__TEST__/Foo/TemperatureSensor/CurrentTemperature', b''))
+    # It comes back as something that is never Not Responding.
+    bridge.handle_mqtt_message(None, None, Message(b'__TEST__/Foo/Switch/On', b'1'))
+    bridge.expire(now + ONE_HOUR + 1)
+    assert not bridge.get_accessory('Foo').not_responding
+    # Only its new removal is scheduled.
+    assert len(bridge._expiry) == 1
+    bridge.expire(now + ONE_DAY * 29)
+    assert bridge.get_accessory('Foo') is None
+
+
+def test_expire_only_checks_due_accessories(bridge, mocker):
+    now = time.time()
+    for i in range(100):
+        bridge.get_or_create_accessory('sensor-{}'.format(i), 'TemperatureSensor')._last_seen = now
+    get_accessory = mocker.spy(bridge, 'get_accessory')
+    bridge.expire(now + 60)
+    get_accessory.assert_not_called()
+
+
+def test_timeouts_by_service_type(bridge, mocker):
+    mocker.patch.dict('mqtt2homekit.accessory.UNSEEN_TIMEOUTS', {'Switch': 60})
+    mocker.patch.dict('mqtt2homekit.accessory.REMOVE_TIMEOUTS', {'Switch': 120})
+    now = time.time()
+    switch = bridge.get_or_create_accessory('Switch', 'Switch')
+    switch._last_seen = now
+    bridge.expire(now + 61)
+    assert switch.not_responding
+    bridge.expire(now + 121)
+    assert not bridge.accessories
@@ -0,0 +1,74 @@
+import shutil
+import sqlite3
+
+from mqtt2homekit.shards import persisted_accessory_ids, shard_persist_file
+from tests.helpers import Message
+
+
+def test_persist_and_load(tmp_path, build_bridge):
+    persist = 'sqlite:///{}'.format(tmp_path / 'bridge.db')
+    bridge = build_bridge(persist)
+    bridge.handle_mqtt_message(None, None, Message(b'__TEST__/Foo/Lightbulb/Brightness', b'50'))
+    bridge.handle_mqtt_message(None, None, Message(b'__TEST__/Bar/Switch/On', b'1'))
+    bridge.driver.persist()
+    bridge.values.flush()
+    assert (tmp_path / 'bridge.db').exists()
+    assert not (tmp_path / 'bridge.db.state').exists()
+
+    restored = build_bridge(persist)
+    assert restored.driver.state.mac == bridge.driver.state.mac
+    assert restored.driver.state.private_key.private_bytes_raw() == bridge.driver.state.private_key.private_bytes_raw()
+    foo = restored.get_accessory('Foo')
+    assert foo.aid == bridge.get_accessory('Foo').aid
+    assert foo.get_service('Lightbulb').get_characteristic('Brightness').value == 50
+    assert restored.get_accessory('Bar').get_service('Switch').get_characteristic('On').value == 1
+
+
+def test_only_changed_rows_are_written(mocker, tmp_path, build_bridge):
+    bridge = build_bridge('sqlite:///{}'.format(tmp_path / 'bridge.db'))
+    bridge.handle_mqtt_message(None, None, Message(b'__TEST__/Foo/Lightbulb/Brightness', b'50'))
+    bridge.handle_mqtt_message(None, None, Message(b'__TEST__/Bar/Switch/On', b'1'))
+    bridge.driver.persist()
+    save = mocker.spy(bridge.database, 'save')
+
+    # Seeing an accessory again doesn't rewrite it, unless it has been a while: and then only
+    # when we saw it is written.
+    bridge.handle_mqtt_message(None, None, Message(b'__TEST__/Foo/Lightbulb/Brightness', b'60'))
+    bridge.driver.persist()
+    assert save.spy_return == 0
+    bridge.get_accessory('Foo')._last_seen += 3600
+    bridge.driver.persist()
+    assert save.spy_return == len('Foo') + 8
+
+    bridge.handle_mqtt_message(None, None, Message(b'__TEST__/Bar/Switch/On', b''))
+    bridge.driver.persist()
+    connection = sqlite3.connect(str(tmp_path / 'bridge.db'))
+    assert connection.execute('SELECT accessory_id FROM accessories').fetchall() == [('Foo',)]
+    assert connection.execute('PRAGMA journal_mode').fetchone() == ('wal',)
+
+
+def test_migrate(tmp_path, build_bridge):
+    shutil.copy('tests/bridge_1.state', str(tmp_path / 'bridge.state'))
+    with open(str(tmp_path / 'bridge.state.values'), 'w') as fp:
+        fp.write('{"__TEST__/accessory_one/Lightbulb/Brightness": "30"}\n')
+    original = build_bridge(str(tmp_path / 'bridge.state'), values_interval=0)
+
+    bridge = build_bridge('sqlite:///{}'.format(tmp_path / 'bridge.db'))
+    assert bridge.driver.state.mac == original.driver.state.mac
+    assert bridge.driver.state.paired_clients == original.driver.state.paired_clients
+    assert sorted(bridge.accessories) == sorted(original.accessories)
+    brightness = bridge.get_accessory('accessory_one').get_service('Lightbulb').characteristics[1]
+    assert brightness.display_name == 'Brightness'
+    assert brightness.value == 30
+
+
+def test_shards(tmp_path, build_bridge):
+    persist = 'sqlite:///{}'.format(tmp_path / 'bridge.db')
+    assert shard_persist_file(persist, 2) == 'sqlite:///{}'.format(tmp_path / 'bridge.2.db')
+    assert shard_persist_file(persist, 'shards') == str(tmp_path / 'bridge.shards.json')
+
+    assert persisted_accessory_ids(persist) == []
+    bridge = build_bridge(persist)
+    bridge.handle_mqtt_message(None, None, Message(b'__TEST__/Foo/Lightbulb/Brightness', b'50'))
+    bridge.driver.persist()
+    assert persisted_accessory_ids(persist) == ['Foo']
@@ -0,0 +1,60 @@
+import asyncio
+
+import pytest
+
+from tests.helpers import Message
+
+
+@pytest.fixture
+def delayed_bridge(build_bridge):
+    return build_bridge(config_changed_delay=0.01)
+
+
+def test_config_changed_is_coalesced(delayed_bridge, mocker):
+    persist = mocker.patch.object(delayed_bridge.driver, 'persist')
+    config_version = delayed_bridge.driver.state.config_version
+
+    # A burst of retained messages for new accessories, like when the broker restarts.
+    for i in range(100):
+        topic = '__TEST__/sensor-{}/TemperatureSensor/CurrentTemperature'.format(i).encode()
+        delayed_bridge.handle_mqtt_message(None, None, Message(topic, b'20'))
+    assert len(delayed_bridge.accessories) == 100
+    persist.assert_not_called()
+
+    delayed_bridge.driver.loop.run_until_complete(asyncio.sleep(0.05))
+    persist.assert_called_once()
+    assert delayed_bridge.driver.state.config_version == config_version + 1
+
+    # Nothing is left pending.
+    delayed_bridge.driver.flush_config_changed()
+    persist.assert_called_once()
+
+
+def test_flush_config_changed(delayed_bridge, mocker):
+    persist = mocker.patch.object(delayed_bridge.driver, 'persist')
+    delayed_bridge.get_or_create_accessory('Foo', 'Lightbulb')
+    delayed_bridge.driver.flush_config_changed()
+    persist.assert_called_once()
+
+    # The scheduled call has already been handled.
+    delayed_bridge.driver.loop.run_until_complete(asyncio.sleep(0.05))
+    persist.assert_called_once()
+
+
+def test_config_changed_without_delay(bridge, mocker):
+    persist = mocker.patch.object(bridge.driver, 'persist')
+    bridge.get_or_create_accessory('Foo', 'Lightbulb')
+    persist.assert_called_once()
+
+
+def test_persist_is_atomic(bridge, mocker):
+    bridge.get_or_create_accessory('Foo', 'Lightbulb')
+    with open(bridge.persist_file) as fp:
+        before = fp.read()
+
+    mocker.patch.object(bridge.driver.encoder, 'encode_accessory', side_effect=ValueError)
+    with pytest.raises(ValueError):
+        bridge.driver.persist()
+
+    with open(bridge.persist_file) as fp:
+        assert fp.read() == before
@@ -1,4 +1,5 @@
 import json
+import os
 from io import StringIO
 from unittest.mock import MagicMock
 
@@ -13,18 +14,82 @@ def test_load_optional_characteristic():
 
 
 def test_persist(mocker):
-    mocker.patch('pyhap.encoder.AccessoryEncoder.persist')
-    mocker.patch('json.loads')
-    json.loads.return_value = {
-        'mac': '12:34:56:78:ab:cd',
-        'config_version': 1,
-        'paired_clients': [],
-        'private_key': 'b0167fb8-96ab-435b-b347-ee669cc410b8',
-        'public_key': '66504ec7-2a93-4e9a-a51b-cd007ae1792a',
-    }
+    def pyhap_persist(fp, state):
+        json.dump({
+            'mac': '12:34:56:78:ab:cd',
+            'config_version': 1,
+            'paired_clients': [],
+            'private_key': 'b0167fb8-96ab-435b-b347-ee669cc410b8',
+            'public_key': '66504ec7-2a93-4e9a-a51b-cd007ae1792a',
+        }, fp)
+
+    mocker.patch('pyhap.encoder.AccessoryEncoder.persist', side_effect=pyhap_persist)
     bridge = MagicMock()
     stream = StringIO()
     BridgeEncoder(bridge=bridge).persist(stream, bridge.state)
-    mocker.stopall()
     data = json.loads(stream.getvalue())
+    assert data['mac'] == '12:34:56:78:ab:cd'
     assert data['accessories'] == []
+
+
+def test_persist_accessories(bridge):
+    bulb = bridge.get_or_create_accessory('Foo', 'Lightbulb')
+    bulb.set_characteristic('Lightbulb', 0, 'Brightness', '50')
+    stream = StringIO()
+    bridge.driver.encoder.persist(stream, bridge.driver.state)
+    data = json.loads(stream.getvalue())
+    assert data['config_version'] == bridge.driver.state.config_version
+    assert data['accessories'] == [{
+        'accessory_id': 'Foo',
+        'name': 'Lightbulb',
+        'services': ['Lightbulb'],
+        'aid': bulb.aid,
+        'last_seen': None,
+        'optional_characteristics': {'Lightbulb': ['Brightness']},
+    }]
+
+
+def describe(bridge):
+    return {
+        accessory.accessory_id: (aid, accessory.display_name, accessory._last_seen, [
+            (service.display_name, accessory.iid_manager.get_iid(service), [
+                (characteristic.display_name, accessory.iid_manager.get_iid(characteristic), characteristic.value)
+                for characteristic in service.characteristics
+            ])
+            for service in accessory.services
+        ])
+        for aid, accessory in bridge.accessories.items()
+    }
+
+
+def test_snapshot(build_bridge, tmp_path):
+    persist_file = str(tmp_path / 'bridge.state')
+    bridge = build_bridge(fast_start=True)
+    bridge.get_or_create_accessory('Foo', 'Lightbulb')
+    bridge.get_or_create_accessory('Foo', 'Lightbulb', index=1)
+    foo = bridge.get_accessory('Foo')
+    # Optional characteristics, added in an order the state file does not record.
+    foo.set_characteristic('Lightbulb', 1, 'Brightness', '20')
+    foo.set_characteristic('Lightbulb', 0, 'Brightness', '50')
+    foo._last_seen = 1234.5
+    bridge.get_or_create_accessory('Bar', 'TemperatureSensor').set_characteristic(
+        'TemperatureSensor', 0, 'CurrentTemperature', '21.5',
+    )
+    bridge.driver.persist()
+    assert os.path.exists(persist_file + '.snapshot')
+
+    restored = build_bridge(fast_start=True)
+    assert describe(restored) == describe(bridge)
+    restored.get_accessory('Foo').get_service('Lightbulb').get_characteristic('On').client_update_value(1)
+    restored.client.publish.assert_called_once_with('__TEST__/Foo/Lightbulb/0/On', b'1', qos=2, retain=True)
+
+    # A snapshot that doesn't match the state file is ignored.
+    with open(persist_file) as fp:
+        state = json.load(fp)
+    state['snapshot'] = 'stale'
+    with open(persist_file, 'w') as fp:
+        json.dump(state, fp)
+    loaded = build_bridge(fast_start=True)
+    assert set(describe(loaded)) == {'Foo', 'Bar'}
+    # The state file does not have values.
+    assert loaded.get_accessory('Foo').get_service('Lightbulb').get_characteristic('Brightness').value == 0
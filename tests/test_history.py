@@ -0,0 +1,76 @@
+from mqtt2homekit.history import RingBuffer
+from tests.helpers import Message
+
+
+def test_ring_buffer_wraps():
+    buffer = RingBuffer(size=3, interval=10)
+    for timestamp in (100, 110, 125, 140):
+        buffer.append(timestamp, timestamp / 10)
+    assert len(buffer) == 3
+    assert list(buffer) == [(110, 11.0), (125, 12.5), (140, 14.0)]
+    assert buffer.first == 110
+    assert buffer.deltas.itemsize == 4 and buffer.values.itemsize == 4
+
+
+def test_ring_buffer_coalesces():
+    buffer = RingBuffer(size=3, interval=60)
+    buffer.append(100, 1)
+    buffer.append(130, 2)
+    # The clock going backwards doesn't reorder anything.
+    buffer.append(90, 3)
+    buffer.append(160, 4)
+    assert list(buffer) == [(100, 3.0), (160, 4.0)]
+
+
+def test_downsample():
+    buffer = RingBuffer(size=10, interval=1)
+    for timestamp, value in ((0, 1), (30, 3), (60, 5), (120, 7), (150, 9)):
+        buffer.append(timestamp, value)
+    assert buffer.downsample(60) == [(0, 2, 1.0, 3.0, 2.0), (60, 1, 5.0, 5.0, 5.0), (120, 2, 7.0, 9.0, 8.0)]
+    assert buffer.downsample(100, start=30, end=130) == [(30, 3, 3.0, 7.0, 5.0)]
+
+
+def test_dump_and_load():
+    buffer = RingBuffer(size=4, interval=1)
+    for timestamp in range(6):
+        buffer.append(timestamp * 2, timestamp)
+    first, deltas, values = buffer.dump()
+    assert len(deltas) == len(values) == 4 * 4
+    assert list(RingBuffer.load(buffer.dump(), 4, 1)) == list(buffer)
+    # A smaller buffer keeps the newest samples.
+    assert list(RingBuffer.load(buffer.dump(), 2, 1)) == list(buffer)[2:]
+
+
+def test_bridge_history(mocker, tmp_path, build_bridge):
+    time = mocker.patch('time.time', return_value=1000.0)
+    persist = str(tmp_path / 'bridge.state')
+    bridge = build_bridge(persist, history=['CurrentTemperature'])
+    topic = b'__TEST__/Foo/TemperatureSensor/CurrentTemperature'
+    for value in (b'20.5', b'21', b'22'):
+        bridge.handle_mqtt_message(None, None, Message(topic, value))
+        time.return_value += 60
+    bridge.handle_mqtt_message(None, None, Message(b'__TEST__/Foo/Lightbulb/Brightness', b'50'))
+    assert list(bridge.history.buffers) == ['__TEST__/Foo/TemperatureSensor/CurrentTemperature']
+    assert bridge.history.query(topic.decode(), 120) == [(960, 2, 20.5, 21.0, 20.75), (1080, 1, 22.0, 22.0, 22.0)]
+
+    # Changes from HomeKit are recorded too.
+    bridge.get_accessory('Foo').get_service('TemperatureSensor').get_characteristic(
+        'CurrentTemperature'
+    ).client_update_value(23)
+    bridge.driver.persist()
+    bridge.history.save()
+
+    restored = build_bridge(persist, history=['CurrentTemperature'])
+    assert list(restored.history.buffers[topic.decode()]) == [(1000, 20.5), (1060, 21.0), (1120, 22.0), (1180, 23.0)]
+
+    restored.handle_mqtt_message(None, None, Message(b'__TEST__/Foo/TemperatureSensor/CurrentTemperature', b''))
+    assert restored.history.buffers == {}
+
+
+def test_corrupt_history(tmp_path, build_bridge, caplog):
+    persist = str(tmp_path / 'bridge.state')
+    with open(persist + '.history', 'wb') as fp:
+        fp.write(b'not a pickle')
+    bridge = build_bridge(persist, history=['CurrentTemperature'])
+    assert bridge.history.buffers == {}
+    assert 'Unable to load history' in caplog.text
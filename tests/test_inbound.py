@@ -0,0 +1,112 @@
+import asyncio
+
+from mqtt2homekit.inbound import InboundQueue, is_lossless
+from tests.helpers import Message
+
+
+def test_is_lossless():
+    assert is_lossless('HomeKit/Foo/Switch/On')
+    assert is_lossless('HomeKit/Foo/StatelessProgrammableSwitch/ProgrammableSwitchEvent')
+    assert not is_lossless('HomeKit/Foo/Switch/NotACharacteristic')
+    assert not is_lossless('HomeKit/Foo/TemperatureSensor/CurrentTemperature')
+    assert not is_lossless('HomeKit/Foo/Outlet/Power')
+
+
+def test_latest_value_wins():
+    handled = []
+    queue = InboundQueue(handled.append, asyncio.new_event_loop(), rate=10)
+    for value in range(10):
+        queue.put(Message('HomeKit/Foo/TemperatureSensor/CurrentTemperature', str(value).encode()))
+        queue.put(Message('HomeKit/Bar/Outlet/Power', str(value).encode()))
+    assert queue.depth == 2
+    assert queue.coalesced == 18
+    queue.drain()
+    assert [(m.topic, m.payload) for m in handled] == [
+        ('HomeKit/Foo/TemperatureSensor/CurrentTemperature', b'9'),
+        ('HomeKit/Bar/Outlet/Power', b'9'),
+    ]
+
+
+def test_lossless_messages_are_kept():
+    handled = []
+    queue = InboundQueue(handled.append, asyncio.new_event_loop(), rate=10, maxsize=7)
+    for value in (b'1', b'2', b'1'):
+        queue.put(Message('HomeKit/Foo/StatelessProgrammableSwitch/ProgrammableSwitchEvent', value))
+    queue.put(Message('HomeKit/Foo/Switch/On', b'1'))
+    queue.put(Message('HomeKit/Foo/Switch/On', b'0'))
+    queue.put(Message('HomeKit/Foo/TemperatureSensor/CurrentTemperature', b'20'))
+    # The queue is full: this is the oldest one that may be dropped.
+    queue.put(Message('HomeKit/Foo/HumiditySensor/CurrentRelativeHumidity', b'50'))
+    queue.put(Message('HomeKit/Foo/TemperatureSensor/CurrentTemperature', b''))
+    assert queue.dropped == 1
+    assert queue.coalesced == 0
+    queue.drain()
+    assert [m.payload for m in handled] == [b'1', b'2', b'1', b'1', b'0', b'50', b'']
+
+
+def test_queue_is_bounded():
+    queue = InboundQueue(lambda message: None, asyncio.new_event_loop(), rate=10, maxsize=100)
+    for i in range(1000):
+        queue.put(Message('HomeKit/Foo-{}/Switch/NotACharacteristic'.format(i), b'1'))
+    assert queue.depth == 100
+    # Even messages that may not be replaced, when there is nothing else to drop.
+    for i in range(1000):
+        queue.put(Message('HomeKit/Foo-{}/Switch/On'.format(i), b'1'))
+    assert queue.depth == 100
+    assert queue.dropped == 1900
+
+
+def test_removal_is_not_overtaken():
+    handled = []
+    queue = InboundQueue(handled.append, asyncio.new_event_loop(), rate=10)
+    for value in (b'21', b'', b'22', b'23'):
+        queue.put(Message('HomeKit/Foo/TemperatureSensor/CurrentTemperature', value))
+    queue.drain()
+    assert [m.payload for m in handled] == [b'', b'23']
+
+
+def test_drains_at_rate():
+    loop = asyncio.new_event_loop()
+    handled = []
+    queue = InboundQueue(handled.append, loop, rate=20)
+    for i in range(10):
+        queue.put(Message('HomeKit/Foo-{}/TemperatureSensor/CurrentTemperature'.format(i), b'20'))
+    # Each 0.05s, we handle one message.
+    loop.run_until_complete(asyncio.sleep(0.12))
+    assert 1 <= len(handled) <= 3
+    loop.run_until_complete(asyncio.sleep(0.5))
+    assert len(handled) == 10
+    assert not queue.depth
+
+
+def drained(rate, seconds, count=100):
+    loop = asyncio.new_event_loop()
+    handled = []
+    queue = InboundQueue(handled.append, loop, rate=rate)
+    for i in range(count):
+        queue.put(Message('HomeKit/Foo-{}/TemperatureSensor/CurrentTemperature'.format(i), b'20'))
+    loop.run_until_complete(asyncio.sleep(seconds))
+    loop.close()
+    return len(handled)
+
+
+def test_drains_at_low_rate():
+    # One straight away, and then one every half a second.
+    assert 2 <= drained(2, 1.0) <= 3
+
+
+def test_drains_at_fractional_rate():
+    # Not 20 a second (one each interval), or 40 (two).
+    assert 14 <= drained(30, 0.5) <= 18
+
+
+def test_bridge_queue(bridge, mocker):
+    bridge.inbound = InboundQueue(
+        lambda message: bridge.handle_mqtt_message(None, None, message), bridge.driver.loop, rate=100,
+    )
+    topic = '__TEST__/Foo/TemperatureSensor/CurrentTemperature'
+    for value in range(10):
+        bridge.receive_mqtt_message(None, None, Message(topic, str(value).encode()))
+    assert not bridge.accessories
+    bridge.inbound.drain()
+    assert bridge.get_accessory('Foo')
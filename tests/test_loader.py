@@ -0,0 +1,66 @@
+import os
+
+from pyhap.loader import get_loader
+
+from mqtt2homekit.loader import load_types, loader, merge, path
+
+
+def test_contrib_types():
+    assert 'Voltage' in loader.service_type('Outlet').optional
+    assert loader.service_type('Inverter').required
+    assert loader.get_service('Weather').display_name == 'Weather'
+
+    # pyhap's own loader is left alone.
+    assert 'Voltage' not in get_loader().serv_types['Outlet']['OptionalCharacteristics']
+
+
+def test_metadata_is_cached():
+    assert loader.service_type('Lightbulb') is loader.service_type('Lightbulb')
+    assert loader.char_type('On') is loader.char_type('On')
+    assert loader.service_type('Lightbulb').required == ('On',)
+    assert 'Brightness' in loader.service_type('Lightbulb').optional
+
+
+def test_get_char():
+    char = loader.get_char('Brightness')
+    assert char.properties == loader.char_type('Brightness').properties
+    # Characteristics share their properties, until one of them overrides them.
+    other = loader.get_char('Brightness')
+    assert char.properties is other.properties
+    char.override_properties({'maxValue': 50})
+    assert char.properties['maxValue'] == 50
+    assert other.properties['maxValue'] == loader.char_type('Brightness').properties['maxValue'] == 100
+    assert loader.char_type('Brightness').coerce('25') == 25
+
+
+def test_merge():
+    existing = {'Foo': {'UUID': '1', 'RequiredCharacteristics': ['On'], 'OptionalCharacteristics': []}}
+    merged = merge(existing, {
+        'Foo': {'UUID': '1', 'OptionalCharacteristics': ['Brightness']},
+        'Bar': {'UUID': '2', 'RequiredCharacteristics': ['On']},
+    })
+    assert merged['Foo']['OptionalCharacteristics'] == ['Brightness']
+    assert merged['Bar']['UUID'] == '2'
+    assert existing['Foo']['OptionalCharacteristics'] == []
+
+
+def test_types_are_cached(tmp_path, monkeypatch, mocker):
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path))
+    built = load_types()
+    assert (tmp_path / 'mqtt2homekit' / 'types.pickle').exists()
+
+    merged = mocker.patch('mqtt2homekit.loader.get_loader', wraps=get_loader)
+    cached = load_types()
+    merged.assert_not_called()
+    assert cached.char_types == built.char_types
+    assert cached.serv_types == built.serv_types
+
+    # Changing one of the files means building them again.
+    contrib = sorted(path.glob('services.*.json'))[0]
+    stat = contrib.stat()
+    os.utime(contrib, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+    try:
+        load_types()
+    finally:
+        os.utime(contrib, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    merged.assert_called()
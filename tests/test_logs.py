@@ -0,0 +1,24 @@
+import json
+import logging
+
+from mqtt2homekit.logs import JSONFormatter, configure_logging
+
+
+def test_json_formatter():
+    record = logging.LogRecord('mqtt2homekit.bridge', logging.INFO, __file__, 1, 'REMOVE %s: %s', ('foo', 'bar'), None)
+    data = json.loads(JSONFormatter().format(record))
+    assert data['level'] == 'INFO'
+    assert data['logger'] == 'mqtt2homekit.bridge'
+    assert data['message'] == 'REMOVE foo: bar'
+
+
+def test_configure_logging():
+    root = logging.getLogger()
+    handlers, level = root.handlers[:], root.level
+    try:
+        configure_logging('WARNING', 'json')
+        assert root.level == logging.WARNING
+        assert isinstance(root.handlers[0].formatter, JSONFormatter)
+        assert not logging.getLogger('mqtt2homekit.bridge').isEnabledFor(logging.DEBUG)
+    finally:
+        root.handlers[:], root.level = handlers, level
@@ -0,0 +1,102 @@
+import asyncio
+
+import pytest
+
+from mqtt2homekit.metrics import Counter, Histogram, Registry, serve
+from tests.helpers import Message
+
+
+@pytest.fixture
+def metrics_bridge(build_bridge):
+    return build_bridge(metrics=True)
+
+
+def test_disabled_by_default(bridge):
+    assert bridge.metrics is None
+    assert bridge.driver.metrics is None
+    bridge.handle_mqtt_message(None, None, Message(b'__TEST__/foo/Lightbulb/On', b'1'))
+
+
+def test_render():
+    registry = Registry()
+    counter = registry.register(Counter('things_total', 'Things', 'kind'))
+    counter.inc('a')
+    counter.inc('a')
+    counter.inc('b"')
+    histogram = registry.register(Histogram('took_seconds', 'Time', buckets=(0.1, 1.0)))
+    histogram.observe(0.05)
+    histogram.observe(0.5)
+    histogram.observe(5)
+
+    assert registry.render().splitlines() == [
+        '# HELP things_total Things',
+        '# TYPE things_total counter',
+        'things_total{kind="a"} 2',
+        'things_total{kind="b\\""} 1',
+        '# HELP took_seconds Time',
+        '# TYPE took_seconds histogram',
+        'took_seconds_bucket{le="0.1"} 1',
+        'took_seconds_bucket{le="1.0"} 2',
+        'took_seconds_bucket{le="+Inf"} 3',
+        'took_seconds_count 3',
+        'took_seconds_sum 5.55',
+    ]
+
+
+def test_bridge_metrics(metrics_bridge):
+    metrics = metrics_bridge.metrics
+    assert metrics_bridge.driver.metrics is metrics
+
+    metrics_bridge.handle_mqtt_message(None, None, Message(b'__TEST__/foo/Lightbulb/On', b'1'))
+    metrics_bridge.handle_mqtt_message(None, None, Message(b'__TEST__/foo/Lightbulb/On', b'0'))
+    metrics_bridge.handle_mqtt_message(None, None, Message(b'__TEST__/bar/Switch/On', b'1'))
+    metrics_bridge.handle_mqtt_message(None, None, Message(b'__TEST__/bar/Switch', b'1'))
+
+    assert metrics.messages_in.values == {'Lightbulb': 2, 'Switch': 1}
+    assert metrics.messages_ignored.values == {None: 1}
+    assert metrics.routes.values == {'hit': 1, 'miss': 3}
+    assert metrics.config_changed.values == {None: 2}
+    assert metrics.persist_bytes.value > 0
+
+    characteristic = metrics_bridge.get_accessory('foo').get_service('Lightbulb').get_characteristic('On')
+    characteristic.client_update_value(1)
+    assert metrics.messages_out.values == {'Lightbulb': 1}
+
+    rendered = metrics.render()
+    assert 'mqtt2homekit_accessories 2\n' in rendered
+    assert 'mqtt2homekit_stale_accessories 0\n' in rendered
+    assert 'mqtt2homekit_handle_mqtt_message_seconds_count 4\n' in rendered
+    assert 'mqtt2homekit_send_mqtt_message_seconds_count 1\n' in rendered
+
+
+def test_serve():
+    registry = Registry()
+    registry.register(Counter('things_total', 'Things')).inc()
+
+    async def fetch():
+        server = await serve(registry, 0)
+        # Only to this machine, by default.
+        assert server.sockets[0].getsockname()[0] == '127.0.0.1'
+        port = server.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(b'GET /metrics HTTP/1.0\r\n\r\n')
+        response = await reader.read()
+        writer.close()
+        server.close()
+        await server.wait_closed()
+        return response
+
+    response = asyncio.run(fetch())
+    assert response.startswith(b'HTTP/1.0 200 OK\r\n')
+    assert response.endswith(b'\r\n\r\n' + registry.render().encode())
+
+
+def test_stop_closes_server(metrics_bridge):
+    async def run():
+        metrics_bridge.metrics_server = await serve(metrics_bridge.metrics, 0)
+        metrics_bridge.transport = None
+        await metrics_bridge.stop()
+        return metrics_bridge.metrics_server
+
+    server = metrics_bridge.driver.loop.run_until_complete(run())
+    assert not server.is_serving()
@@ -0,0 +1,116 @@
+import asyncio
+
+import pytest
+
+from tests.helpers import Message
+
+CLIENTS = [('192.168.1.2', 50001), ('192.168.1.3', 50002)]
+
+
+class Subscribed(dict):
+    """
+    Every controller is subscribed to every characteristic.
+    """
+    def __contains__(self, topic):
+        return True
+
+    def get(self, topic, default=None):
+        return set(CLIENTS)
+
+
+@pytest.fixture
+def build(mocker, build_bridge):
+    def build(**kwargs):
+        bridge = build_bridge(metrics=True, **kwargs)
+        driver = bridge.driver
+        driver.aio_stop_event = asyncio.Event()
+        driver.topics = Subscribed()
+        driver.http_server = mocker.MagicMock()
+        driver.http_server.push_event.return_value = True
+        return bridge
+    return build
+
+
+def send(bridge, topic, *payloads):
+    for payload in payloads:
+        bridge.handle_mqtt_message(None, None, Message(topic, payload))
+
+
+def pushed(bridge, client_addr=CLIENTS[0]):
+    return [
+        data['value']
+        for (data, client, *immediate), kwargs in bridge.driver.http_server.push_event.call_args_list
+        if client == client_addr
+    ]
+
+
+def wait(bridge, seconds):
+    bridge.driver.loop.run_until_complete(asyncio.sleep(seconds))
+
+
+def test_interval(build):
+    bridge = build(notify_interval=0.05)
+    send(bridge, b'__TEST__/Foo/TemperatureSensor/CurrentTemperature', b'20', b'21', b'22', b'23')
+    # The first change is sent, and the latest of the rest once the interval is up.
+    assert pushed(bridge) == [20]
+    wait(bridge, 0.1)
+    assert pushed(bridge) == [20, 23]
+    assert bridge.driver.notifications.suppressed.values == {'interval': 2}
+    assert 'mqtt2homekit_events_suppressed_total{reason="interval"} 2' in bridge.metrics.render()
+
+    # Switching things on and off is always sent straight away.
+    bridge.driver.http_server.push_event.reset_mock()
+    send(bridge, b'__TEST__/Bar/Lightbulb/On', b'1', b'0', b'1')
+    assert pushed(bridge) == [1, 0, 1]
+
+    # And so are changes made by a controller (except to that controller).
+    bridge.driver.http_server.push_event.reset_mock()
+    send(bridge, b'__TEST__/Bar/Lightbulb/Brightness', b'10')
+    brightness = bridge.get_accessory('Bar').get_service('Lightbulb').get_characteristic('Brightness')
+    brightness.client_update_value(40, CLIENTS[0])
+    brightness.client_update_value(50, CLIENTS[0])
+    assert pushed(bridge) == [10]
+    assert pushed(bridge, CLIENTS[1]) == [10, 40, 50]
+
+
+@pytest.mark.parametrize('kwargs', [{'notify_interval': 0.05}, {'notify_rate': 20, 'notify_burst': 1}])
+def test_bypass_drops_waiting(build, kwargs):
+    bridge = build(**kwargs)
+    send(bridge, b'__TEST__/Bar/Lightbulb/Brightness', b'10', b'20')
+    brightness = bridge.get_accessory('Bar').get_service('Lightbulb').get_characteristic('Brightness')
+    brightness.client_update_value(40, CLIENTS[0])
+    wait(bridge, 0.2)
+    # 20 was held back, and is older than 40: it isn't sent after it.
+    assert pushed(bridge) == [10]
+    assert pushed(bridge, CLIENTS[1]) == [10, 40]
+
+
+def test_rate(build):
+    bridge = build(notify_rate=20, notify_burst=2)
+    for i in range(4):
+        send(bridge, '__TEST__/Sensor{}/TemperatureSensor/CurrentTemperature'.format(i).encode(), b'20')
+    send(bridge, b'__TEST__/Sensor3/TemperatureSensor/CurrentTemperature', b'21')
+    # Each controller has its own bucket.
+    assert pushed(bridge, CLIENTS[0]) == pushed(bridge, CLIENTS[1]) == [20, 20]
+    wait(bridge, 0.2)
+    assert pushed(bridge, CLIENTS[0]) == pushed(bridge, CLIENTS[1]) == [20, 20, 20, 21]
+    assert bridge.driver.notifications.suppressed.values == {'rate': 2}
+
+
+def test_controller_gone(build, mocker):
+    bridge = build(notify_rate=20, notify_burst=1)
+    unsubscribe = mocker.patch.object(bridge.driver, 'async_subscribe_client_topic')
+    send(bridge, b'__TEST__/Foo/TemperatureSensor/CurrentTemperature', b'20')
+    bridge.driver.http_server.push_event.return_value = False
+    send(bridge, b'__TEST__/Foo/TemperatureSensor/CurrentTemperature', b'21')
+    wait(bridge, 0.1)
+    assert unsubscribe.call_count == 2
+    assert not bridge.driver.notifications._buckets
+    assert not bridge.driver.notifications._queued
+
+
+def test_disabled(build):
+    bridge = build()
+    assert bridge.driver.notifications is None
+    send(bridge, b'__TEST__/Foo/TemperatureSensor/CurrentTemperature', b'20', b'21', b'22')
+    assert pushed(bridge) == [20, 21, 22]
@@ -0,0 +1,107 @@
+import pytest
+
+from mqtt2homekit.payloads import TEXT, CodecRules, get_codec
+from tests.helpers import Message
+
+
+@pytest.mark.parametrize('spec,payload,value', [
+    ('text', b'21.5', '21.5'),
+    ('struct:<h/100', b'\x66\x08', 21.5),
+    ('struct:<f', b'\x00\x00\xac\x41', 21.5),
+    ('struct:B', b'\x01', 1),
+    ('cbor', b'\xf9\x4d\x60', 21.5),
+    ('cbor', b'\x18\x64', 100),
+    ('cbor', b'\x38\x63', -100),
+    ('cbor', b'\xf5', True),
+    ('cbor', b'\x63abc', 'abc'),
+    ('msgpack', b'\xca\x41\xac\x00\x00', 21.5),
+    ('msgpack', b'\x64', 100),
+    ('msgpack', b'\xd0\x9c', -100),
+    ('msgpack', b'\xc3', True),
+    ('msgpack', b'\xa3abc', 'abc'),
+    ('msgpack', b'\xcd\x01\x00', 256),
+])
+def test_codecs(spec, payload, value):
+    codec = get_codec(spec)
+    assert codec.decode(payload) == value
+    assert codec.encode(value) == payload
+
+
+@pytest.mark.parametrize('spec,payload', [
+    ('struct:<h', b'\x01'),
+    ('cbor', b'\x18\x64\x00'),
+    ('cbor', b'\x80'),
+    ('msgpack', b'\x90'),
+])
+def test_invalid_payloads(spec, payload):
+    with pytest.raises(Exception):
+        get_codec(spec).decode(payload)
+
+
+def test_rules():
+    rules = CodecRules([
+        ('__TEST__/garden-*', 'struct:<h/100'),
+        ('*/CurrentTemperature', 'cbor'),
+        ('__TEST__/Foo/Switch/On', 'msgpack'),
+    ])
+    assert rules.select('__TEST__/garden-1/TemperatureSensor/CurrentTemperature').name == 'struct:<h/100.0'
+    assert rules.select('__TEST__/Foo/TemperatureSensor/CurrentTemperature').name == 'cbor'
+    assert rules.select('__TEST__/Foo/Switch/On').name == 'msgpack'
+    assert rules.select('__TEST__/Foo/Lightbulb/On') is TEXT
+    with pytest.raises(ValueError):
+        CodecRules([('__TEST__/*/On', 'cbor')])
+    with pytest.raises(ValueError):
+        CodecRules([('*', 'struct:<hh')])
+    with pytest.raises(ValueError):
+        CodecRules([('*', 'struct:zz')])
+
+
+def test_bridge_codecs(build_bridge):
+    bridge = build_bridge(codecs=[('*/CurrentTemperature', 'struct:<h/100'), ('*/On', 'cbor')])
+    topic = b'__TEST__/Foo/TemperatureSensor/CurrentTemperature'
+    bridge.handle_mqtt_message(None, None, Message(topic, b'\x66\x08'))
+    temperature = bridge.get_accessory('Foo').get_service('TemperatureSensor').get_characteristic('CurrentTemperature')
+    assert temperature.value == 21.5
+    assert bridge._routes[topic.decode()].codec.name == 'struct:<h/100.0'
+    bridge.handle_mqtt_message(None, None, Message(topic, b'\xd0\x07'))
+    assert temperature.value == 20.0
+    # The values are kept as text, whatever the payload was.
+    assert bridge.values.payloads[topic.decode()] == '20.0'
+
+    bridge.handle_mqtt_message(None, None, Message(b'__TEST__/Foo/Lightbulb/Brightness', b'50'))
+    bridge.handle_mqtt_message(None, None, Message(b'__TEST__/Foo/Lightbulb/On', b'\xf5'))
+    lightbulb = bridge.get_accessory('Foo').get_service('Lightbulb')
+    assert lightbulb.get_characteristic('Brightness').value == 50
+    assert lightbulb.get_characteristic('On').value == 1
+
+    lightbulb.get_characteristic('On').client_update_value(False)
+    bridge.client.publish.assert_called_once_with('__TEST__/Foo/Lightbulb/On', b'\x00', qos=2, retain=True)
+    assert bridge.values.payloads['__TEST__/Foo/Lightbulb/On'] == '0'
+
+
+def test_skip_retained(mocker, build_bridge):
+    bridge = build_bridge(codecs=[('*/CurrentTemperature', 'struct:<h')], skip_retained=True)
+    handle = mocker.spy(bridge, 'handle_mqtt_message')
+    text = b'__TEST__/Foo/Lightbulb/Brightness'
+    binary = b'__TEST__/Bar/TemperatureSensor/CurrentTemperature'
+    bridge.receive_mqtt_message(None, None, Message(text, b'50'))
+    bridge.receive_mqtt_message(None, None, Message(binary, b'12'))
+    assert bridge.values.payloads[binary.decode()] == '12849'
+
+    # The text payload is the same, so it is skipped: but a binary payload is never compared
+    # with the text we keep.
+    bridge.values.payloads[binary.decode()] = '12'
+    bridge.receive_mqtt_message(None, None, Message(text, b'50', retain=True))
+    bridge.receive_mqtt_message(None, None, Message(binary, b'12', retain=True))
+    assert handle.call_count == 3
+
+
+def test_codec_for_inbound_topic(build_bridge):
+    bridge = build_bridge(codecs=[('__TEST__/Foo/Lightbulb/0/Brightness', 'struct:B')])
+    topic = b'__TEST__/Foo/Lightbulb/0/Brightness'
+    bridge.handle_mqtt_message(None, None, Message(topic, b'\x32'))
+    bridge.handle_mqtt_message(None, None, Message(topic, b'\x3c'))
+    brightness = bridge.get_accessory('Foo').get_service('Lightbulb').get_characteristic('Brightness')
+    assert brightness.value == 60
+    brightness.client_update_value(70)
+    bridge.client.publish.assert_called_once_with('__TEST__/Foo/Lightbulb/Brightness', b'\x46', qos=2, retain=True)
@@ -0,0 +1,33 @@
+import json
+
+from benchmarks import replay
+
+
+def test_synthetic_trace():
+    trace = replay.synthetic_trace('__TEST__', 2, 2, 100, 0.05)
+    assert trace == [
+        (0.0, '__TEST__/device-0/Lightbulb/On', '0'),
+        (0.01, '__TEST__/device-0/Lightbulb/Brightness', '1'),
+        (0.02, '__TEST__/device-1/Lightbulb/On', '0'),
+        (0.03, '__TEST__/device-1/Lightbulb/Brightness', '1'),
+        (0.04, '__TEST__/device-0/Lightbulb/On', '1'),
+    ]
+
+
+def test_replay(tmp_path, capsys):
+    trace_file = str(tmp_path / 'trace.jsonl')
+    output = str(tmp_path / 'results.json')
+    replay.write_trace(trace_file, replay.synthetic_trace('__TEST__', 3, 2, 500, 0.2))
+    replay.main(['--trace', trace_file, '--writes', '20', '--config-delay', '0', '--output', output])
+    with open(output) as fp:
+        results = json.load(fp)
+    assert json.loads(capsys.readouterr().out) == results
+    assert results['messages'] == results['inbound']['published'] == 100
+    assert results['inbound']['handled'] == 100
+    assert results['inbound']['latency']['p99_ms'] > 0
+    assert results['outbound']['published'] == results['outbound']['written'] > 0
+    assert results['accessories'] == 3
+    # Each new accessory changes the configuration, and so does adding Brightness to it.
+    assert results['config_changed'] == results['persist'] == 6
+    assert results['max_rss_bytes'] > 0
+    assert not results['timed_out']
@@ -0,0 +1,126 @@
+import json
+import os
+
+import pytest
+
+from benchmarks.broker import FakeBroker
+from benchmarks.utils import wait_for
+from mqtt2homekit import shards
+from mqtt2homekit.shards import ShardedBridges, ShardTable, shard_persist_file
+from tests.helpers import Message
+
+
+@pytest.fixture
+def sharded(mocker, tmp_path):
+    mocker.patch('pyhap.accessory_driver.AccessoryDriver.update_advertisement')
+    mocker.patch('signal.signal')
+
+    def build(count=3, **kwargs):
+        kwargs.setdefault('mqtt_server', 'mqtt://127.0.0.1:1883')
+        return ShardedBridges('Test Bridge', count, persist_file=str(tmp_path / 'bridge.state'),
+                              prefix='__TEST__', **kwargs)
+    return build
+
+
+def test_shard_persist_file():
+    assert shard_persist_file('/tmp/bridge.state', 0) == '/tmp/bridge.state'
+    assert shard_persist_file('/tmp/bridge.state', 2) == '/tmp/bridge.2.state'
+
+
+def test_table_is_stable(tmp_path):
+    path = str(tmp_path / 'table')
+    table = ShardTable(path, 4)
+    assigned = {'accessory-{}'.format(i): table.shard_for('accessory-{}'.format(i)) for i in range(100)}
+    assert len(set(assigned.values())) == 4
+
+    # Even with a different number of shards, nothing moves.
+    table = ShardTable(path, 6)
+    assert {accessory_id: table.shard_for(accessory_id) for accessory_id in assigned} == assigned
+    with open(path) as fp:
+        assert json.load(fp) == assigned
+
+
+def test_table_shrinks(tmp_path):
+    path = str(tmp_path / 'table')
+    with open(path, 'w') as fp:
+        json.dump({'Foo': 2, 'Bar': 1}, fp)
+    table = ShardTable(path, 2)
+    assert table.assignments['Bar'] == 1
+    assert table.shard_for('Foo') in (0, 1)
+    with open(path) as fp:
+        assert json.load(fp) == table.assignments
+
+
+def test_table_skips_full_shards(tmp_path, mocker):
+    mocker.patch.object(shards, 'MAX_ACCESSORIES', 2)
+    table = ShardTable(str(tmp_path / 'table'), 2)
+    assigned = [table.shard_for('accessory-{}'.format(i)) for i in range(4)]
+    assert sorted(assigned) == [0, 0, 1, 1]
+
+
+def test_messages_go_to_one_shard(sharded):
+    bridges = sharded()
+    assert len({bridge.port for bridge in bridges.bridges}) == 3
+    assert len({bridge.driver.loop for bridge in bridges.bridges}) == 1
+    assert len({bridge.client for bridge in bridges.bridges}) == 1
+
+    for i in range(30):
+        topic = '__TEST__/accessory-{}/Switch/On'.format(i).encode()
+        bridges.receive_mqtt_message(bridges.client, None, Message(topic, b'1'))
+
+    counts = [len(bridge.accessories) for bridge in bridges.bridges]
+    assert sum(counts) == 30
+    assert all(counts)
+    for i in range(30):
+        accessory_id = 'accessory-{}'.format(i)
+        assert bridges.bridge_for(accessory_id).get_accessory(accessory_id)
+
+    # Removing one we have never seen does not assign it a shard.
+    bridges.receive_mqtt_message(bridges.client, None, Message(b'__TEST__/unknown/Switch/On', b''))
+    assert 'unknown' not in bridges.table.assignments
+
+
+def test_unknown_types_are_not_assigned(sharded):
+    bridges = sharded(2, ignore_unknown=True)
+    for topic in (b'__TEST__/junk/NotAService/On', b'__TEST__/junk/Switch/NotACharacteristic', b'__TEST__/junk/a/b/c'):
+        bridges.receive_mqtt_message(bridges.client, None, Message(topic, b'1'))
+    assert 'junk' not in bridges.table.assignments
+    bridges.receive_mqtt_message(bridges.client, None, Message(b'__TEST__/junk/Switch/On', b'1'))
+    assert bridges.bridge_for('junk').get_accessory('junk')
+
+
+def test_existing_accessories_stay_put(sharded, tmp_path):
+    bridges = sharded(1)
+    bridges.receive_mqtt_message(bridges.client, None, Message(b'__TEST__/Foo/Switch/On', b'1'))
+    bridges.bridges[0].driver.persist()
+    os.unlink(str(tmp_path / 'bridge.shards.state'))
+
+    # The table is rebuilt from the state file: Foo stays on the first bridge.
+    bridges = sharded(5)
+    assert bridges.table.assignments == {'Foo': 0}
+    assert bridges.bridges[0].get_accessory('Foo')
+
+
+def test_shared_connection(sharded):
+    broker = FakeBroker().start()
+    try:
+        bridges = sharded(mqtt_server='mqtt://127.0.0.1:{}'.format(broker.port))
+        bridges.loop.run_until_complete(bridges.connect())
+        bridges.loop.run_until_complete(wait_for(lambda: broker.subscribed('__TEST__/')))
+        assert len(broker.connections) == 1
+
+        for i in range(10):
+            broker.publish('__TEST__/accessory-{}/Switch/On'.format(i), b'1')
+        bridges.loop.run_until_complete(wait_for(
+            lambda: sum(len(bridge.accessories) for bridge in bridges.bridges) == 10
+        ))
+
+        accessory = bridges.bridge_for('accessory-0').get_accessory('accessory-0')
+        accessory.get_service('Switch').get_characteristic('On').client_update_value(0)
+        bridges.loop.run_until_complete(wait_for(
+            lambda: ('__TEST__/accessory-0/Switch/On', b'0') in [message[:2] for message in broker.published]
+        ))
+        bridges.client.disconnect()
+        bridges.client.loop_stop()
+    finally:
+        broker.stop()
@@ -0,0 +1,46 @@
+import os
+import subprocess
+import sys
+
+# Importing our own modules may take at most this share of the time it takes to import
+# mqtt2homekit.main: the rest is pyhap, paho and click, which every bridge needs.
+BUDGET = 0.1
+
+# These are only needed for some options, and are imported when they are used.
+DEFERRED = ('multiprocessing', 'sqlite3', 'mqtt2homekit.shards', 'mqtt2homekit.supervisor')
+
+
+def import_times(module, tmp_path):
+    """
+    Import module in a new interpreter, and return how long (in microseconds) each module
+    that was imported took, by itself, and with the modules it imported.
+    """
+    env = dict(os.environ, XDG_CACHE_HOME=str(tmp_path))
+    # Compiling our modules every time would be most of the time we take.
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import {}'.format(module)],
+        env=env, capture_output=True, text=True, check=True,
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        own, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = (int(own), int(cumulative))
+    return times
+
+
+def test_cold_start(tmp_path):
+    # The first time compiles our modules, and writes the cache of types.
+    import_times('mqtt2homekit.main', tmp_path)
+    assert (tmp_path / 'mqtt2homekit' / 'types.pickle').exists()
+
+    shares = []
+    for i in range(3):
+        times = import_times('mqtt2homekit.main', tmp_path)
+        for name in DEFERRED:
+            assert name not in times
+        ours = sum(own for name, (own, cumulative) in times.items() if name.startswith('mqtt2homekit'))
+        shares.append(ours / times['mqtt2homekit.main'][1])
+    assert min(shares) < BUDGET
@@ -0,0 +1,102 @@
+import multiprocessing
+import os
+import signal
+
+import pytest
+
+from benchmarks.broker import FakeBroker
+from benchmarks.utils import wait_for
+from mqtt2homekit import shards
+from mqtt2homekit.metrics import add_label
+from mqtt2homekit.shards import ShardTable
+from mqtt2homekit.supervisor import Supervisor
+
+
+def subscribed(broker, count):
+    connections = list(broker.connections)
+    return len(connections) == count and all(connection.subscriptions for connection in connections)
+
+
+@pytest.fixture
+def broker():
+    broker = FakeBroker().start()
+    yield broker
+    broker.stop()
+
+
+def test_add_label():
+    assert add_label('foo', 'shard', 1) == 'foo{shard="1"}'
+    assert add_label('foo{a="b"}', 'shard', 1) == 'foo{shard="1",a="b"}'
+
+
+def test_asking_table(tmp_path):
+    asked = []
+
+    def ask(accessory_id):
+        asked.append(accessory_id)
+        return len(asked) % 4
+
+    table = ShardTable(str(tmp_path / 'table'), 4, ask=ask)
+    assert [table.shard_for('accessory-{}'.format(i % 3)) for i in range(6)] == [1, 2, 3, 1, 2, 3]
+    assert asked == ['accessory-0', 'accessory-1', 'accessory-2']
+    assert not os.path.exists(str(tmp_path / 'table'))
+
+
+def test_supervisor_assigns(tmp_path, mocker):
+    mocker.patch.object(shards, 'MAX_ACCESSORIES', 2)
+    supervisor = Supervisor('Test Bridge', 2, persist_file=str(tmp_path / 'bridge.state'))
+    worker = supervisor.workers[0]
+    worker.connection, connection = multiprocessing.Pipe()
+    try:
+        for i in range(4):
+            connection.send(('shard_for', 'accessory-{}'.format(i)))
+        connection.send(('shard_for', 'accessory-0'))
+        connection.send(('health', {'pid': 1}))
+        supervisor.receive(worker)
+        answers = [connection.recv() for i in range(5)]
+    finally:
+        supervisor.loop.close()
+    # No shard gets more than it can hold, and the same accessory always gets the same answer.
+    assert sorted(shard for accessory_id, shard in answers[:4]) == [0, 0, 1, 1]
+    assert answers[4] == answers[0]
+    assert worker.health == {'pid': 1}
+    assert set(supervisor.table.assignments) == {'accessory-{}'.format(i) for i in range(4)}
+
+
+def test_workers(broker, tmp_path):
+    supervisor = Supervisor(
+        'Test Bridge', 2,
+        persist_file=str(tmp_path / 'bridge.state'),
+        mqtt_server='mqtt://127.0.0.1:{}'.format(broker.port),
+        prefix='__TEST__',
+        metrics=True,
+        heartbeat_interval=0.1,
+    )
+    loop = supervisor.loop
+
+    def accessories():
+        return sum(worker['accessories'] for worker in supervisor.health() if 'accessories' in worker)
+
+    try:
+        loop.run_until_complete(supervisor.run())
+        loop.run_until_complete(wait_for(lambda: subscribed(broker, 2), timeout=30))
+
+        for i in range(20):
+            broker.publish('__TEST__/accessory-{}/Switch/On'.format(i), b'1')
+        loop.run_until_complete(wait_for(lambda: accessories() == 20, timeout=10))
+        # Each message was handled by exactly one of the workers.
+        assert all(worker['accessories'] for worker in supervisor.health())
+        assert 'mqtt2homekit_messages_received_total{shard="1",service_type="Switch"}' in supervisor.render()
+
+        # A worker that dies is restarted.
+        crashed = supervisor.workers[0]
+        pid = crashed.process.pid
+        os.kill(pid, signal.SIGKILL)
+        loop.run_until_complete(wait_for(
+            lambda: crashed.restarts == 1 and crashed.health['pid'] != pid, timeout=30,
+        ))
+        assert 'mqtt2homekit_worker_restarts_total{shard="0"} 1' in supervisor.render()
+    finally:
+        loop.run_until_complete(supervisor.stop())
+    assert all(worker.process.exitcode is not None for worker in supervisor.workers)
+    assert os.path.exists(str(tmp_path / 'bridge.1.state'))
@@ -0,0 +1,66 @@
+import threading
+
+import pytest
+
+from benchmarks.broker import FakeBroker
+from benchmarks.utils import (record_events, run_until, start_bridge,
+                              stop_bridge)
+
+
+@pytest.fixture
+def broker():
+    broker = FakeBroker().start()
+    yield broker
+    broker.stop()
+
+
+@pytest.mark.parametrize('mqtt_loop', ['thread', 'asyncio'])
+def test_message_to_event(broker, mqtt_loop):
+    bridge = start_bridge(broker, mqtt_loop=mqtt_loop, prefix='__TEST__')
+    events = record_events(bridge)
+    threads = set()
+    handle_mqtt_message = bridge.handle_mqtt_message
+
+    def handle(*args):
+        threads.add(threading.current_thread())
+        handle_mqtt_message(*args)
+
+    bridge.client.on_message = handle
+
+    broker.publish('__TEST__/Foo/TemperatureSensor/CurrentTemperature', b'21.5')
+    run_until(bridge, lambda: events)
+    assert events[0][3]['value'] == 21.5
+    # HomeKit events are always sent from the driver's loop...
+    assert events[0][1] is threading.main_thread()
+    # ...and in asyncio mode, that is also where the MQTT message was handled.
+    assert (threads == {threading.main_thread()}) == (mqtt_loop == 'asyncio')
+    stop_bridge(bridge)
+
+
+def test_asyncio_publish(broker):
+    bridge = start_bridge(broker, mqtt_loop='asyncio', prefix='__TEST__')
+    bulb = bridge.get_or_create_accessory('Foo', 'Lightbulb')
+    bulb.get_service('Lightbulb').get_characteristic('On').client_update_value(1)
+    run_until(bridge, lambda: broker.published)
+    assert broker.published[0][:2] == ('__TEST__/Foo/Lightbulb/On', b'1')
+    stop_bridge(bridge)
+
+
+def test_scene_is_published_after_homekit_write(broker):
+    bridge = start_bridge(broker, qos=1, prefix='__TEST__')
+    for i in range(30):
+        bridge.get_or_create_accessory('light-{}'.format(i), 'Lightbulb')
+
+    async def scene():
+        for accessory in bridge.accessories.values():
+            accessory.get_service('Lightbulb').get_characteristic('On').client_update_value(1)
+        # Nothing is sent until HomeKit's write has been handled.
+        assert len(bridge._outbound) == 30
+
+    bridge.driver.loop.run_until_complete(scene())
+    run_until(bridge, lambda: len(broker.published) == 30)
+    assert {message.topic for message in broker.published} == {
+        '__TEST__/light-{}/Lightbulb/On'.format(i) for i in range(30)
+    }
+    assert {message.qos for message in broker.published} == {1}
+    stop_bridge(bridge)
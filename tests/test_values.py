@@ -0,0 +1,102 @@
+import json
+
+from mqtt2homekit import values
+from mqtt2homekit.values import ValueStore
+from tests.helpers import Message
+
+
+def test_journal(tmp_path):
+    path = str(tmp_path / 'values')
+    store = ValueStore(path)
+    store.changed('HomeKit/Foo/Switch/On', '1')
+    store.changed('HomeKit/Bar/Switch/On', '0')
+    store.flush()
+    store.changed('HomeKit/Foo/Switch/On', '0')
+    store.forget('HomeKit/Bar')
+    store.flush()
+    # Nothing has changed, so nothing is written.
+    store.flush()
+
+    with open(path) as fp:
+        lines = [json.loads(line) for line in fp]
+    assert lines == [
+        {'HomeKit/Foo/Switch/On': '1', 'HomeKit/Bar/Switch/On': '0'},
+        {'HomeKit/Foo/Switch/On': '0', 'HomeKit/Bar/Switch/On': None},
+    ]
+
+    # A crash part way through writing a line.
+    with open(path, 'a') as fp:
+        fp.write('{"HomeKit/Foo/Switch/On":')
+    assert ValueStore(path).load() == {'HomeKit/Foo/Switch/On': '0'}
+    # Loading compacts the journal.
+    with open(path) as fp:
+        assert fp.read() == '{"HomeKit/Foo/Switch/On":"0"}\n'
+
+
+def test_compact(tmp_path, mocker):
+    mocker.patch.object(values, 'COMPACT_AFTER', 3)
+    path = str(tmp_path / 'values')
+    store = ValueStore(path)
+    for i in range(5):
+        store.changed('HomeKit/Foo/Lightbulb/Brightness', str(i))
+        store.flush()
+    with open(path) as fp:
+        assert len(fp.readlines()) == 2
+    assert ValueStore(path).load() == {'HomeKit/Foo/Lightbulb/Brightness': '4'}
+
+
+def test_restore_values(mocker, tmp_path, build_bridge):
+    persist_file = str(tmp_path / 'bridge.state')
+    bridge = build_bridge(persist_file)
+    bridge.handle_mqtt_message(None, None, Message(b'__TEST__/Foo/Lightbulb/Brightness', b'40'))
+    bridge.handle_mqtt_message(None, None, Message(b'__TEST__/Foo/Lightbulb/Brightness', b'50'))
+    bridge.handle_mqtt_message(None, None, Message(b'__TEST__/Bar/TemperatureSensor/CurrentTemperature', b'21.5'))
+    bridge.get_accessory('Foo').get_service('Lightbulb').get_characteristic('On').client_update_value(1)
+    bridge.handle_mqtt_message(None, None, Message(b'__TEST__/Gone/Switch/On', b'1'))
+    bridge.handle_mqtt_message(None, None, Message(b'__TEST__/Gone/Switch/On', b''))
+    bridge.driver.persist()
+    bridge.values.flush()
+
+    restored = build_bridge(persist_file, skip_retained=True)
+    foo = restored.get_accessory('Foo').get_service('Lightbulb')
+    assert foo.get_characteristic('Brightness').value == 50
+    assert foo.get_characteristic('On').value == 1
+    sensor = restored.get_accessory('Bar').get_service('TemperatureSensor')
+    assert sensor.get_characteristic('CurrentTemperature').value == 21.5
+    assert set(restored.values.payloads) == {
+        '__TEST__/Foo/Lightbulb/Brightness',
+        '__TEST__/Foo/Lightbulb/On',
+        '__TEST__/Bar/TemperatureSensor/CurrentTemperature',
+    }
+
+    # Retained messages we already have the value for are skipped: others are handled as usual.
+    handle = mocker.patch.object(restored, 'handle_mqtt_message')
+    restored.receive_mqtt_message(None, None, Message(b'__TEST__/Foo/Lightbulb/Brightness', b'50', retain=True))
+    restored.receive_mqtt_message(None, None, Message(b'__TEST__/Foo/Lightbulb/On', b'1', retain=True))
+    handle.assert_not_called()
+    restored.receive_mqtt_message(None, None, Message(b'__TEST__/Foo/Lightbulb/Brightness', b'60', retain=True))
+    restored.receive_mqtt_message(None, None, Message(b'__TEST__/Foo/Lightbulb/Brightness', b'50'))
+    restored.receive_mqtt_message(None, None, Message(b'__TEST__/Gone/Switch/On', b'1', retain=True))
+    assert handle.call_count == 3
+
+
+def test_values_survive_new_service(tmp_path, build_bridge):
+    persist_file = str(tmp_path / 'bridge.state')
+    bridge = build_bridge(persist_file)
+    bridge.handle_mqtt_message(None, None, Message(b'__TEST__/Foo/Lightbulb/Brightness', b'50'))
+    # Adding a service pops the accessory and adds it again: that doesn't remove it.
+    bridge.handle_mqtt_message(None, None, Message(b'__TEST__/Foo/Switch/On', b'1'))
+    assert set(bridge.values.payloads) == {'__TEST__/Foo/Lightbulb/Brightness', '__TEST__/Foo/Switch/On'}
+    bridge.driver.persist()
+    bridge.values.flush()
+
+    restored = build_bridge(persist_file)
+    foo = restored.get_accessory('Foo')
+    assert foo.get_service('Lightbulb').get_characteristic('Brightness').value == 50
+    assert foo.get_service('Switch').get_characteristic('On').value == 1
+
+
+def test_values_disabled(tmp_path, build_bridge):
+    bridge = build_bridge(str(tmp_path / 'bridge.state'), values_interval=0)
+    assert bridge.values is None
+    bridge.handle_mqtt_message(None, None, Message(b'__TEST__/Foo/Lightbulb/Brightness', b'40'))